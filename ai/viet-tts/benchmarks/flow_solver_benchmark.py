@@ -0,0 +1,92 @@
+"""
+Quality / latency benchmark of the flow matching ODE solvers.
+
+Speech tokens are decoded once by the LLM, then the flow decoder is run with every
+solver / step count from the same initial noise. Each mel-spectrogram is compared to the
+10-step euler reference (mean absolute log-mel distance), together with its latency.
+
+Usage: python benchmarks/flow_solver_benchmark.py --text "Xin chào" --voice samples/diep-chi.wav
+"""
+import time
+import click
+import torch
+from rich.table import Table
+from rich.console import Console
+
+from viettts.tts import TTS
+from viettts.flow.flow_matching import ODE_SOLVERS
+from viettts.utils.common import set_all_random_seed
+from viettts.utils.file_utils import load_prompt_speech_from_file
+
+
+REFERENCE = ('euler', 10)
+# estimator calls per step (before classifier-free guidance)
+SOLVER_NFE = {'euler': 1, 'midpoint': 2, 'heun': 2, 'dpm': 1}
+
+
+def sync(device: torch.device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def run_flow(tts: TTS, speech_token: torch.Tensor, model_input: dict, n_timesteps: int, solver: str, seed: int):
+    device = tts.model.device
+    set_all_random_seed(seed)
+    sync(device)
+    start = time.perf_counter()
+    mel = tts.model.flow.inference(
+        token=speech_token.to(device),
+        token_len=torch.tensor([speech_token.shape[1]], dtype=torch.int32).to(device),
+        prompt_token=model_input['flow_prompt_speech_token'].to(device),
+        prompt_token_len=torch.tensor([model_input['flow_prompt_speech_token'].shape[1]], dtype=torch.int32).to(device),
+        prompt_feat=model_input['prompt_speech_feat'].to(device),
+        prompt_feat_len=torch.tensor([model_input['prompt_speech_feat'].shape[1]], dtype=torch.int32).to(device),
+        embedding=model_input['flow_embedding'].to(device),
+        n_timesteps=n_timesteps,
+        solver=solver
+    )
+    sync(device)
+    return mel, time.perf_counter() - start
+
+
+@click.command()
+@click.option('--text', type=str, required=True, help='Text to synthesize.')
+@click.option('--voice', type=str, required=True, help='Prompt audio file.')
+@click.option('--model-dir', type=str, default='pretrained-models')
+@click.option('--steps', type=str, default='2,3,4,5,10', help='Comma separated step counts to compare.')
+@click.option('--repeat', type=int, default=3, help='Runs per configuration, the fastest one is reported.')
+@click.option('--seed', type=int, default=1234)
+def main(text: str, voice: str, model_dir: str, steps: str, repeat: int, seed: int):
+    tts = TTS(model_dir)
+    prompt_speech_16k = load_prompt_speech_from_file(filepath=voice, min_duration=3, max_duration=5)
+    model_input = tts.frontend.frontend_tts(tts.frontend.preprocess_text(text, split=False), prompt_speech_16k)
+    set_all_random_seed(seed)
+    speech_token = tts.model.llm.inference_batch(
+        text=[model_input['text'].to(tts.model.device)],
+        prompt_text=[torch.zeros(1, 0, dtype=torch.int32, device=tts.model.device)],
+        prompt_speech_token=[torch.zeros(1, 0, dtype=torch.int32, device=tts.model.device)],
+        embedding=[model_input['llm_embedding'].to(tts.model.device).half()]
+    )[0]
+    speech_token = torch.tensor(speech_token, dtype=torch.int32).unsqueeze(dim=0)
+
+    # warmup
+    run_flow(tts, speech_token, model_input, 2, REFERENCE[0], seed)
+    reference, reference_time = run_flow(tts, speech_token, model_input, REFERENCE[1], REFERENCE[0], seed)
+
+    table = Table(title=f'Flow solvers ({speech_token.shape[1]} speech tokens, reference {REFERENCE[0]}-{REFERENCE[1]})')
+    for column in ['Solver', 'Steps', 'NFE', 'Latency (ms)', 'Speedup', 'Mel L1']:
+        table.add_column(column)
+    for solver in ODE_SOLVERS:
+        for n_timesteps in [int(i) for i in steps.split(',')]:
+            best = float('inf')
+            for _ in range(repeat):
+                mel, elapsed = run_flow(tts, speech_token, model_input, n_timesteps, solver, seed)
+                best = min(best, elapsed)
+            distance = (mel - reference).abs().mean().item()
+            table.add_row(solver, str(n_timesteps), str(SOLVER_NFE[solver] * n_timesteps), f'{best * 1000:.1f}',
+                          f'{reference_time / best:.2f}x', f'{distance:.4f}')
+    Console().print(table)
+
+
+if __name__ == '__main__':
+    main()
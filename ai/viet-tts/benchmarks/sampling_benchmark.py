@@ -0,0 +1,101 @@
+"""
+Micro-benchmark of the per-token sampler overhead of the LLM decoder.
+
+Compares the former list based nucleus / RAS sampling (kept here as reference)
+with the tensorized samplers of viettts.utils.common, for one row and for a batch of rows.
+
+Usage: python benchmarks/sampling_benchmark.py --steps 500 --batch-size 8 --device cpu
+"""
+import time
+import click
+import torch
+from rich.table import Table
+from rich.console import Console
+
+from viettts.utils.common import ras_sampling, random_sampling
+
+
+VOCAB_SIZE = 6561 + 3
+
+
+def legacy_nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
+    prob, indices = [], []
+    cum_prob = 0.0
+    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
+    for i in range(len(sorted_idx)):
+        if (cum_prob < top_p or len(prob) <= 1) and len(prob) < top_k:
+            cum_prob += sorted_value[i]
+            prob.append(sorted_value[i])
+            indices.append(sorted_idx[i])
+        else:
+            break
+    prob = torch.tensor(prob).to(weighted_scores)
+    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
+    return indices[prob.multinomial(1, replacement=True)]
+
+
+def legacy_ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
+    top_ids = legacy_nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
+    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
+    if rep_num >= win_size * tau_r:
+        top_ids = random_sampling(weighted_scores, decoded_tokens, sampling)
+    return top_ids
+
+
+def sync(device: torch.device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def bench_legacy(scores: torch.Tensor, steps: int) -> float:
+    """Rows are sampled one by one, like the former decoding loop."""
+    decoded = [[] for _ in range(scores.size(0))]
+    sync(scores.device)
+    start = time.perf_counter()
+    for step in range(steps):
+        for i in range(scores.size(0)):
+            decoded[i].append(legacy_ras_sampling(scores[step % scores.size(0)], decoded[i], 25).item())
+    sync(scores.device)
+    return time.perf_counter() - start
+
+
+def bench_tensorized(scores: torch.Tensor, steps: int) -> float:
+    """All rows are sampled in one call, history is a preallocated tensor."""
+    decoded = torch.zeros((scores.size(0), steps), dtype=torch.long, device=scores.device)
+    sync(scores.device)
+    start = time.perf_counter()
+    for step in range(steps):
+        top_ids = ras_sampling(scores, decoded[:, :step], 25)
+        decoded[:, step] = top_ids.squeeze(dim=1)
+        top_ids.tolist()
+    sync(scores.device)
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.option('--steps', type=int, default=500, help='Number of sampled tokens per row.')
+@click.option('--batch-size', type=int, default=8, help='Number of rows decoded together.')
+@click.option('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+def main(steps: int, batch_size: int, device: str):
+    device = torch.device(device)
+    torch.manual_seed(0)
+    # peaky distributions, similar to the llm output
+    scores = (torch.randn(batch_size, VOCAB_SIZE, device=device) * 4).log_softmax(dim=-1)
+
+    table = Table(title=f'Sampler overhead ({steps} steps, device={device})')
+    table.add_column('Rows')
+    table.add_column('Legacy (us/token)')
+    table.add_column('Tensorized (us/token)')
+    table.add_column('Speedup')
+    for rows in sorted({1, batch_size}):
+        # warmup
+        bench_legacy(scores[:rows], 10)
+        bench_tensorized(scores[:rows], 10)
+        legacy = bench_legacy(scores[:rows], steps) / (steps * rows) * 1e6
+        tensorized = bench_tensorized(scores[:rows], steps) / (steps * rows) * 1e6
+        table.add_row(str(rows), f'{legacy:.1f}', f'{tensorized:.1f}', f'{legacy / tensorized:.1f}x')
+    Console().print(table)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import io
+
+import numpy as np
+import pytest
+import soundfile
+
+from viettts.utils.audio_encoder import encode_audio, encode_stream, get_encoder, has_pyav
+
+SAMPLE_RATE = 22050
+DURATION = 10
+
+requires_pyav = pytest.mark.skipif(not has_pyav(), reason="needs PyAV")
+
+
+def make_chunks():
+    t = np.arange(SAMPLE_RATE * DURATION) / SAMPLE_RATE
+    audio = (0.3 * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+    return np.array_split(audio, 37)
+
+
+def decode(data: bytes, response_format: str) -> np.ndarray:
+    if response_format == 'pcm':
+        return np.frombuffer(data, dtype=np.int16).astype(np.float32) / (2 ** 15 - 1)
+    if response_format in ('opus', 'aac'):
+        import av
+        with av.open(io.BytesIO(data)) as container:
+            return np.concatenate([frame.to_ndarray().reshape(-1) for frame in container.decode(audio=0)])
+    audio, sample_rate = soundfile.read(io.BytesIO(data), dtype='float32')
+    assert sample_rate == SAMPLE_RATE
+    return audio
+
+
+def expected_samples(response_format: str) -> int:
+    # opus is always encoded at 48 kHz
+    return DURATION * (48000 if response_format == 'opus' else SAMPLE_RATE)
+
+
+@pytest.mark.parametrize('response_format', [
+    'pcm', 'wav', 'flac', 'mp3',
+    pytest.param('opus', marks=requires_pyav),
+    pytest.param('aac', marks=requires_pyav),
+])
+def test_complete_file_round_trip(response_format):
+    audio = decode(encode_audio(make_chunks(), response_format, SAMPLE_RATE), response_format)
+    # lossy codecs add encoder delay / padding of at most a few frames
+    assert abs(len(audio) - expected_samples(response_format)) <= 4096
+    assert np.abs(audio).max() > 0.2
+
+
+@pytest.mark.parametrize('response_format', [
+    'pcm', 'wav',
+    pytest.param('mp3', marks=requires_pyav),
+    pytest.param('opus', marks=requires_pyav),
+    pytest.param('aac', marks=requires_pyav),
+])
+def test_stream_round_trip(response_format):
+    encoder = get_encoder(response_format, SAMPLE_RATE, incremental=True)
+    parts = list(encode_stream(make_chunks(), encoder))
+    assert len(parts) > 1
+    audio = decode(b''.join(parts), response_format)
+    assert abs(len(audio) - expected_samples(response_format)) <= 4096
+
+
+def test_flac_cannot_be_streamed():
+    with pytest.raises(ValueError):
+        get_encoder('flac', SAMPLE_RATE, incremental=True)
@@ -7,7 +7,9 @@ from loguru import logger
 from rich.table import Table
 from rich.console import Console
 from viettts.tts import TTS
-from viettts.utils.file_utils import load_prompt_speech_from_file, load_voices
+from viettts.frontend import TTSFrontEnd
+from viettts.utils.file_utils import load_prompt_speech_from_file, load_voices, download_model
+from viettts.utils.voice_store import build_voice_store
 
 
 AUDIO_DIR = 'samples'
@@ -99,6 +101,30 @@ def show_voice():
     console.print(table)
 
 
+@click.command('build-voices')
+@click.option('-d', '--voice-dir', type=str, default=AUDIO_DIR, help=f"The directory containing voice audio files. Default is '{AUDIO_DIR}'.")
+@click.option('-o', '--output', type=str, default=os.path.join(MODEL_DIR, 'voice-store'), help="The directory to save precomputed voices. Default is 'pretrained-models/voice-store'.")
+def build_voices(voice_dir: str, output: str):
+    """Precompute speaker conditioning of built-in voices, loaded by the API server at startup.
+
+    Usage: viettts build-voices --voice-dir samples --output pretrained-models/voice-store
+    """
+    st = time.perf_counter()
+    if not os.path.exists(MODEL_DIR):
+        logger.info('Downloading model from huggingface [dangvansam/viet-tts]')
+        download_model(MODEL_DIR)
+
+    frontend = TTSFrontEnd(
+        speech_embedding_model=f'{MODEL_DIR}/speech_embedding.onnx',
+        speech_tokenizer_model=f'{MODEL_DIR}/speech_tokenizer.onnx'
+    )
+    voice_map = load_voices(voice_dir)
+    build_voice_store(frontend, voice_map, output)
+
+    et = time.perf_counter()
+    logger.success(f"Saved {len(voice_map)} voices to: {output} [time cost={et-st:.2f}s]")
+
+
 @click.group()
 def cli():
     """
@@ -111,4 +137,5 @@ def cli():
 
 cli.add_command(start_server)
 cli.add_command(synthesis)
-cli.add_command(show_voice)
\ No newline at end of file
+cli.add_command(show_voice)
+cli.add_command(build_voices)
\ No newline at end of file
@@ -140,12 +140,14 @@ class ConditionalCFM(BASECFM):
         self.t_scheduler = cfm_params.t_scheduler
         self.training_cfg_rate = cfm_params.training_cfg_rate
         self.inference_cfg_rate = cfm_params.inference_cfg_rate
+        # run conditional and unconditional estimations of classifier-free guidance in one batched call
+        self.batch_cfg = cfm_params.batch_cfg if hasattr(cfm_params, "batch_cfg") else True
         in_channels = in_channels + (spk_emb_dim if n_spks > 0 else 0)
         # Just change the architecture of the estimator here
         self.estimator = estimator
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, solver=None):
         """Forward diffusion
 
         Args:
@@ -158,16 +160,21 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): name of the ODE solver in ODE_SOLVERS.
+                Defaults to None, which uses cfm_params.solver.
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
+        solver = solver or self.solver
+        if solver not in ODE_SOLVERS:
+            raise ValueError(f"Unknown ODE solver '{solver}', available: {list(ODE_SOLVERS)}")
         z = torch.randn_like(mu) * temperature
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond)
+        return ODE_SOLVERS[solver](self, z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond)
 
     def solve_euler(self, x, t_span, mu, mask, spks, cond):
         """
@@ -184,32 +191,102 @@ class ConditionalCFM(BASECFM):
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        t = t.unsqueeze(dim=0)
+        inputs = self.prepare_estimator_inputs(x, mask, mu, spks, cond)
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1:step], t_span[step] - t_span[step - 1]
+            x = x + dt * self.velocity(x, t, inputs)
+        return x
 
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
-        sol = []
+    def solve_midpoint(self, x, t_span, mu, mask, spks, cond):
+        """
+        Explicit midpoint solver (2nd order, 2 estimations per step).
+        Args: same as solve_euler
+        """
+        inputs = self.prepare_estimator_inputs(x, mask, mu, spks, cond)
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1:step], t_span[step] - t_span[step - 1]
+            x_mid = x + 0.5 * dt * self.velocity(x, t, inputs)
+            x = x + dt * self.velocity(x_mid, t + 0.5 * dt, inputs)
+        return x
 
+    def solve_heun(self, x, t_span, mu, mask, spks, cond):
+        """
+        Heun solver (2nd order, 2 estimations per step).
+        Args: same as solve_euler
+        """
+        inputs = self.prepare_estimator_inputs(x, mask, mu, spks, cond)
         for step in range(1, len(t_span)):
-            dphi_dt = self.forward_estimator(x, mask, mu, t, spks, cond)
-            # Classifier-Free Guidance inference introduced in VoiceBox
-            if self.inference_cfg_rate > 0:
+            t, dt = t_span[step - 1:step], t_span[step] - t_span[step - 1]
+            dphi_dt = self.velocity(x, t, inputs)
+            x_pred = x + dt * dphi_dt
+            x = x + 0.5 * dt * (dphi_dt + self.velocity(x_pred, t + dt, inputs))
+        return x
+
+    def solve_dpm(self, x, t_span, mu, mask, spks, cond):
+        """
+        Few-step 2nd order multistep solver in the spirit of DPM-Solver++(2M): the velocity
+        of the previous step is reused to extrapolate the current one (Adams-Bashforth with
+        variable step size), so it costs 1 estimation per step like euler.
+        Args: same as solve_euler
+        """
+        inputs = self.prepare_estimator_inputs(x, mask, mu, spks, cond)
+        prev_dphi_dt, prev_dt = None, None
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1:step], t_span[step] - t_span[step - 1]
+            dphi_dt = self.velocity(x, t, inputs)
+            if prev_dphi_dt is None:
+                x = x + dt * dphi_dt
+            else:
+                x = x + dt * (dphi_dt + 0.5 * dt / prev_dt * (dphi_dt - prev_dphi_dt))
+            prev_dphi_dt, prev_dt = dphi_dt, dt
+        return x
+
+    def prepare_estimator_inputs(self, x, mask, mu, spks, cond):
+        """Estimator inputs that do not change between solver steps."""
+        # Classifier-Free Guidance inference introduced in VoiceBox
+        use_cfg = self.inference_cfg_rate > 0
+        inputs = {'use_cfg': use_cfg, 'batch_cfg': use_cfg and self.support_batch_cfg(x.size(0)),
+                  'mask': mask, 'mu': mu, 'spks': spks, 'cond': cond}
+        if inputs['batch_cfg']:
+            # conditional rows first, then unconditional rows with zeroed mu / spks / cond,
+            # these do not change between steps so they are stacked only once
+            inputs['mask_in'] = torch.concat([mask, mask], dim=0)
+            inputs['mu_in'] = torch.concat([mu, torch.zeros_like(mu)], dim=0)
+            inputs['spks_in'] = torch.concat([spks, torch.zeros_like(spks)], dim=0) if spks is not None else None
+            inputs['cond_in'] = torch.concat([cond, torch.zeros_like(cond)], dim=0)
+        return inputs
+
+    def velocity(self, x, t, inputs):
+        """Estimated dphi_dt at (x, t), with classifier-free guidance applied."""
+        if inputs['batch_cfg']:
+            batch_size = x.size(0)
+            dphi_dt, cfg_dphi_dt = self.forward_estimator(
+                torch.concat([x, x], dim=0), inputs['mask_in'], inputs['mu_in'],
+                t.expand(2 * batch_size), inputs['spks_in'], inputs['cond_in']
+            ).split(batch_size, dim=0)
+        else:
+            mu, spks, cond = inputs['mu'], inputs['spks'], inputs['cond']
+            dphi_dt = self.forward_estimator(x, inputs['mask'], mu, t, spks, cond)
+            if inputs['use_cfg']:
                 cfg_dphi_dt = self.forward_estimator(
-                    x, mask,
+                    x, inputs['mask'],
                     torch.zeros_like(mu), t,
                     torch.zeros_like(spks) if spks is not None else None,
                     torch.zeros_like(cond)
                 )
-                dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt -
-                           self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
-
-        return sol[-1]
+        if inputs['use_cfg']:
+            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt -
+                       self.inference_cfg_rate * cfg_dphi_dt)
+        return dphi_dt
+
+    def support_batch_cfg(self, batch_size):
+        if not self.batch_cfg:
+            return False
+        if isinstance(self.estimator, torch.nn.Module):
+            return True
+        # onnx estimator exported with a fixed batch size only accepts that size
+        export_batch_size = self.estimator.get_inputs()[0].shape[0]
+        return not isinstance(export_batch_size, int) or export_batch_size == 2 * batch_size
 
     def forward_estimator(self, x, mask, mu, t, spks, cond):
         if isinstance(self.estimator, torch.nn.Module):
@@ -266,3 +343,12 @@ class ConditionalCFM(BASECFM):
         pred = self.estimator(y, mask, mu, t.squeeze(), spks, cond)
         loss = F.mse_loss(pred * mask, u * mask, reduction="sum") / (torch.sum(mask) * u.shape[1])
         return loss, y
+
+
+# name -> solver of ConditionalCFM, selectable per request
+ODE_SOLVERS = {
+    'euler': ConditionalCFM.solve_euler,
+    'midpoint': ConditionalCFM.solve_midpoint,
+    'heun': ConditionalCFM.solve_heun,
+    'dpm': ConditionalCFM.solve_dpm,
+}
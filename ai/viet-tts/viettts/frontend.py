@@ -1,4 +1,6 @@
 import os
+import hashlib
+import threading
 import torch
 import torchaudio
 import whisper
@@ -7,16 +9,69 @@ import numpy as np
 import torchaudio.compliance.kaldi as kaldi
 from typing import Callable, List, Union
 from functools import partial
+from collections import OrderedDict
 from loguru import logger
 
 from viettts.utils.frontend_utils import split_text, normalize_text, mel_spectrogram
 from viettts.tokenizer.tokenizer import get_tokenizer
 
+
+class PromptFeatureCache:
+    """
+    LRU cache of prompt conditioning features (speech tokens, mel features, speaker embedding).
+    Entries are keyed by a content hash of the 16k prompt audio and the cache is bounded by the
+    total size in bytes of the cached tensors.
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.cur_bytes = 0
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def make_key(prompt_speech_16k: torch.Tensor) -> str:
+        data = prompt_speech_16k.detach().cpu().contiguous().numpy()
+        return hashlib.sha1(data.tobytes()).hexdigest() + f'_{tuple(data.shape)}'
+
+    @staticmethod
+    def entry_bytes(prompt_input: dict) -> int:
+        # llm_embedding and flow_embedding share one tensor, count it once
+        tensors = {id(v): v for v in prompt_input.values() if isinstance(v, torch.Tensor)}
+        return sum(v.element_size() * v.nelement() for v in tensors.values())
+
+    def get(self, key: str):
+        with self.lock:
+            prompt_input = self.entries.get(key)
+            if prompt_input is not None:
+                self.entries.move_to_end(key)
+            return prompt_input
+
+    def put(self, key: str, prompt_input: dict):
+        size = self.entry_bytes(prompt_input)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = prompt_input
+            self.cur_bytes += size
+            while self.cur_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.cur_bytes -= self.entry_bytes(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.cur_bytes = 0
+
+
 class TTSFrontEnd:
     def __init__(
         self,
         speech_embedding_model: str,
         speech_tokenizer_model: str,
+        prompt_cache_bytes: int = 64 * 1024 * 1024
     ):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.tokenizer = get_tokenizer()
@@ -34,6 +89,7 @@ class TTSFrontEnd:
             providers=["CUDAExecutionProvider" if torch.cuda.is_available() else "CPUExecutionProvider"]
         )
         self.spk2info = {}
+        self.prompt_cache = PromptFeatureCache(max_bytes=prompt_cache_bytes)
 
     def _extract_text_token(self, text: str):
         text_token = self.tokenizer.encode(text, allowed_special='all')
@@ -98,29 +154,51 @@ class TTSFrontEnd:
             ))
         return text
 
-    def frontend_tts(
-        self,
-        text: str,
-        prompt_speech_16k: Union[np.ndarray, torch.Tensor]
-    ) -> dict:
+    def frontend_prompt(self, prompt_speech_16k: Union[np.ndarray, torch.Tensor, dict]) -> dict:
+        """
+        Extract the prompt conditioning (speech tokens, 22.05k mel features, speaker embedding)
+        once per prompt audio. Results are cached by content hash, so repeated prompts
+        (e.g. built-in voices) skip feature extraction entirely.
+        Precomputed conditioning (see `viettts.utils.voice_store`) is returned as is.
+        """
+        if isinstance(prompt_speech_16k, dict):
+            return prompt_speech_16k
         if isinstance(prompt_speech_16k, np.ndarray):
             prompt_speech_16k = torch.from_numpy(prompt_speech_16k)
 
-        text_token, text_token_len = self._extract_text_token(text)
+        key = self.prompt_cache.make_key(prompt_speech_16k)
+        prompt_input = self.prompt_cache.get(key)
+        if prompt_input is not None:
+            return prompt_input
+
         speech_token, speech_token_len = self._extract_speech_token(prompt_speech_16k)
         prompt_speech_22050 = torchaudio.transforms.Resample(orig_freq=16000, new_freq=22050)(prompt_speech_16k)
         speech_feat, speech_feat_len = self._extract_speech_feat(prompt_speech_22050)
         embedding = self._extract_spk_embedding(prompt_speech_16k)
 
-        model_input = {
-            'text': text_token,
-            'text_len': text_token_len,
-            'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
+        prompt_input = {
+            'flow_prompt_speech_token': speech_token,
+            'flow_prompt_speech_token_len': speech_token_len,
             'prompt_speech_feat': speech_feat,
             'prompt_speech_feat_len': speech_feat_len,
             'llm_embedding': embedding,
             'flow_embedding': embedding
         }
+        self.prompt_cache.put(key, prompt_input)
+        return prompt_input
+
+    def frontend_tts(
+        self,
+        text: str,
+        prompt_speech_16k: Union[np.ndarray, torch.Tensor, dict]
+    ) -> dict:
+        prompt_input = self.frontend_prompt(prompt_speech_16k)
+        text_token, text_token_len = self._extract_text_token(text)
+        model_input = {
+            'text': text_token,
+            'text_len': text_token_len,
+            **prompt_input
+        }
         return model_input
 
 
@@ -131,21 +209,16 @@ class TTSFrontEnd:
     ) -> dict:
         if isinstance(source_speech_16k, np.ndarray):
             source_speech_16k = torch.from_numpy(source_speech_16k)
-        if isinstance(prompt_speech_16k, np.ndarray):
-            prompt_speech_16k = torch.from_numpy(prompt_speech_16k)
 
-        prompt_speech_token, prompt_speech_token_len = self._extract_speech_token(prompt_speech_16k)
-        prompt_speech_22050 = torchaudio.transforms.Resample(orig_freq=16000, new_freq=22050)(prompt_speech_16k)
-        prompt_speech_feat, prompt_speech_feat_len = self._extract_speech_feat(prompt_speech_22050)
-        embedding = self._extract_spk_embedding(prompt_speech_16k)
+        prompt_input = self.frontend_prompt(prompt_speech_16k)
         source_speech_token, source_speech_token_len = self._extract_speech_token(source_speech_16k)
         model_input = {
             'source_speech_token': source_speech_token,
             'source_speech_token_len': source_speech_token_len,
-            'flow_prompt_speech_token': prompt_speech_token,
-            'flow_prompt_speech_token_len': prompt_speech_token_len,
-            'prompt_speech_feat': prompt_speech_feat,
-            'prompt_speech_feat_len': prompt_speech_feat_len,
-            'flow_embedding': embedding
+            'flow_prompt_speech_token': prompt_input['flow_prompt_speech_token'],
+            'flow_prompt_speech_token_len': prompt_input['flow_prompt_speech_token_len'],
+            'prompt_speech_feat': prompt_input['prompt_speech_feat'],
+            'prompt_speech_feat_len': prompt_input['prompt_speech_feat_len'],
+            'flow_embedding': prompt_input['flow_embedding']
         }
         return model_input
@@ -1,4 +1,4 @@
-from typing import Dict, Optional, Callable, List, Generator
+from typing import Dict, Optional, Callable, List, Generator, Union
 import torch
 from torch import nn
 import torch.nn.functional as F
@@ -6,6 +6,7 @@ from torch.nn.utils.rnn import pad_sequence, unpad_sequence
 from viettts.utils.common import IGNORE_ID
 from viettts.transformer.label_smoothing_loss import LabelSmoothingLoss
 from viettts.utils.common import th_accuracy
+from viettts.transformer.attention import KVCache
 
 
 class TransformerLM(torch.nn.Module):
@@ -126,14 +127,22 @@ class TransformerLM(torch.nn.Module):
     def sampling_ids(
             self,
             weighted_scores: torch.Tensor,
-            decoded_tokens: List,
+            decoded_tokens: torch.Tensor,
             sampling: int,
-            ignore_eos: bool = True,
+            ignore_eos: Union[bool, torch.Tensor] = True,
     ):
+        """
+        weighted_scores: (vocab,) or (batch, vocab), ignore_eos: bool or (batch,) bool tensor.
+        Rows that must not end yet resample until they draw a token other than EOS.
+        """
+        top_ids = self.sampling(weighted_scores, decoded_tokens, sampling)
+        if isinstance(ignore_eos, torch.Tensor):
+            ignore_eos = ignore_eos.view(-1, 1)
         while True:
-            top_ids = self.sampling(weighted_scores, decoded_tokens, sampling)
-            if (not ignore_eos) or (self.speech_token_size not in top_ids):
+            retry = (top_ids == self.speech_token_size) & ignore_eos
+            if not retry.any():
                 break
+            top_ids = torch.where(retry, self.sampling(weighted_scores, decoded_tokens, sampling), top_ids)
         return top_ids
 
     @torch.inference_mode()
@@ -179,21 +188,146 @@ class TransformerLM(torch.nn.Module):
         min_len = int((text_len - prompt_text_len) * min_token_text_ratio)
         max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
 
-        # 5. step by step decode
-        out_tokens = []
-        offset = 0
-        att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
+        # 5. step by step decode, only the prompt needs a causal mask, single token steps attend to all history
+        decoded = torch.zeros(max_len, dtype=torch.long, device=lm_input.device)
+        use_kv_cache = self.support_kv_cache()
+        if use_kv_cache:
+            kv_cache = self.init_kv_cache(1, lm_input.size(1) + max_len, lm_input.dtype, lm_input.device)
+        else:
+            offset = 0
+            att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
+        att_mask = torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device, dtype=torch.bool))
+        no_mask = torch.ones((0, 0, 0), device=lm_input.device, dtype=torch.bool)
         for i in range(max_len):
-            y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
-                                                                  att_cache=att_cache, cnn_cache=cnn_cache,
-                                                                  att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
-                                                                                                 device=lm_input.device)).to(torch.bool))
+            if use_kv_cache:
+                y_pred = self.llm.forward_chunk_kv(lm_input, kv_cache, att_mask=att_mask)
+            else:
+                y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
+                                                                      att_cache=att_cache, cnn_cache=cnn_cache, att_mask=att_mask)
+                offset += lm_input.size(1)
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False).item()
+            top_ids = self.sampling_ids(logp.squeeze(dim=0), decoded[:i], sampling, ignore_eos=i < min_len).item()
             if top_ids == self.speech_token_size:
                 break
             # in stream mode, yield token one by one
             yield top_ids
-            out_tokens.append(top_ids)
-            offset += lm_input.size(1)
+            decoded[i] = top_ids
             lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+            att_mask = no_mask
+
+    def support_kv_cache(self) -> bool:
+        # llm exported by torch.jit only provides forward_chunk
+        return not isinstance(self.llm, torch.jit.ScriptModule)
+
+    def init_kv_cache(self, batch_size: int, capacity: int, dtype: torch.dtype, device: torch.device) -> KVCache:
+        self_attn = self.llm.encoders[0].self_attn
+        return KVCache(len(self.llm.encoders), batch_size, self_attn.h, self_attn.d_k, capacity, device=device, dtype=dtype)
+
+    @torch.inference_mode()
+    def inference_batch(
+            self,
+            text: List[torch.Tensor],
+            prompt_text: List[torch.Tensor],
+            prompt_speech_token: List[torch.Tensor],
+            embedding: List[torch.Tensor],
+            sampling: int = 25,
+            max_token_text_ratio: float = 20,
+            min_token_text_ratio: float = 2,
+    ) -> List[List[int]]:
+        """Decode several utterances together, one batched forward per step.
+
+        Rows may come from different sentences or different requests (with
+        different prompts). They are left-padded so that every row appends its
+        next token at the same position; padded positions are masked out.
+
+        Args:
+            text: list of (1, T_i) text tokens
+            prompt_text: list of (1, P_i) prompt text tokens
+            prompt_speech_token: list of (1, S_i) prompt speech tokens
+            embedding: list of (1, D) or (0, D) speaker embeddings
+
+        Returns:
+            List[List[int]]: decoded speech tokens of each row, without EOS
+        """
+        batch_size = len(text)
+        device = text[0].device
+        if not self.support_kv_cache():
+            return [list(self.inference(text=text[i],
+                                        text_len=torch.tensor([text[i].shape[1]], dtype=torch.int32, device=device),
+                                        prompt_text=prompt_text[i],
+                                        prompt_text_len=torch.tensor([prompt_text[i].shape[1]], dtype=torch.int32, device=device),
+                                        prompt_speech_token=prompt_speech_token[i],
+                                        prompt_speech_token_len=torch.tensor([prompt_speech_token[i].shape[1]], dtype=torch.int32, device=device),
+                                        embedding=embedding[i],
+                                        sampling=sampling,
+                                        max_token_text_ratio=max_token_text_ratio,
+                                        min_token_text_ratio=min_token_text_ratio))
+                    for i in range(batch_size)]
+
+        # 1. encode text of all rows together
+        full_text = [torch.concat([p, t], dim=1).squeeze(dim=0) for p, t in zip(prompt_text, text)]
+        full_text_len = torch.tensor([t.size(0) for t in full_text], dtype=torch.int32, device=device)
+        full_text = pad_sequence(full_text, batch_first=True, padding_value=0)
+        encoded, encoded_len = self.encode(self.text_embedding(full_text), full_text_len)
+
+        # 2. build llm_input of each row
+        sos_eos_emb = self.llm_embedding.weight[self.sos_eos].reshape(1, -1)
+        task_id_emb = self.llm_embedding.weight[self.task_id].reshape(1, -1)
+        lm_inputs = []
+        for i in range(batch_size):
+            if embedding[i].shape[0] != 0:
+                spk_emb = self.spk_embed_affine_layer(F.normalize(embedding[i], dim=1))
+            else:
+                spk_emb = torch.zeros(0, self.llm_input_size, dtype=encoded.dtype, device=device)
+            if prompt_speech_token[i].shape[1] != 0:
+                prompt_speech_token_emb = self.speech_embedding(prompt_speech_token[i].squeeze(dim=0))
+            else:
+                prompt_speech_token_emb = torch.zeros(0, self.llm_input_size, dtype=encoded.dtype, device=device)
+            lm_inputs.append(torch.concat([sos_eos_emb, spk_emb, encoded[i, :encoded_len[i]],
+                                           task_id_emb, prompt_speech_token_emb], dim=0))
+
+        # 3. left pad llm_input
+        lm_input_len = torch.tensor([x.size(0) for x in lm_inputs], device=device)
+        max_input_len = int(lm_input_len.max())
+        lm_input = torch.zeros(batch_size, max_input_len, self.llm_input_size, dtype=encoded.dtype, device=device)
+        for i, x in enumerate(lm_inputs):
+            lm_input[i, max_input_len - x.size(0):] = x
+
+        # 4. cal min/max_length of each row
+        min_len = [int(t.shape[1] * min_token_text_ratio) for t in text]
+        max_len = [int(t.shape[1] * max_token_text_ratio) for t in text]
+
+        # 5. key_valid marks the real (non padded) positions of the whole buffer, it does not change while
+        # decoding since padding is only on the left; single token steps need no mask when nothing is padded
+        capacity = max_input_len + max(max_len)
+        kv_cache = self.init_kv_cache(batch_size, capacity, lm_input.dtype, device)
+        key_valid = (torch.arange(capacity, device=device).unsqueeze(0) >= (max_input_len - lm_input_len).unsqueeze(1)).unsqueeze(1)
+        causal = torch.tril(torch.ones((max_input_len, max_input_len), device=device, dtype=torch.bool))
+        att_mask = causal.unsqueeze(0) & key_valid[:, :, :max_input_len]
+        step_mask = key_valid if bool((lm_input_len != max_input_len).any()) else torch.ones((0, 0, 0), device=device, dtype=torch.bool)
+
+        # 6. step by step decode, finished rows keep feeding a dummy token until all rows end.
+        # Every unfinished row has decoded exactly `step` tokens, so the history of all rows is one tensor.
+        decoded = torch.zeros((batch_size, max(max_len)), dtype=torch.long, device=device)
+        min_len_t = torch.tensor(min_len, device=device)
+        out_tokens = [[] for _ in range(batch_size)]
+        finished = [max_len[i] <= 0 for i in range(batch_size)]
+        for step in range(max(max_len)):
+            if all(finished):
+                break
+            y_pred = self.llm.forward_chunk_kv(lm_input, kv_cache, att_mask=att_mask)
+            logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+            top_ids = self.sampling_ids(logp, decoded[:, :step], sampling, ignore_eos=step < min_len_t).squeeze(dim=1)
+            for i, token in enumerate(top_ids.tolist()):
+                if finished[i]:
+                    continue
+                if token == self.speech_token_size:
+                    finished[i] = True
+                    continue
+                out_tokens[i].append(token)
+                if len(out_tokens[i]) >= max_len[i]:
+                    finished[i] = True
+            decoded[:, step] = top_ids.masked_fill(top_ids == self.speech_token_size, 0)
+            att_mask = step_mask
+            lm_input = self.speech_embedding(decoded[:, step:step + 1])
+        return out_tokens
@@ -2,12 +2,76 @@ from loguru import logger
 import torch
 import numpy as np
 import threading
-import time
 from torch.nn import functional as F
 from contextlib import nullcontext
-import uuid
+from typing import List
 from viettts.utils.common import fade_in_out_audio
 
+
+class TokenChannel:
+    """
+    Speech tokens handed over from the llm thread (producer) to the flow/hift consumer of one session.
+    The consumer wakes up as soon as enough tokens are available or the llm has ended, the producer
+    blocks while `maxsize` tokens are pending (0 means unbounded) and stops once the consumer is gone.
+    """
+    def __init__(self, maxsize: int=0, tokens: List[int]=None):
+        self.tokens = list(tokens) if tokens is not None else []
+        self.maxsize = maxsize
+        self.ended = False
+        self.cancelled = False
+        self.cond = threading.Condition()
+
+    def put(self, token: int) -> bool:
+        """Returns False when the consumer is gone and the producer should stop."""
+        with self.cond:
+            while self.maxsize > 0 and len(self.tokens) >= self.maxsize and not self.cancelled:
+                self.cond.wait()
+            if self.cancelled:
+                return False
+            self.tokens.append(token)
+            self.cond.notify_all()
+            return True
+
+    def end(self):
+        with self.cond:
+            self.ended = True
+            self.cond.notify_all()
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify_all()
+
+    def wait(self, size: int) -> bool:
+        """Block until `size` tokens are available (True) or the llm ended with fewer tokens (False)."""
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.tokens) >= size or self.ended)
+            return len(self.tokens) >= size
+
+    def peek(self, size: int) -> List[int]:
+        with self.cond:
+            return self.tokens[:size]
+
+    def consume(self, size: int):
+        with self.cond:
+            del self.tokens[:size]
+            self.cond.notify_all()
+
+    def drain(self) -> List[int]:
+        with self.cond:
+            tokens, self.tokens = self.tokens, []
+            self.cond.notify_all()
+            return tokens
+
+
+class TTSSession:
+    """Variables of one inference: its token channel and the caches kept between streamed chunks."""
+    def __init__(self, channel: TokenChannel=None):
+        self.channel = channel if channel is not None else TokenChannel()
+        self.mel_overlap = None
+        self.hift_cache = None
+
+
 class TTSModel:
     def __init__(
         self,
@@ -34,12 +98,8 @@ class TTSModel:
         self.stream_scale_factor = 1
         assert self.stream_scale_factor >= 1, 'stream_scale_factor should be greater than 1, change it according to your actual rtf'
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
-        self.lock = threading.Lock()
-        # dict used to store session related variable
-        self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
-        self.mel_overlap_dict = {}
-        self.hift_cache_dict = {}
+        # in stream mode the llm may run ahead of flow/hift by this many tokens before it waits
+        self.stream_token_buffer_len = 2 * (self.token_max_hop_len + self.token_overlap_len)
 
     def load(self, llm_model, flow_model, hift_model):
         self.llm.load_state_dict(torch.load(llm_model, map_location=self.device))
@@ -67,21 +127,24 @@ class TTSModel:
         del self.flow.decoder.estimator
         self.flow.decoder.estimator = onnxruntime.InferenceSession(flow_decoder_estimator_model, sess_options=option, providers=providers)
 
-    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid):
-        with self.llm_context:
-            for i in self.llm.inference(
-                text=text.to(self.device),
-                text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
-                prompt_text=prompt_text.to(self.device),
-                prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                embedding=llm_embedding.to(self.device).half()
-            ):
-                self.tts_speech_token_dict[uuid].append(i)
-        self.llm_end_dict[uuid] = True
+    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, channel: TokenChannel):
+        try:
+            with self.llm_context:
+                for i in self.llm.inference(
+                    text=text.to(self.device),
+                    text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
+                    prompt_text=prompt_text.to(self.device),
+                    prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                    prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                    prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                    embedding=llm_embedding.to(self.device).half()
+                ):
+                    if not channel.put(i):
+                        break
+        finally:
+            channel.end()
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0):
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, session: TTSSession, finalize=False, speed=1.0, n_timesteps=10, solver=None):
         tts_mel = self.flow.inference(
             token=token.to(self.device),
             token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
@@ -89,20 +152,22 @@ class TTSModel:
             prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
             prompt_feat=prompt_feat.to(self.device),
             prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-            embedding=embedding.to(self.device)
+            embedding=embedding.to(self.device),
+            n_timesteps=n_timesteps,
+            solver=solver
         )
 
-        if self.hift_cache_dict[uuid] is not None:
-            hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
+        if session.hift_cache is not None:
+            hift_cache_mel, hift_cache_source = session.hift_cache['mel'], session.hift_cache['source']
             tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
         else:
             hift_cache_source = torch.zeros(1, 1, 0)
 
         if finalize is False:
-            self.mel_overlap_dict[uuid] = tts_mel[:, :, -self.mel_overlap_len:]
+            session.mel_overlap = tts_mel[:, :, -self.mel_overlap_len:]
             tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
             tts_speech, tts_source = self.hift.inference(mel=tts_mel, cache_source=hift_cache_source)
-            self.hift_cache_dict[uuid] = {
+            session.hift_cache = {
                 'mel': tts_mel[:, :, -self.mel_cache_len:],
                 'source': tts_source[:, :, -self.source_cache_len:],
                 'speech': tts_speech[:, -self.source_cache_len:]
@@ -110,13 +175,34 @@ class TTSModel:
             tts_speech = tts_speech[:, :-self.source_cache_len]
         else:
             if speed != 1.0:
-                assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
+                assert session.hift_cache is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
             tts_speech, tts_source = self.hift.inference(mel=tts_mel, cache_source=hift_cache_source)
 
         tts_speech = fade_in_out_audio(tts_speech)
         return tts_speech
 
+    def stream_token2wav(self, session: TTSSession, flow_prompt_speech_token, prompt_speech_feat, flow_embedding, n_timesteps=10, solver=None):
+        """Synthesize a chunk each time a hop of tokens (plus overlap) is available in the session channel."""
+        channel = session.channel
+        token_hop_len = self.token_min_hop_len
+        while channel.wait(token_hop_len + self.token_overlap_len):
+            this_tts_speech_token = torch.tensor(channel.peek(token_hop_len + self.token_overlap_len)).unsqueeze(dim=0)
+            this_tts_speech = self.token2wav(
+                token=this_tts_speech_token,
+                prompt_token=flow_prompt_speech_token,
+                prompt_feat=prompt_speech_feat,
+                embedding=flow_embedding,
+                session=session,
+                n_timesteps=n_timesteps,
+                solver=solver,
+                finalize=False
+            )
+            yield {'tts_speech': this_tts_speech.cpu()}
+            channel.consume(token_hop_len)
+            # increase token_hop_len for better speech quality
+            token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
+
     def tts(
         self,
         text: str,
@@ -128,69 +214,78 @@ class TTSModel:
         prompt_speech_feat: torch.Tensor=torch.zeros(1, 0, 80),
         stream: bool=False,
         speed: float=1.0,
+        n_timesteps: int=10,
+        solver: str=None,
         **kwargs
     ):
-        # this_uuid is used to track variables related to this inference thread
-        this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.mel_overlap_dict[this_uuid], self.hift_cache_dict[this_uuid] = None, None
-        
-        p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
+        # the session holds all variables of this inference, the llm thread hands tokens over through its channel
+        session = TTSSession(TokenChannel(maxsize=self.stream_token_buffer_len if stream else 0))
+        p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, session.channel))
         p.start()
-        
-        if stream:
-            token_hop_len = self.token_min_hop_len
-            while True:
-                time.sleep(0.01)
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]).unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(
-                        token=this_tts_speech_token,
-                        prompt_token=flow_prompt_speech_token,
-                        prompt_feat=prompt_speech_feat,
-                        embedding=flow_embedding,
-                        uuid=this_uuid,
-                        finalize=False
-                    )
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
-                    break
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(
-                token=this_tts_speech_token,
-                prompt_token=flow_prompt_speech_token,
-                prompt_feat=prompt_speech_feat,
-                embedding=flow_embedding,
-                uuid=this_uuid,
-                finalize=True
+
+        try:
+            if stream:
+                yield from self.stream_token2wav(session, flow_prompt_speech_token, prompt_speech_feat, flow_embedding,
+                                                 n_timesteps=n_timesteps, solver=solver)
+                p.join()
+                this_tts_speech_token = torch.tensor(session.channel.drain()).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(
+                    token=this_tts_speech_token,
+                    prompt_token=flow_prompt_speech_token,
+                    prompt_feat=prompt_speech_feat,
+                    embedding=flow_embedding,
+                    session=session,
+                    n_timesteps=n_timesteps,
+                    solver=solver,
+                    finalize=True
+                )
+                yield {'tts_speech': this_tts_speech.cpu()}
+            else:
+                p.join()
+                this_tts_speech_token = torch.tensor(session.channel.drain()).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(
+                    token=this_tts_speech_token,
+                    prompt_token=flow_prompt_speech_token,
+                    prompt_feat=prompt_speech_feat,
+                    embedding=flow_embedding,
+                    session=session,
+                    n_timesteps=n_timesteps,
+                    solver=solver,
+                    finalize=True,
+                    speed=speed
+                )
+                yield {'tts_speech': this_tts_speech.cpu()}
+        finally:
+            # stop the llm thread if the consumer is closed early (e.g. client disconnected)
+            session.channel.cancel()
+
+    def tts_batch(self, model_inputs: List[dict], speed: float=1.0, n_timesteps: int=10, solver: str=None):
+        """
+        Non-stream tts for several sentences (possibly from different requests) at once.
+        The LLM decodes all rows together, then flow and hift run per row, outputs are yielded in input order.
+        """
+        with self.llm_context:
+            speech_tokens = self.llm.inference_batch(
+                text=[i['text'].to(self.device) for i in model_inputs],
+                prompt_text=[i.get('prompt_text', torch.zeros(1, 0, dtype=torch.int32)).to(self.device) for i in model_inputs],
+                prompt_speech_token=[i.get('llm_prompt_speech_token', torch.zeros(1, 0, dtype=torch.int32)).to(self.device) for i in model_inputs],
+                embedding=[i.get('llm_embedding', torch.zeros(0, 192)).to(self.device).half() for i in model_inputs]
             )
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+
+        for model_input, speech_token in zip(model_inputs, speech_tokens):
             this_tts_speech = self.token2wav(
-                token=this_tts_speech_token,
-                prompt_token=flow_prompt_speech_token,
-                prompt_feat=prompt_speech_feat,
-                embedding=flow_embedding,
-                uuid=this_uuid,
+                token=torch.tensor(speech_token, dtype=torch.int32).unsqueeze(dim=0),
+                prompt_token=model_input['flow_prompt_speech_token'],
+                prompt_feat=model_input['prompt_speech_feat'],
+                embedding=model_input['flow_embedding'],
+                session=TTSSession(),
+                n_timesteps=n_timesteps,
+                solver=solver,
                 finalize=True,
                 speed=speed
             )
             yield {'tts_speech': this_tts_speech.cpu()}
 
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
-
     def vc(
         self,
         source_speech_token: torch.Tensor,
@@ -199,62 +294,42 @@ class TTSModel:
         flow_embedding: torch.Tensor,
         stream: bool=False,
         speed: float=1.0,
+        n_timesteps: int=10,
+        solver: str=None,
         **kwargs
     ):
-        this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = source_speech_token.flatten().tolist(), True
-            self.mel_overlap_dict[this_uuid], self.hift_cache_dict[this_uuid] = None, None
+        # all tokens are known, the channel is ended from the start
+        session = TTSSession(TokenChannel(tokens=source_speech_token.flatten().tolist()))
+        session.channel.end()
 
         if stream:
-            token_hop_len = self.token_min_hop_len
-            while True:
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
-                        .unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(
-                        token=this_tts_speech_token,
-                        prompt_token=flow_prompt_speech_token,
-                        prompt_feat=prompt_speech_feat,
-                        embedding=flow_embedding,
-                        uuid=this_uuid,
-                        finalize=False
-                    )
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
-                    break
-
+            yield from self.stream_token2wav(session, flow_prompt_speech_token, prompt_speech_feat, flow_embedding,
+                                             n_timesteps=n_timesteps, solver=solver)
             # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid], dim=1).unsqueeze(dim=0)
+            this_tts_speech_token = torch.tensor(session.channel.drain()).unsqueeze(dim=0)
             this_tts_speech = self.token2wav(
                 token=this_tts_speech_token,
                 prompt_token=flow_prompt_speech_token,
                 prompt_feat=prompt_speech_feat,
                 embedding=flow_embedding,
-                uuid=this_uuid,
+                session=session,
+                n_timesteps=n_timesteps,
+                solver=solver,
                 finalize=True
             )
             yield {'tts_speech': this_tts_speech.cpu()}
         else:
             # deal with all tokens
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+            this_tts_speech_token = torch.tensor(session.channel.drain()).unsqueeze(dim=0)
             this_tts_speech = self.token2wav(
                 token=this_tts_speech_token,
                 prompt_token=flow_prompt_speech_token,
                 prompt_feat=prompt_speech_feat,
                 embedding=flow_embedding,
-                uuid=this_uuid,
+                session=session,
+                n_timesteps=n_timesteps,
+                solver=solver,
                 finalize=True,
                 speed=speed
             )
             yield {'tts_speech': this_tts_speech.cpu()}
-
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
@@ -1,9 +1,8 @@
 import io
 import os
-import queue
 import random
-import subprocess
 import threading
+import time
 import wave
 
 import tempfile
@@ -12,24 +11,35 @@ import requests
 import numpy as np
 from loguru import logger
 from datetime import datetime
-from typing import Any, List, Optional
+from collections import deque
+from typing import Any, Iterator, List, Optional
 from pydantic import BaseModel
 from anyio import CapacityLimiter
 from anyio.lowlevel import RunVar
 from fastapi import FastAPI, UploadFile, Form, File, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse, FileResponse
+from fastapi.responses import Response, StreamingResponse, JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from viettts.tts import TTS
+from viettts.flow.flow_matching import ODE_SOLVERS
 from viettts.utils.file_utils import load_prompt_speech_from_file, load_voices
+from viettts.utils.audio_encoder import get_encoder, get_media_type, encode_stream, encode_audio
+from viettts.utils.voice_store import load_voice_store
 
 
 VOICE_DIR = 'samples'
 VOICE_MAP = load_voices(VOICE_DIR)
+MODEL_DIR = './pretrained-models'
+VOICE_STORE_DIR = os.path.join(MODEL_DIR, 'voice-store')
 
 global tts_obj
 tts_obj = None
 
+global voice_store
+voice_store = {}
+
+SAMPLE_RATE = 22050
+
 
 app = FastAPI(
     title="VietTTS API",
@@ -62,6 +72,11 @@ class OpenAITTSRequest(BaseModel):
     voice: str = random.choice(list(VOICE_MAP))
     response_format: str = "wav"
     speed: float = 1.0
+    # flow matching ODE solver, fewer steps are faster at some quality cost
+    n_timesteps: int = 10
+    solver: str = "euler"
+    # stream audio chunk by chunk as soon as it is synthesized
+    stream: bool = False
 
 class TTSRequest(BaseModel):
     text: str
@@ -80,6 +95,69 @@ def wav_chunk_header(sample_rate=22050, bit_depth=16, channels=1):
     return wav_header_bytes
 
 
+class LatencyStats:
+    """Rolling window of latencies (seconds), e.g. time to first audio of streamed requests."""
+
+    def __init__(self, maxlen: int = 1000):
+        self.values = deque(maxlen=maxlen)
+        self.lock = threading.Lock()
+
+    def add(self, value: float):
+        with self.lock:
+            self.values.append(value)
+
+    def summary(self) -> dict:
+        with self.lock:
+            values = sorted(self.values)
+        if not values:
+            return {'count': 0}
+        return {
+            'count': len(values),
+            'avg': sum(values) / len(values),
+            'p50': values[len(values) // 2],
+            'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+            'max': values[-1]
+        }
+
+
+ttfa_stats = LatencyStats()
+
+
+def measure_ttfa(audio: Iterator[bytes], start: float) -> Iterator[bytes]:
+    """Record time to first audio: from request received to the first encoded audio bytes."""
+    first = True
+    for data in audio:
+        if first:
+            ttfa = time.perf_counter() - start
+            ttfa_stats.add(ttfa)
+            logger.info(f"Time to first audio: {ttfa * 1000:.0f} ms")
+            first = False
+        yield data
+
+
+def audio_chunks(model_output) -> Iterator[np.ndarray]:
+    for chunk in model_output:
+        yield chunk['tts_speech'].squeeze(0).numpy()
+
+
+def get_voice_name(voice: str) -> Optional[str]:
+    if voice.isdigit():
+        voice_names = list(VOICE_MAP)
+        return voice_names[int(voice)] if int(voice) < len(voice_names) else None
+    return voice if voice in VOICE_MAP else None
+
+
+def load_voice_prompt(voice_name: str):
+    """Return precomputed conditioning of a built-in voice, or fall back to decoding its audio file."""
+    if voice_name in voice_store:
+        return voice_store[voice_name]
+    return load_prompt_speech_from_file(
+        filepath=VOICE_MAP[voice_name],
+        min_duration=3,
+        max_duration=5
+    )
+
+
 @app.get("/", response_class=PlainTextResponse)
 async def root():
     return 'VietTTS API'
@@ -93,128 +171,49 @@ async def health():
 async def show_voices():
     return list(VOICE_MAP.keys()) 
 
+@app.get("/metrics/ttfa")
+@app.get("/v1/metrics/ttfa")
+async def show_ttfa():
+    return ttfa_stats.summary()
+
 @app.post("/audio/speech")
 @app.post("/v1/audio/speech")
 async def openai_api_tts(tts_request: OpenAITTSRequest):
+    start = time.perf_counter()
     logger.info(f"Received TTS request: {tts_request.dict()}")
     
-    if tts_request.voice.isdigit():
-        voice_file = list(VOICE_MAP.values())[int(tts_request.voice)]
-    else:
-        voice_file = VOICE_MAP.get(tts_request.voice)
-
-    if not voice_file:
+    voice_name = get_voice_name(tts_request.voice)
+    if not voice_name:
         logger.error(f"Voice {tts_request.voice} not found")
         return PlainTextResponse(content="Voice not found", status_code=404)
 
-    prompt_speech_16k = load_prompt_speech_from_file(
-        filepath=voice_file,
-        min_duration=3,
-        max_duration=5
-    )
-    # prompt_speech_16k = fade_in_out_audio(prompt_speech_16k)
-
-    def build_ffmpeg_args(response_format, input_format, sample_rate=24000):
-        if input_format == 'WAV':
-            ffmpeg_args = ["ffmpeg", "-loglevel", "error", "-f", "WAV", "-i", "-"]
-        else:
-            ffmpeg_args = ["ffmpeg", "-loglevel", "error", "-f", input_format, "-ar", sample_rate, "-ac", "1", "-i", "-"]
-        if response_format == "mp3":
-            ffmpeg_args.extend(["-f", "mp3", "-c:a", "libmp3lame", "-ab", "64k"])
-        elif response_format == "opus":
-            ffmpeg_args.extend(["-f", "ogg", "-c:a", "libopus"])
-        elif response_format == "aac":
-            ffmpeg_args.extend(["-f", "adts", "-c:a", "aac", "-ab", "64k"])
-        elif response_format == "flac":
-            ffmpeg_args.extend(["-f", "flac", "-c:a", "flac"])
-        elif response_format == "wav":
-            ffmpeg_args.extend(["-f", "wav", "-c:a", "pcm_s16le"])
-        elif response_format == "pcm": # even though pcm is technically 'raw', we still use ffmpeg to adjust the speed
-            ffmpeg_args.extend(["-f", "s16le", "-c:a", "pcm_s16le"])
-        return ffmpeg_args
-
-    def exception_check(exq: queue.Queue):
-        try:
-            e = exq.get_nowait()
-        except queue.Empty:
-            return
-        raise e
-
-    if tts_request.response_format == "mp3":
-        media_type = "audio/mpeg"
-    elif tts_request.response_format == "opus":
-        media_type = "audio/ogg;codec=opus" # codecs?
-    elif tts_request.response_format == "aac":
-        media_type = "audio/aac"
-    elif tts_request.response_format == "flac":
-        media_type = "audio/x-flac"
-    elif tts_request.response_format == "wav":
-        media_type = "audio/wav"
-    elif tts_request.response_format == "pcm":
-        media_type = "audio/pcm;rate=24000"
-    else:
-        raise ValueError(f"Invalid response_format: '{tts_request.response_format}'", param='response_format')
-
-    ffmpeg_args = None
-    ffmpeg_args = build_ffmpeg_args(tts_request.response_format, input_format="f32le", sample_rate="24000")
-    ffmpeg_args.extend(["-"])
-    ffmpeg_proc = subprocess.Popen(ffmpeg_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    if tts_request.solver not in ODE_SOLVERS or not 1 <= tts_request.n_timesteps <= 50:
+        logger.error(f"Invalid solver {tts_request.solver} / n_timesteps {tts_request.n_timesteps}")
+        return PlainTextResponse(content=f"Invalid solver or n_timesteps, solver must be one of {list(ODE_SOLVERS)} and 1 <= n_timesteps <= 50", status_code=400)
 
-    in_q = queue.Queue()
-    ex_q = queue.Queue()
-
-    def generator():
-        # text -> in_q
-        try:
-            model_output = tts_obj.inference_tts(
-                tts_text=tts_request.input,
-                prompt_speech_16k=prompt_speech_16k,
-                speed=tts_request.speed,
-                stream=False
-            )
-            for chunk in model_output:
-                exception_check(ex_q)
-                chunk = chunk['tts_speech'].numpy().tobytes()
-                in_q.put(chunk)
-        except BrokenPipeError as e:
-            logger.info("Client disconnected - 'Broken pipe'")
-        except Exception as e:
-            logger.error(f"Exception: {repr(e)}")
-            raise e
-        finally:
-            in_q.put(None) # sentinel
+    try:
+        # only streamed responses are encoded incrementally, others are sent as complete files
+        encoder = get_encoder(tts_request.response_format, SAMPLE_RATE, incremental=tts_request.stream)
+    except ValueError as e:
+        logger.error(str(e))
+        return PlainTextResponse(content=str(e), status_code=400)
 
-    def out_writer(): 
-        try:
-            while True:
-                chunk = in_q.get()
-                if chunk is None: # sentinel
-                    break
-                ffmpeg_proc.stdin.write(chunk) # BrokenPipeError from here on client disconnect
-        except Exception as e: # BrokenPipeError
-            ex_q.put(e)  # we need to get this exception into the generation loop
-            ffmpeg_proc.kill()
-            return
-        finally:
-            ffmpeg_proc.stdin.close()
-            
-    generator_worker = threading.Thread(target=generator, daemon=True)
-    generator_worker.start()
-    out_writer_worker = threading.Thread(target=out_writer, daemon=True)
-    out_writer_worker.start()
-
-    async def cleanup():
-        try:
-            ffmpeg_proc.kill()
-            # del generator_worker
-            # del out_writer_worker
-        except Exception as e:
-            logger.error(f"Exception: {repr(e)}")
+    prompt_speech_16k = load_voice_prompt(voice_name)
+    # prompt_speech_16k = fade_in_out_audio(prompt_speech_16k)
 
+    # in stream mode chunks are synthesized hop by hop and sent as soon as they are encoded,
+    # otherwise sentence by sentence and the file is sent once complete
+    model_output = tts_obj.inference_tts(
+        tts_text=tts_request.input,
+        prompt_speech_16k=prompt_speech_16k,
+        speed=1.0 if tts_request.stream else tts_request.speed,  # speed change is only supported in non-stream mode
+        stream=tts_request.stream,
+        n_timesteps=tts_request.n_timesteps,
+        solver=tts_request.solver
+    )
     return StreamingResponse(
-        content=ffmpeg_proc.stdout,
-        media_type=media_type,
-        background=cleanup
+        content=measure_ttfa(encode_stream(audio_chunks(model_output), encoder), start),
+        media_type=get_media_type(tts_request.response_format, SAMPLE_RATE)
     )
 
 @app.post("/tts")
@@ -228,109 +227,87 @@ async def tts(
 ):
     logger.info(f"Received TTS request: text={text}, voice={voice}, speed={speed}, audio_url={audio_url}")
     voice_file = None
+    voice_name = None
 
     # Case 1: Uploaded audio file
     if audio_file:
-        temp_audio_file = tempfile.NamedTemporaryFile(
-            delete=False,
-            suffix=f'.{audio_file.filename.split(".")[-1]}'
-        )
         try:
-            with open(temp_audio_file.name, "wb") as temp_file:
+            with tempfile.NamedTemporaryFile(
+                delete=False,
+                suffix=f'.{audio_file.filename.split(".")[-1]}'
+            ) as temp_file:
                 shutil.copyfileobj(audio_file.file, temp_file)
-            voice_file = temp_audio_file.name
+            voice_file = temp_file.name
             logger.info(f"Using uploaded audio file as voice: {voice_file}")
         finally:
             audio_file.file.close()
 
     # Case 2: Audio URL
     elif audio_url:
-        temp_audio_file = tempfile.NamedTemporaryFile(
-            delete=False,
-            suffix=f'.{audio_url.lower().split(".")[-1]}'
-        )
+        response = requests.get(audio_url, stream=True)
         try:
-            response = requests.get(audio_url, stream=True)
             if response.status_code != 200:
                 raise HTTPException(status_code=400, detail="Failed to fetch audio from URL")
-            with open(temp_audio_file.name, "wb") as temp_file:
+            with tempfile.NamedTemporaryFile(
+                delete=False,
+                suffix=f'.{audio_url.lower().split(".")[-1]}'
+            ) as temp_file:
                 shutil.copyfileobj(response.raw, temp_file)
-            voice_file = temp_audio_file.name
+            voice_file = temp_file.name
             logger.info(f"Using audio URL as voice: {voice_file}")
         finally:
             response.close()
 
     # Case 3: Predefined voice
     elif voice:
-        if voice.isdigit():
-            voice_file = list(VOICE_MAP.values())[int(voice)]
-        else:
-            voice_file = VOICE_MAP.get(voice)
-
-        if not voice_file:
+        voice_name = get_voice_name(voice)
+        if not voice_name:
             logger.error(f"Voice {voice} not found")
             raise HTTPException(status_code=404, detail="Voice not found")
+        voice_file = VOICE_MAP[voice_name]
     
     else:
-        voice_file = random.choice(list(VOICE_MAP.values()))
+        voice_name = random.choice(list(VOICE_MAP))
+        voice_file = VOICE_MAP[voice_name]
 
     # Error if no voice file is available
     if not voice_file or not os.path.exists(voice_file):
         raise HTTPException(status_code=400, detail="No valid voice file provided")
 
-    prompt_speech_16k = load_prompt_speech_from_file(
-        filepath=voice_file,
-        min_duration=3,
-        max_duration=5
-    )
-
-    temp_output_file = tempfile.NamedTemporaryFile(
-        delete=False, 
-        suffix=f"_{datetime.now().strftime('%Y%m%d_%H%M%S')}.mp3"
-    )
-
     try:
+        if voice_name:
+            prompt_speech_16k = load_voice_prompt(voice_name)
+        else:
+            prompt_speech_16k = load_prompt_speech_from_file(
+                filepath=voice_file,
+                min_duration=3,
+                max_duration=5
+            )
+
         model_output = tts_obj.inference_tts(
             tts_text=text,
             prompt_speech_16k=prompt_speech_16k,
             speed=speed,
             stream=False
         )
-
-        raw_audio = b''.join(chunk['tts_speech'].numpy().tobytes() for chunk in model_output)
-        ffmpeg_args = [
-            "ffmpeg", "-loglevel", "error", "-y", "-f", "f32le", "-ar", "24000", "-ac", "1",
-            "-i", "-", "-f", "mp3", "-c:a", "libmp3lame", "-ab", "64k", temp_output_file.name
-        ]
-        ffmpeg_proc = subprocess.run(
-            ffmpeg_args,
-            input=raw_audio,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-
-        if ffmpeg_proc.returncode != 0:
-            logger.error(f"FFmpeg error: {ffmpeg_proc.stderr.decode()}")
-            raise HTTPException(status_code=500, detail="Error during audio processing")
-
-        if not os.path.exists(temp_output_file.name):
-            logger.error(f"FFmpeg did not create the output file: {temp_output_file.name}")
-            raise HTTPException(status_code=500, detail="FFmpeg failed to produce the output file")
-
-        return FileResponse(
-            path=temp_output_file.name,
+        # encoded in memory at the model sample rate, no output file is written
+        audio = encode_audio(audio_chunks(model_output), 'mp3', SAMPLE_RATE)
+        filename = f"tts_{datetime.now().strftime('%Y%m%d_%H%M%S')}.mp3"
+        return Response(
+            content=audio,
             media_type="audio/mpeg",
-            filename=temp_output_file.name.split("/")[-1]
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'}
         )
 
     finally:
         if audio_file or audio_url:
-            if os.path.exists(temp_audio_file.name):
-                os.unlink(temp_audio_file.name)
+            if os.path.exists(voice_file):
+                os.unlink(voice_file)
 
 
 @app.on_event("startup")
 async def startup():
-    global tts_obj
+    global tts_obj, voice_store
     RunVar("_default_thread_limiter").set(CapacityLimiter(os.cpu_count()))
-    tts_obj = TTS('./pretrained-models')
\ No newline at end of file
+    tts_obj = TTS(MODEL_DIR)
+    voice_store = load_voice_store(VOICE_STORE_DIR, VOICE_MAP, device=tts_obj.frontend.device)
\ No newline at end of file
@@ -1,12 +1,60 @@
 """Multi-Head Attention layer definition."""
 
 import math
-from typing import Tuple
+from typing import Optional, Tuple
 
 import torch
 from torch import nn
 
 
+class KVCache:
+    """Preallocated KEY & VALUE buffer of all layers for autoregressive decoding.
+
+    Each step writes its keys/values in place at `length` instead of
+    concatenating them onto the history, so decoding does not reallocate
+    the cache at every token.
+
+    Args:
+        num_layers (int): The number of attention layers.
+        batch_size (int): The number of sequences decoded together.
+        n_head (int): The number of heads.
+        d_k (int): The dimension of each head.
+        capacity (int): The maximum number of cached positions.
+
+    """
+
+    def __init__(self,
+                 num_layers: int,
+                 batch_size: int,
+                 n_head: int,
+                 d_k: int,
+                 capacity: int,
+                 device: torch.device = torch.device('cpu'),
+                 dtype: torch.dtype = torch.float32):
+        shape = (num_layers, batch_size, n_head, capacity, d_k)
+        self.key = torch.zeros(shape, device=device, dtype=dtype)
+        self.value = torch.zeros(shape, device=device, dtype=dtype)
+        self.capacity = capacity
+        self.length = 0
+
+    def update(self, layer: int, k: torch.Tensor,
+               v: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Write k, v (#batch, head, time, d_k) of `layer` at the current
+        length and return views of the whole history
+        (#batch, head, length + time, d_k).
+        """
+        end = self.length + k.size(2)
+        if end > self.capacity:
+            raise ValueError(f'KVCache overflow: {end} > capacity {self.capacity}')
+        self.key[layer, :, :, self.length:end] = k
+        self.value[layer, :, :, self.length:end] = v
+        return self.key[layer, :, :, :end], self.value[layer, :, :, :end]
+
+    def advance(self, size: int):
+        """Move the write position after all layers consumed a chunk."""
+        self.length += size
+
+
 class MultiHeadedAttention(nn.Module):
     """Multi-Head Attention layer.
 
@@ -117,7 +165,9 @@ class MultiHeadedAttention(nn.Module):
         value: torch.Tensor,
         mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         pos_emb: torch.Tensor = torch.empty(0),
-        cache: torch.Tensor = torch.zeros((0, 0, 0, 0))
+        cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
+        kv_cache: Optional[KVCache] = None,
+        layer_idx: int = 0
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Compute scaled dot product attention.
 
@@ -139,6 +189,9 @@ class MultiHeadedAttention(nn.Module):
             cache (torch.Tensor): Cache tensor (1, head, cache_t, d_k * 2),
                 where `cache_t == chunk_size * num_decoding_left_chunks`
                 and `head * d_k == size`
+            kv_cache (KVCache): Preallocated decoding buffer, when given it
+                is updated in place for `layer_idx` and `cache` is ignored.
+            layer_idx (int): Index of this layer in `kv_cache`.
 
 
         Returns:
@@ -166,15 +219,20 @@ class MultiHeadedAttention(nn.Module):
         # >>> torch.equal(b, c)        # True
         # >>> d = torch.split(a, 2, dim=-1)
         # >>> torch.equal(d[0], d[1])  # True
-        if cache.size(0) > 0:
-            key_cache, value_cache = torch.split(cache,
-                                                 cache.size(-1) // 2,
-                                                 dim=-1)
-            k = torch.cat([key_cache, k], dim=2)
-            v = torch.cat([value_cache, v], dim=2)
-        # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
-        #   non-trivial to calculate `next_cache_start` here.
-        new_cache = torch.cat((k, v), dim=-1)
+        if kv_cache is not None:
+            # The history lives in the preallocated buffer, nothing to return
+            k, v = kv_cache.update(layer_idx, k, v)
+            new_cache = torch.zeros((0, 0, 0, 0), dtype=k.dtype, device=k.device)
+        else:
+            if cache.size(0) > 0:
+                key_cache, value_cache = torch.split(cache,
+                                                     cache.size(-1) // 2,
+                                                     dim=-1)
+                k = torch.cat([key_cache, k], dim=2)
+                v = torch.cat([value_cache, v], dim=2)
+            # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since
+            #   it's non-trivial to calculate `next_cache_start` here.
+            new_cache = torch.cat((k, v), dim=-1)
 
         scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
         return self.forward_attention(v, scores, mask), new_cache
@@ -236,7 +294,9 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         value: torch.Tensor,
         mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         pos_emb: torch.Tensor = torch.empty(0),
-        cache: torch.Tensor = torch.zeros((0, 0, 0, 0))
+        cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
+        kv_cache: Optional[KVCache] = None,
+        layer_idx: int = 0
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Compute 'Scaled Dot Product Attention' with rel. positional encoding.
         Args:
@@ -250,6 +310,9 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
             cache (torch.Tensor): Cache tensor (1, head, cache_t, d_k * 2),
                 where `cache_t == chunk_size * num_decoding_left_chunks`
                 and `head * d_k == size`
+            kv_cache (KVCache): Preallocated decoding buffer, when given it
+                is updated in place for `layer_idx` and `cache` is ignored.
+            layer_idx (int): Index of this layer in `kv_cache`.
         Returns:
             torch.Tensor: Output tensor (#batch, time1, d_model).
             torch.Tensor: Cache tensor (1, head, cache_t + time1, d_k * 2)
@@ -275,15 +338,20 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         # >>> torch.equal(b, c)        # True
         # >>> d = torch.split(a, 2, dim=-1)
         # >>> torch.equal(d[0], d[1])  # True
-        if cache.size(0) > 0:
-            key_cache, value_cache = torch.split(cache,
-                                                 cache.size(-1) // 2,
-                                                 dim=-1)
-            k = torch.cat([key_cache, k], dim=2)
-            v = torch.cat([value_cache, v], dim=2)
-        # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
-        #   non-trivial to calculate `next_cache_start` here.
-        new_cache = torch.cat((k, v), dim=-1)
+        if kv_cache is not None:
+            # The history lives in the preallocated buffer, nothing to return
+            k, v = kv_cache.update(layer_idx, k, v)
+            new_cache = torch.zeros((0, 0, 0, 0), dtype=k.dtype, device=k.device)
+        else:
+            if cache.size(0) > 0:
+                key_cache, value_cache = torch.split(cache,
+                                                     cache.size(-1) // 2,
+                                                     dim=-1)
+                k = torch.cat([key_cache, k], dim=2)
+                v = torch.cat([value_cache, v], dim=2)
+            # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since
+            #   it's non-trivial to calculate `next_cache_start` here.
+            new_cache = torch.cat((k, v), dim=-1)
 
         n_batch_pos = pos_emb.size(0)
         p = self.linear_pos(pos_emb).view(n_batch_pos, -1, self.h, self.d_k)
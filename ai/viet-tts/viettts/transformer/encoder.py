@@ -5,6 +5,7 @@ from typing import Tuple
 import torch
 import torch.utils.checkpoint as ckpt
 
+from viettts.transformer.attention import KVCache
 from viettts.transformer.convolution import ConvolutionModule
 from viettts.transformer.encoder_layer import TransformerEncoderLayer
 from viettts.transformer.encoder_layer import ConformerEncoderLayer
@@ -256,6 +257,55 @@ class BaseEncoder(torch.nn.Module):
 
         return (xs, r_att_cache, r_cnn_cache)
 
+    @torch.jit.unused
+    def forward_chunk_kv(
+        self,
+        xs: torch.Tensor,
+        kv_cache: KVCache,
+        att_mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+    ) -> torch.Tensor:
+        """ Forward one chunk in autoregressive decoding mode
+
+        Same as `forward_chunk` with full history cache, but the KEY & VALUE
+        of every layer are written in place into the preallocated `kv_cache`,
+        so the cost of a step does not include copying the whole history.
+        Several sequences (b >= 1) can be decoded together; sequences of
+        different length must be left-padded, so that every row appends its
+        chunk at the same position, and padded positions are excluded through
+        `att_mask`. Conformer cnn cache is not supported.
+
+        Args:
+            xs (torch.Tensor): chunk input, with shape (b, time, mel-dim)
+            kv_cache (KVCache): decoding buffer, `kv_cache.length` is the
+                current offset and is advanced by `time`.
+            att_mask (torch.Tensor): attention mask with shape
+                (b, time, cache_t1 + time) or (b, 1, T) with T >= cache_t1 +
+                time (extra positions are ignored), (0, 0, 0) means fake mask,
+                e.g. for single token steps without padding.
+
+        Returns:
+            torch.Tensor: output of current input xs,
+                with shape (b, time, hidden-dim).
+        """
+        offset = kv_cache.length
+        tmp_masks = torch.ones(xs.size(0),
+                               1,
+                               xs.size(1),
+                               device=xs.device,
+                               dtype=torch.bool)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, pos_emb, _ = self.embed(xs, tmp_masks, offset)
+        pos_emb = self.embed.position_encoding(offset=0,
+                                               size=offset + xs.size(1))
+        for i, layer in enumerate(self.encoders):
+            xs, _, _, _ = layer(xs, att_mask, pos_emb,
+                                kv_cache=kv_cache, layer_idx=i)
+        kv_cache.advance(xs.size(1))
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs
+
     @torch.jit.unused
     def forward_chunk_by_chunk(
         self,
@@ -14,7 +14,8 @@ class TTS:
         self,
         model_dir,
         load_jit=False,
-        load_onnx=False
+        load_onnx=False,
+        max_batch_size=8
     ):
         if not os.path.exists(model_dir):
             logger.info(f'Downloading model from huggingface [dangvansam/viet-tts]')
@@ -48,20 +49,36 @@ class TTS:
 
         logger.success('Loaded model from {}'.format(model_dir))
         self.model_dir = model_dir
+        self.max_batch_size = max_batch_size
 
     def list_avaliable_spks(self):
         spks = list(self.frontend.spk2info.keys())
         return spks
 
-    def inference_tts(self, tts_text, prompt_speech_16k, stream=False, speed=1.0):
-        for i in tqdm(self.frontend.preprocess_text(tts_text, split=True)):
-            model_input = self.frontend.frontend_tts(i, prompt_speech_16k)
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+    def inference_tts(self, tts_text, prompt_speech_16k, stream=False, speed=1.0, n_timesteps=10, solver=None):
+        """
+        n_timesteps / solver select the flow matching ODE solver (see viettts.flow.flow_matching.ODE_SOLVERS),
+        fewer steps trade some quality for a faster flow decoding.
+        """
+        # prompt features are extracted once per request and shared by every sentence
+        prompt_input = self.frontend.frontend_prompt(prompt_speech_16k)
+        texts = self.frontend.preprocess_text(tts_text, split=True)
+        if stream or self.max_batch_size <= 1:
+            for i in tqdm(texts):
+                model_input = self.frontend.frontend_tts(i, prompt_input)
+                for model_output in self.model.tts(**model_input, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver):
+                    yield model_output
+            return
+
+        # non-stream: decode up to max_batch_size sentences together
+        for start in tqdm(range(0, len(texts), self.max_batch_size)):
+            model_inputs = [self.frontend.frontend_tts(i, prompt_input) for i in texts[start:start + self.max_batch_size]]
+            for model_output in self.model.tts_batch(model_inputs, speed=speed, n_timesteps=n_timesteps, solver=solver):
                 yield model_output
 
-    def inference_vc(self, source_speech_16k, prompt_speech_16k, stream=False, speed=1.0):
+    def inference_vc(self, source_speech_16k, prompt_speech_16k, stream=False, speed=1.0, n_timesteps=10, solver=None):
         model_input = self.frontend.frontend_vc(source_speech_16k, prompt_speech_16k)
-        for model_output in self.model.vc(**model_input, stream=stream, speed=speed):
+        for model_output in self.model.vc(**model_input, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver):
             yield model_output
 
     def tts_to_wav(self, text, prompt_speech_16k, speed=1.0):
@@ -0,0 +1,250 @@
+"""
+In-process audio encoders used by the API server.
+
+Encoders work chunk by chunk: `encode` takes float32 mono samples in [-1, 1] and returns the
+bytes produced so far, `close` returns the remaining ones. Nothing is written to disk and no
+process is spawned. pcm / wav / flac / mp3 are encoded with soundfile (libsndfile), opus and
+aac need PyAV (`pip install av`), which is also used for streamed mp3 and for mp3 when libsndfile
+has no mp3 support.
+"""
+import io
+import wave
+import struct
+from abc import ABC, abstractmethod
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+import soundfile
+
+
+# response_format -> media type
+MEDIA_TYPES = {
+    'pcm': 'audio/pcm;rate={sample_rate}',
+    'wav': 'audio/wav',
+    'flac': 'audio/x-flac',
+    'mp3': 'audio/mpeg',
+    'opus': 'audio/ogg;codec=opus',
+    'aac': 'audio/aac',
+}
+
+
+class StreamSink(io.RawIOBase):
+    """
+    Writable, seekable file object whose content can be taken out while it is still being written.
+    Writes back into bytes that were already taken out (header updates done by muxers on close)
+    cannot be applied to a stream and are dropped, so only encoders that do not rely on them are
+    used incrementally (see get_encoder).
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0  # number of bytes already taken out
+        self.pos = 0
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        size = len(data)
+        start = self.pos - self.offset
+        if start < 0:
+            data = data[-start:]
+            start = 0
+        end = start + len(data)
+        if end > len(self.buffer):
+            self.buffer.extend(b'\0' * (end - len(self.buffer)))
+        self.buffer[start:end] = data
+        self.pos += size
+        return size
+
+    def read(self, size=-1) -> bytes:
+        return b''
+
+    def seek(self, offset, whence=io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.offset + len(self.buffer)
+        self.pos = offset
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+    def pop(self) -> bytes:
+        data = bytes(self.buffer)
+        self.offset += len(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+class AudioEncoder(ABC):
+    def __init__(self, sample_rate: int, incremental: bool = True):
+        # when not incremental, container formats keep their output until close, so that
+        # header fields known only at the end (length, seek table...) are filled in
+        self.sample_rate = sample_rate
+        self.incremental = incremental
+
+    @abstractmethod
+    def encode(self, samples: np.ndarray) -> bytes:
+        """Encode a chunk of float32 mono samples, return the bytes available so far."""
+
+    def close(self) -> bytes:
+        return b''
+
+
+class PCMEncoder(AudioEncoder):
+    """Raw 16-bit little endian PCM."""
+
+    def encode(self, samples: np.ndarray) -> bytes:
+        return to_int16(samples).tobytes()
+
+
+class WavEncoder(PCMEncoder):
+    """16-bit PCM wav, the header is sent with the first chunk with the unknown (0xFFFFFFFF) streaming data length."""
+
+    def __init__(self, sample_rate: int):
+        super().__init__(sample_rate, incremental=True)
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(sample_rate)
+        header = buffer.getvalue()
+        unknown = struct.pack('<I', 0xFFFFFFFF)
+        self.header = header[:4] + unknown + header[8:40] + unknown
+
+    def encode(self, samples: np.ndarray) -> bytes:
+        header, self.header = self.header, b''
+        return header + super().encode(samples)
+
+    def close(self) -> bytes:
+        header, self.header = self.header, b''
+        return header
+
+
+class SoundFileEncoder(AudioEncoder):
+    def __init__(self, sample_rate: int, format: str, subtype: Optional[str] = None, incremental: bool = True):
+        super().__init__(sample_rate, incremental)
+        self.sink = StreamSink()
+        self.file = soundfile.SoundFile(self.sink, mode='w', samplerate=sample_rate, channels=1,
+                                        format=format, subtype=subtype)
+
+    def encode(self, samples: np.ndarray) -> bytes:
+        self.file.write(np.asarray(samples, dtype=np.float32))
+        return self.sink.pop() if self.incremental else b''
+
+    def close(self) -> bytes:
+        self.file.close()
+        return self.sink.pop()
+
+
+class PyAVEncoder(AudioEncoder):
+    def __init__(self, sample_rate: int, container_format: str, codec: str,
+                 codec_rate: Optional[int] = None, bit_rate: Optional[int] = None, incremental: bool = True,
+                 options: Optional[dict] = None):
+        import av
+        super().__init__(sample_rate, incremental)
+        self.av = av
+        self.sink = StreamSink()
+        self.container = av.open(self.sink, mode='w', format=container_format, options=options or {})
+        # the codec context resamples (statefully, across chunks) to its own rate and sample format
+        self.stream = self.container.add_stream(codec, rate=codec_rate or sample_rate, layout='mono')
+        if bit_rate:
+            self.stream.bit_rate = bit_rate
+        self.samples = 0
+
+    def mux(self, frame) -> bytes:
+        for packet in self.stream.encode(frame):
+            self.container.mux(packet)
+        return self.sink.pop() if self.incremental else b''
+
+    def encode(self, samples: np.ndarray) -> bytes:
+        samples = np.ascontiguousarray(samples, dtype=np.float32).reshape(1, -1)
+        frame = self.av.AudioFrame.from_ndarray(samples, format='flt', layout='mono')
+        frame.sample_rate = self.sample_rate
+        frame.pts = self.samples
+        self.samples += samples.shape[1]
+        return self.mux(frame)
+
+    def close(self) -> bytes:
+        data = self.mux(None)
+        self.container.close()
+        return data + self.sink.pop()
+
+
+def to_int16(samples: np.ndarray) -> np.ndarray:
+    return (np.clip(samples, -1.0, 1.0) * (2 ** 15 - 1)).astype(np.int16)
+
+
+def has_pyav() -> bool:
+    try:
+        import av  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def get_encoder(response_format: str, sample_rate: int, incremental: bool = True) -> AudioEncoder:
+    """
+    Create a new encoder, raise ValueError if the format is unknown or not supported by the installed libraries.
+    Incremental encoders return bytes at every chunk, for streaming responses: formats whose header is only
+    complete at close (flac) cannot be streamed, mp3 is streamed with PyAV without the Xing (length) header.
+    """
+    if response_format == 'pcm':
+        return PCMEncoder(sample_rate)
+    if response_format == 'wav':
+        if incremental:
+            return WavEncoder(sample_rate)
+        return SoundFileEncoder(sample_rate, format='WAV', subtype='PCM_16', incremental=False)
+    if response_format == 'flac':
+        if incremental:
+            raise ValueError("flac cannot be streamed, use stream=false or another response_format")
+        return SoundFileEncoder(sample_rate, format='FLAC', subtype='PCM_16', incremental=False)
+    if response_format == 'mp3':
+        if incremental:
+            if has_pyav():
+                return PyAVEncoder(sample_rate, container_format='mp3', codec='libmp3lame', bit_rate=64000,
+                                   incremental=True, options={'write_xing': '0'})
+            raise ValueError("streaming mp3 needs PyAV (pip install av)")
+        if 'MP3' in soundfile.available_formats():
+            return SoundFileEncoder(sample_rate, format='MP3', subtype='MPEG_LAYER_III', incremental=False)
+        if has_pyav():
+            return PyAVEncoder(sample_rate, container_format='mp3', codec='libmp3lame', bit_rate=64000, incremental=False)
+        raise ValueError("mp3 needs libsndfile >= 1.1 or PyAV")
+    if response_format == 'opus':
+        if has_pyav():
+            return PyAVEncoder(sample_rate, container_format='ogg', codec='libopus', codec_rate=48000, incremental=incremental)
+        raise ValueError("opus needs PyAV (pip install av)")
+    if response_format == 'aac':
+        if has_pyav():
+            return PyAVEncoder(sample_rate, container_format='adts', codec='aac', bit_rate=64000, incremental=incremental)
+        raise ValueError("aac needs PyAV (pip install av)")
+    raise ValueError(f"Invalid response_format: '{response_format}', available: {list(MEDIA_TYPES)}")
+
+
+def get_media_type(response_format: str, sample_rate: int) -> str:
+    return MEDIA_TYPES[response_format].format(sample_rate=sample_rate)
+
+
+def encode_stream(chunks: Iterable[np.ndarray], encoder: AudioEncoder) -> Iterator[bytes]:
+    """Encode audio chunks while they are produced, yield encoded bytes as soon as they are available."""
+    for chunk in chunks:
+        data = encoder.encode(chunk)
+        if data:
+            yield data
+    data = encoder.close()
+    if data:
+        yield data
+
+
+def encode_audio(chunks: Iterable[np.ndarray], response_format: str, sample_rate: int) -> bytes:
+    """Encode a whole audio into a complete file in memory."""
+    return b''.join(encode_stream(chunks, get_encoder(response_format, sample_rate, incremental=False)))
@@ -93,33 +93,37 @@ def init_weights(m, mean=0.0, std=0.01):
 
 # Repetition Aware Sampling in VALL-E 2
 def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
+    """
+    weighted_scores: (vocab,) or (batch, vocab) scores of the next token
+    decoded_tokens: tokens decoded so far, a list or a (len,) / (batch, len) tensor,
+        only the last `win_size` ones are used
+    Returns top_ids with shape (1,) or (batch, 1)
+    """
     top_ids = nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
-    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
-    if rep_num >= win_size * tau_r:
-        top_ids = random_sampling(weighted_scores, decoded_tokens, sampling)
-    return top_ids
+    if not isinstance(decoded_tokens, torch.Tensor):
+        decoded_tokens = torch.tensor(decoded_tokens[-win_size:], dtype=torch.long, device=weighted_scores.device)
+    rep_num = (decoded_tokens[..., -win_size:] == top_ids).sum(dim=-1, keepdim=True)
+    # rows repeating themselves too much fall back to random sampling, computed for all rows to avoid a sync
+    return torch.where(rep_num >= win_size * tau_r, random_sampling(weighted_scores, decoded_tokens, sampling), top_ids)
 
 
 def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
-    prob, indices = [], []
-    cum_prob = 0.0
-    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
-    for i in range(len(sorted_idx)):
-        # sampling both top-p and numbers.
-        if (cum_prob < top_p or len(prob) <=1) and len(prob) <top_k:     
-            cum_prob += sorted_value[i]
-            prob.append(sorted_value[i])
-            indices.append(sorted_idx[i])
-        else:
-            break
-    prob = torch.tensor(prob).to(weighted_scores)
-    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
-    top_ids = indices[prob.multinomial(1, replacement=True)]
-    return top_ids
+    """
+    Sample among the smallest set of top_k most likely tokens whose probability reaches top_p,
+    the two most likely tokens are always kept.
+    weighted_scores: (vocab,) or (batch, vocab), returns (1,) or (batch, 1)
+    """
+    prob = weighted_scores.softmax(dim=-1, dtype=torch.float32)
+    sorted_prob, sorted_idx = prob.topk(min(top_k, prob.size(-1)), dim=-1)
+    # a token is kept when the probability before it is still below top_p
+    keep = (sorted_prob.cumsum(dim=-1) - sorted_prob) < top_p
+    keep[..., :2] = True
+    sorted_prob = sorted_prob.masked_fill(~keep, 0.0)
+    return sorted_idx.gather(-1, sorted_prob.multinomial(1, replacement=True))
 
 
 def random_sampling(weighted_scores, decoded_tokens, sampling):
-    top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True)
+    top_ids = weighted_scores.softmax(dim=-1, dtype=torch.float32).multinomial(1, replacement=True)
     return top_ids
 
 
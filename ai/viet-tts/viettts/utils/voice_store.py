@@ -0,0 +1,106 @@
+import os
+import json
+import torch
+import numpy as np
+from typing import Dict
+from loguru import logger
+
+from viettts.utils.file_utils import load_prompt_speech_from_file
+
+
+STORE_VERSION = 1
+
+# tensor name in prompt conditioning dict -> .npy file name in voice directory
+STORE_TENSORS = {
+    'prompt_speech_16k': 'prompt_speech_16k.npy',
+    'flow_prompt_speech_token': 'speech_token.npy',
+    'prompt_speech_feat': 'speech_feat.npy',
+    'flow_embedding': 'embedding.npy',
+}
+
+
+def _source_signature(filepath: str) -> dict:
+    stat = os.stat(filepath)
+    return {'source': os.path.abspath(filepath), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def build_voice_store(frontend, voice_map: Dict[str, str], store_dir: str, min_duration: float=3, max_duration: float=5):
+    """
+    Precompute the speaker conditioning of every voice in `voice_map` and save it to `store_dir`.
+
+    Each voice gets its own directory with one .npy file per tensor (VAD-trimmed 16k prompt,
+    speech tokens, 22.05k mel features, speaker embedding) and a meta.json describing the source file.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    for voice_name, voice_file in voice_map.items():
+        prompt_speech_16k = load_prompt_speech_from_file(
+            filepath=voice_file,
+            min_duration=min_duration,
+            max_duration=max_duration
+        )
+        prompt_input = frontend.frontend_prompt(prompt_speech_16k)
+        prompt_input = {'prompt_speech_16k': prompt_speech_16k, **prompt_input}
+
+        voice_dir = os.path.join(store_dir, voice_name)
+        os.makedirs(voice_dir, exist_ok=True)
+        for key, filename in STORE_TENSORS.items():
+            np.save(os.path.join(voice_dir, filename), prompt_input[key].detach().cpu().numpy())
+
+        meta = {
+            'version': STORE_VERSION,
+            'min_duration': min_duration,
+            'max_duration': max_duration,
+            **_source_signature(voice_file)
+        }
+        with open(os.path.join(voice_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        logger.info(f'Saved voice [{voice_name}] to {voice_dir}')
+
+
+def load_voice(voice_dir: str, device: torch.device=torch.device('cpu')) -> dict:
+    """
+    Load one voice from the store. Arrays are memory-mapped (copy-on-write), so only the pages
+    actually used by inference are read from disk.
+    """
+    tensors = {
+        key: torch.from_numpy(np.load(os.path.join(voice_dir, filename), mmap_mode='c')).to(device)
+        for key, filename in STORE_TENSORS.items()
+    }
+    speech_token, speech_feat = tensors['flow_prompt_speech_token'], tensors['prompt_speech_feat']
+    return {
+        'prompt_speech_16k': tensors['prompt_speech_16k'],
+        'flow_prompt_speech_token': speech_token,
+        'flow_prompt_speech_token_len': torch.tensor([speech_token.shape[1]], dtype=torch.int32).to(device),
+        'prompt_speech_feat': speech_feat,
+        'prompt_speech_feat_len': torch.tensor([speech_feat.shape[1]], dtype=torch.int32).to(device),
+        'llm_embedding': tensors['flow_embedding'],
+        'flow_embedding': tensors['flow_embedding']
+    }
+
+
+def load_voice_store(store_dir: str, voice_map: Dict[str, str], device: torch.device=torch.device('cpu')) -> Dict[str, dict]:
+    """
+    Load the precomputed conditioning of the voices in `voice_map`.
+    Voices that are missing from the store, or whose source file changed since the store was built, are skipped.
+    """
+    voices = {}
+    if not os.path.isdir(store_dir):
+        logger.warning(f'Voice store not found: {store_dir}, run `viettts build-voices` to create it')
+        return voices
+
+    for voice_name, voice_file in voice_map.items():
+        voice_dir = os.path.join(store_dir, voice_name)
+        meta_file = os.path.join(voice_dir, 'meta.json')
+        if not os.path.exists(meta_file):
+            continue
+        with open(meta_file, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        signature = _source_signature(voice_file)
+        if meta.get('version') != STORE_VERSION or meta.get('size') != signature['size'] or meta.get('mtime') != signature['mtime']:
+            logger.warning(f'Voice [{voice_name}] in store is outdated, skipped')
+            continue
+        voices[voice_name] = load_voice(voice_dir, device)
+
+    logger.info(f'Loaded {len(voices)}/{len(voice_map)} voices from store {store_dir}')
+    return voices
+
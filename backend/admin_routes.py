@@ -1,5 +1,5 @@
 from flask import Blueprint, jsonify, request
-from database import db, User, SystemLog
+from database import db, User, SystemLog, count_history
 from datetime import datetime
 import json
 import psutil
@@ -21,53 +21,13 @@ def get_admin_stats():
         thirty_days_ago = datetime.utcnow().timestamp() - (30 * 24 * 60 * 60)
         new_users = User.query.filter(User.created_at >= datetime.fromtimestamp(thirty_days_ago)).count()
         
-        # Thống kê chuyển đổi giọng nói từ file lịch sử
+        # Thống kê chuyển đổi giọng nói từ lịch sử và thư mục models
         try:
-            # Đường dẫn tới các file lịch sử JSON
-            rvc_conversion_history_path = os.path.join(os.path.dirname(__file__), 'results', 'rvc', 'voice_conversion', 'conversion_history.json')
-            openvoice_conversion_history_path = os.path.join(os.path.dirname(__file__), 'results', 'openvoice', 'voice_conversion', 'conversion_history.json')
-            tts_history_path = os.path.join(os.path.dirname(__file__), 'results', 'openvoice', 'tts', 'tts_history.json')
-            uvr_history_path = os.path.join(os.path.dirname(__file__), 'results', 'rvc', 'uvr', 'uvr_history.json')
-            
-            # Đếm số lượng chuyển đổi RVC
-            rvc_conversions = 0
-            if os.path.exists(rvc_conversion_history_path):
-                try:
-                    with open(rvc_conversion_history_path, 'r', encoding='utf-8') as f:
-                        rvc_history = json.load(f)
-                        rvc_conversions = len(rvc_history)
-                except Exception as e:
-                    logging.error(f"Lỗi khi đọc lịch sử RVC: {str(e)}")
-            
-            # Đếm số lượng chuyển đổi OpenVoice
-            openvoice_conversions = 0
-            if os.path.exists(openvoice_conversion_history_path):
-                try:
-                    with open(openvoice_conversion_history_path, 'r', encoding='utf-8') as f:
-                        openvoice_history = json.load(f)
-                        openvoice_conversions = len(openvoice_history)
-                except Exception as e:
-                    logging.error(f"Lỗi khi đọc lịch sử OpenVoice: {str(e)}")
-            
-            # Đếm số lượng TTS
-            tts_count = 0
-            if os.path.exists(tts_history_path):
-                try:
-                    with open(tts_history_path, 'r', encoding='utf-8') as f:
-                        tts_history = json.load(f)
-                        tts_count = len(tts_history)
-                except Exception as e:
-                    logging.error(f"Lỗi khi đọc lịch sử TTS: {str(e)}")
-            
-            # Đếm số lượng UVR
-            uvr_count = 0
-            if os.path.exists(uvr_history_path):
-                try:
-                    with open(uvr_history_path, 'r', encoding='utf-8') as f:
-                        uvr_history = json.load(f)
-                        uvr_count = len(uvr_history)
-                except Exception as e:
-                    logging.error(f"Lỗi khi đọc lịch sử UVR: {str(e)}")
+            # Đếm số lượng chuyển đổi, TTS và UVR từ bảng lịch sử
+            rvc_conversions = count_history('conversion', model='rvc')
+            openvoice_conversions = count_history('conversion', model='openvoice')
+            tts_count = count_history('tts')
+            uvr_count = count_history('uvr')
             
             # Đếm số lượng models từ thư mục models
             openvoice_voice_models_dir = os.path.join(os.path.dirname(__file__), '..', 'ai', 'openvoice', 'sample_voices')
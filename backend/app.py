@@ -1,13 +1,17 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, send_file, Response
 import os
 import time
 import json
+import uuid
+import mimetypes
+from urllib.parse import quote
 from werkzeug.utils import secure_filename
 import logging
 import numpy as np
 from flask_cors import CORS  # Thêm import CORS
 import sys
 import io
+import threading
 from logging.handlers import RotatingFileHandler
 import traceback
 from datetime import datetime
@@ -15,7 +19,9 @@ from datetime import datetime
 # Import các controllers và models
 from models.openvoice_controller import OpenVoiceController
 from models.rvc_controller import RVCController
-from database import db, User, SystemLog, init_db
+from database import db, User, SystemLog, init_db, add_history, query_history, import_legacy_history
+from models.artifact_index import get_artifact_index, ListingCache
+from job_queue import JobQueue, QueueFullError, SUCCEEDED, FINISHED_STATUSES
 from admin_routes import admin_bp
 from ai_engineer_routes import ai_engineer_bp
 from rvc_routes import rvc_bp  # Thêm import RVC blueprint
@@ -46,6 +52,12 @@ app.config['RVC_FOLDER'] = os.path.join(app.config['RESULTS_FOLDER'], 'rvc')
 app.config['RVC_VC_FOLDER'] = os.path.join(app.config['RVC_FOLDER'], 'voice_conversion')
 app.config['RVC_UVR_FOLDER'] = os.path.join(app.config['RVC_FOLDER'], 'uvr')
 
+# Cách gửi file kết quả: '' (Flask tự gửi), 'x-sendfile' (Apache/lighttpd) hoặc 'x-accel-redirect' (nginx)
+app.config['RESULT_SENDFILE'] = os.environ.get('RESULT_SENDFILE', '').lower()
+app.config['USE_X_SENDFILE'] = app.config['RESULT_SENDFILE'] == 'x-sendfile'
+# Location internal của nginx trỏ tới thư mục results (chỉ dùng với x-accel-redirect)
+app.config['RESULT_ACCEL_PREFIX'] = os.environ.get('RESULT_ACCEL_PREFIX', '/protected-results/')
+
 # Khởi tạo database
 db.init_app(app)
 
@@ -82,6 +94,25 @@ sys.path.append(current_dir)
 openvoice = OpenVoiceController()
 rvc = RVCController()
 
+# Hàng đợi job chuyển đổi giọng nói / TTS, lưu trong SQLite để không mất job khi khởi động lại.
+# JOB_WORKERS là số job dùng model chạy đồng thời, JOB_MAX_QUEUED là số job chờ tối đa
+job_queue = JobQueue(
+    os.path.join(app.config['RESULTS_FOLDER'], 'jobs.db'),
+    num_workers=int(os.environ.get('JOB_WORKERS', 1)),
+    max_queued=int(os.environ.get('JOB_MAX_QUEUED', 100))
+)
+JOB_MAX_WAIT = 120  # thời gian chờ tối đa của một request long-poll (giây)
+
+# Khi chạy `python app.py` với debug=True, reloader của werkzeug chạy file này ở cả process theo dõi
+# lẫn process phục vụ request; chỉ khởi động worker ở process phục vụ request
+SERVING_PROCESS = __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+
+if SERVING_PROCESS:
+    # Load sẵn các model UVR5 trong UVR_PRELOAD ở nền
+    threading.Thread(target=rvc.warm_uvr_models, daemon=True).start()
+    # Khởi động sẵn pool worker RVC ở nền để request đầu tiên không phải chờ load model
+    threading.Thread(target=rvc.get_worker_pool, daemon=True).start()
+
 # Đảm bảo thư mục upload và results tồn tại
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['RESULTS_FOLDER'], exist_ok=True)
@@ -92,6 +123,28 @@ os.makedirs(app.config['RVC_FOLDER'], exist_ok=True)
 os.makedirs(app.config['RVC_VC_FOLDER'], exist_ok=True)
 os.makedirs(app.config['RVC_UVR_FOLDER'], exist_ok=True)
 
+# Chỉ mục file kết quả cho /api/download và /api/play-audio. Thứ tự thư mục là thứ tự ưu tiên khi
+# có nhiều file cùng tên
+artifacts = get_artifact_index()
+RESULT_DIRS = [
+    app.config['OPENVOICE_VC_FOLDER'],
+    app.config['OPENVOICE_TTS_FOLDER'],
+    app.config['RVC_VC_FOLDER'],
+    os.path.join(app.config['RVC_UVR_FOLDER'], 'vocals'),
+    os.path.join(app.config['RVC_UVR_FOLDER'], 'instrumental'),
+    app.config['RVC_UVR_FOLDER'],
+    app.config['RESULTS_FOLDER']
+]
+if SERVING_PROCESS:
+    artifacts.start_scan(RESULT_DIRS)
+
+# Danh sách giọng mẫu được phép phát, chỉ liệt kê lại khi thư mục giọng mẫu thay đổi
+openvoice_voices = ListingCache(
+    [os.path.join(openvoice.model_dir, 'sample_voices'), os.path.join(openvoice.model_dir, 'resources')],
+    openvoice.list_available_voices
+)
+rvc_voices = ListingCache([rvc.models_dir, rvc.weights_dir], rvc.list_available_voices)
+
 # Đăng ký các blueprint
 app.register_blueprint(admin_bp)
 app.register_blueprint(ai_engineer_bp)
@@ -101,8 +154,14 @@ app.register_blueprint(auth_bp)  # Đăng ký Auth blueprint
 # Tạo bảng database khi khởi động
 with app.app_context():
     try:
-        # Sử dụng hàm init_db để tạo lại database hoàn toàn
         init_db(app)
+        # Chuyển lịch sử dạng file JSON của các phiên bản trước vào database (chỉ chạy một lần)
+        import_legacy_history([
+            ('conversion', 'openvoice', os.path.join(app.config['OPENVOICE_VC_FOLDER'], 'conversion_history.json')),
+            ('conversion', 'rvc', os.path.join(app.config['RVC_VC_FOLDER'], 'conversion_history.json')),
+            ('tts', 'openvoice', os.path.join(app.config['OPENVOICE_TTS_FOLDER'], 'tts_history.json')),
+            ('uvr', None, os.path.join(app.config['RVC_UVR_FOLDER'], 'uvr_history.json'))
+        ])
     except Exception as e:
         logger.error(f"Lỗi khi khởi tạo database: {str(e)}")
 
@@ -110,6 +169,148 @@ with app.app_context():
 def health_check():
     return jsonify({'status': 'ok'})
 
+def remove_upload(params):
+    """Xóa file gốc (và thư mục upload riêng của job) sau khi xử lý"""
+    file_path = params['file_path']
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    upload_dir = os.path.dirname(file_path)
+    if os.path.isdir(upload_dir) and not os.listdir(upload_dir):
+        os.rmdir(upload_dir)
+
+def run_convert_job(ctx):
+    """Chuyển đổi giọng nói (chạy trong worker của hàng đợi job)"""
+    params = ctx.params
+    file_path = params['file_path']
+    filename = params['filename']
+    model_type = params['model_type']
+    target_voice = params['target_voice']
+    tau = params['tau']
+
+    try:
+        # Xử lý chuyển đổi giọng nói dựa trên model được chọn
+        if model_type == 'openvoice':
+            logger.info(f"Xử lý file {filename} với OpenVoice, target voice: {target_voice}, tau: {tau}")
+            result_path = openvoice.convert_voice(file_path, target_voice, tau=tau)
+        else:
+            logger.info(f"Xử lý file {filename} với RVC, target voice: {target_voice}")
+            result_path = rvc.convert_voice(file_path, target_voice)
+
+        if not result_path:
+            # Không sử dụng giải pháp dự phòng, trả về lỗi
+            logger.error(f"Lỗi khi xử lý với model {model_type}")
+            raise RuntimeError(f'Mô hình {model_type} không thể xử lý file này')
+
+        # Job bị hủy trong lúc xử lý thì không ghi lịch sử
+        ctx.progress(0.95)
+
+        # Trả về URL để tải file kết quả
+        result_url = f"/api/download/{os.path.basename(result_path)}"
+
+        # Lưu thông tin vào lịch sử chuyển đổi (RVCController tự lưu lịch sử của RVC)
+        if model_type == 'openvoice':
+            add_history('conversion', {
+                'timestamp': time.time(),
+                'source_file': filename,
+                'target_voice': target_voice,
+                'model_used': model_type,
+                'tau': tau,
+                'result_file': os.path.basename(result_path),
+                'result_url': result_url
+            }, model=model_type)
+
+        return {
+            'result_url': result_url,
+            'model_used': model_type,
+            'tau': tau,
+            'target_voice': target_voice
+        }
+    finally:
+        remove_upload(params)
+
+def run_tts_job(ctx):
+    """Chuyển văn bản thành giọng nói (chạy trong worker của hàng đợi job)"""
+    params = ctx.params
+    text = params['text']
+    speaker = params['speaker']
+    language = params['language']
+    speed = params['speed']
+
+    logger.info(f"Xử lý text-to-speech: '{text}', speaker: {speaker}, language: {language}, speed: {speed}")
+
+    # Chuyển văn bản thành giọng nói
+    result_path = openvoice.text_to_speech(text, speaker, language, speed)
+    if not result_path:
+        logger.error("Lỗi khi chuyển văn bản thành giọng nói")
+        raise RuntimeError('Không thể chuyển văn bản thành giọng nói')
+
+    ctx.progress(0.95)
+
+    # Trả về URL để tải file kết quả
+    result_url = f"/api/download/{os.path.basename(result_path)}"
+
+    # Lưu thông tin vào lịch sử
+    add_history('tts', {
+        'timestamp': time.time(),
+        'text': text,
+        'speaker': speaker,
+        'language': language,
+        'speed': speed,
+        'result_file': os.path.basename(result_path),
+        'result_url': result_url
+    }, model='openvoice')
+
+    return {
+        'result_url': result_url,
+        'speaker': speaker,
+        'language': language,
+        'speed': speed
+    }
+
+job_queue.register('convert', run_convert_job, cleanup=remove_upload)
+job_queue.register('tts', run_tts_job)
+if SERVING_PROCESS:
+    # Chạy tiếp các job còn dở từ lần chạy trước
+    job_queue.start()
+
+def is_async_request(value):
+    return str(value).lower() in ('1', 'true', 'yes')
+
+def job_response(job):
+    """Thông tin job trả về cho client"""
+    job = dict(job)
+    job.pop('params', None)
+    job['status_url'] = f"/api/jobs/{job['id']}"
+    job['wait_url'] = f"/api/jobs/{job['id']}/wait"
+    job['events_url'] = f"/api/jobs/{job['id']}/events"
+    return job
+
+def submit_job(job_type, params, priority, run_async):
+    """
+    Thêm job vào hàng đợi. Chế độ async trả về 202 kèm job_id ngay, chế độ thường chờ job xong và
+    trả về kết quả như API đồng bộ trước đây.
+    """
+    job_queue.start()
+    try:
+        job_id = job_queue.submit(job_type, params, priority=priority)
+    except QueueFullError as e:
+        logger.warning(str(e))
+        if job_type == 'convert':
+            remove_upload(params)
+        return jsonify({'error': str(e)}), 503
+
+    if run_async:
+        return jsonify(job_response(job_queue.get(job_id))), 202
+
+    job, _ = job_queue.wait(job_id)
+    if job['status'] == SUCCEEDED:
+        return jsonify({'success': True, 'job_id': job_id, **job['result']})
+    return jsonify({
+        'success': False,
+        'job_id': job_id,
+        'error': job['error'] or 'Job đã bị hủy'
+    }), 500
+
 @app.route('/api/convert', methods=['POST'])
 def convert_audio():
     if 'audio' not in request.files:
@@ -125,6 +326,14 @@ def convert_audio():
     model_type = request.form.get('model_type', 'openvoice')
     target_voice = request.form.get('target_voice', 'default')
     tau = float(request.form.get('tau', 0.4))
+    try:
+        priority = int(request.form.get('priority', 0))
+    except ValueError:
+        return jsonify({'error': 'Tham số priority phải là số nguyên'}), 400
+    
+    if model_type not in ('openvoice', 'rvc'):
+        logger.error(f"Model không được hỗ trợ: {model_type}")
+        return jsonify({'error': f'Model {model_type} không được hỗ trợ'}), 400
     
     # Kiểm tra và giới hạn giá trị tau
     if tau < 0.1:
@@ -132,131 +341,54 @@ def convert_audio():
     elif tau > 1.0:
         tau = 1.0
     
-    # Lưu file tạm thời
+    # Lưu file vào thư mục riêng của job để các job cùng tên file không ghi đè nhau,
+    # tên file (và do đó tên file kết quả) vẫn giữ nguyên
     filename = secure_filename(audio_file.filename)
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], uuid.uuid4().hex)
+    os.makedirs(upload_dir, exist_ok=True)
+    file_path = os.path.join(upload_dir, filename)
     audio_file.save(file_path)
     
-    try:
-        # Xử lý chuyển đổi giọng nói dựa trên model được chọn
-        if model_type == 'openvoice':
-            logger.info(f"Xử lý file {filename} với OpenVoice, target voice: {target_voice}, tau: {tau}")
-            result_path = openvoice.convert_voice(file_path, target_voice, tau=tau)
-        elif model_type == 'rvc':
-            logger.info(f"Xử lý file {filename} với RVC, target voice: {target_voice}")
-            result_path = rvc.convert_voice(file_path, target_voice)
-        else:
-            logger.error(f"Model không được hỗ trợ: {model_type}")
-            return jsonify({'error': f'Model {model_type} không được hỗ trợ'}), 400
-        
-        if result_path:
-            # Trả về URL để tải file kết quả
-            result_url = f"/api/download/{os.path.basename(result_path)}"
-            
-            # Lưu thông tin vào lịch sử chuyển đổi
-            history_entry = {
-                'timestamp': time.time(),
-                'source_file': filename,
-                'target_voice': target_voice,
-                'model_used': model_type,
-                'tau': tau,
-                'result_file': os.path.basename(result_path),
-                'result_url': result_url
-            }
-            
-            # Lưu lịch sử vào file
-            if model_type == 'openvoice':
-                history_file = os.path.join(app.config['OPENVOICE_VC_FOLDER'], 'conversion_history.json')
-            else:
-                history_file = os.path.join(app.config['RVC_VC_FOLDER'], 'conversion_history.json')
-                
-            history = []
-            if os.path.exists(history_file):
-                try:
-                    with open(history_file, 'r', encoding='utf-8') as f:
-                        history = json.load(f)
-                except:
-                    history = []
-            
-            history.append(history_entry)
-            with open(history_file, 'w', encoding='utf-8') as f:
-                json.dump(history, f, ensure_ascii=False, indent=2)
-            
-            return jsonify({
-                'success': True,
-                'result_url': result_url,
-                'model_used': model_type,
-                'tau': tau,
-                'target_voice': target_voice
-            })
-        else:
-            # Không sử dụng giải pháp dự phòng, trả về lỗi
-            logger.error(f"Lỗi khi xử lý với model {model_type}")
-            return jsonify({
-                'success': False,
-                'error': f'Mô hình {model_type} không thể xử lý file này'
-            }), 500
-            
-    except Exception as e:
-        logger.exception(f"Lỗi xử lý: {str(e)}")
-        return jsonify({'error': f'Lỗi xử lý: {str(e)}'}), 500
-    finally:
-        # Xóa file gốc sau khi xử lý
-        if os.path.exists(file_path):
-            os.remove(file_path)
+    return submit_job('convert', {
+        'file_path': file_path,
+        'filename': filename,
+        'model_type': model_type,
+        'target_voice': target_voice,
+        'tau': tau
+    }, priority, is_async_request(request.form.get('async')))
+
+def send_audio(file_path, as_attachment=False):
+    """
+    Gửi file âm thanh với ETag mạnh (hash nội dung): hỗ trợ Range (206), If-Range, If-None-Match và
+    If-Modified-Since (304) để trình phát tua không phải tải lại cả file. Ở chế độ x-accel-redirect,
+    nginx gửi file (kể cả Range), Flask chỉ trả header.
+    """
+    file_path = os.path.abspath(file_path)
+    etag = artifacts.etag(file_path)
+
+    if app.config['RESULT_SENDFILE'] == 'x-accel-redirect':
+        relative = os.path.relpath(file_path, os.path.abspath(app.config['RESULTS_FOLDER']))
+        if not relative.startswith('..'):
+            response = Response(mimetype=mimetypes.guess_type(file_path)[0] or 'application/octet-stream')
+            response.set_etag(etag)
+            response.last_modified = os.path.getmtime(file_path)
+            response.cache_control.no_cache = True
+            if as_attachment:
+                response.headers.set('Content-Disposition', 'attachment', filename=os.path.basename(file_path))
+            response.headers['X-Accel-Redirect'] = (
+                app.config['RESULT_ACCEL_PREFIX'].rstrip('/') + '/' + quote(relative.replace(os.sep, '/'))
+            )
+            return response.make_conditional(request)
+
+    # max_age=0: trình duyệt luôn hỏi lại server, nhận 304 nếu file không đổi
+    return send_file(file_path, as_attachment=as_attachment, etag=etag, conditional=True, max_age=0)
 
 @app.route('/api/download/<filename>', methods=['GET'])
 def download_file(filename):
     """API để tải xuống file kết quả"""
-    # Kiểm tra file trong thư mục OpenVoice voice_conversion
-    file_path = os.path.join(app.config['OPENVOICE_VC_FOLDER'], filename)
-    if os.path.exists(file_path):
-        return send_from_directory(app.config['OPENVOICE_VC_FOLDER'], filename, as_attachment=True)
-    
-    # Kiểm tra file trong thư mục OpenVoice tts
-    file_path = os.path.join(app.config['OPENVOICE_TTS_FOLDER'], filename)
-    if os.path.exists(file_path):
-        return send_from_directory(app.config['OPENVOICE_TTS_FOLDER'], filename, as_attachment=True)
-    
-    # Kiểm tra file trong thư mục RVC voice_conversion
-    file_path = os.path.join(app.config['RVC_VC_FOLDER'], filename)
-    if os.path.exists(file_path):
-        return send_from_directory(app.config['RVC_VC_FOLDER'], filename, as_attachment=True)
-    
-    # Kiểm tra file trong thư mục RVC UVR vocals
-    vocals_dir = os.path.join(app.config['RVC_UVR_FOLDER'], 'vocals')
-    file_path = os.path.join(vocals_dir, filename)
-    if os.path.exists(file_path):
-        logger.info(f"Đã tìm thấy file vocals: {file_path}")
-        return send_from_directory(vocals_dir, filename, as_attachment=True)
-    
-    # Kiểm tra file trong thư mục RVC UVR instrumental
-    instrumental_dir = os.path.join(app.config['RVC_UVR_FOLDER'], 'instrumental')
-    file_path = os.path.join(instrumental_dir, filename)
-    if os.path.exists(file_path):
-        logger.info(f"Đã tìm thấy file instrumental: {file_path}")
-        return send_from_directory(instrumental_dir, filename, as_attachment=True)
-    
-    # Kiểm tra file trong thư mục RVC UVR (thư mục gốc)
-    file_path = os.path.join(app.config['RVC_UVR_FOLDER'], filename)
-    if os.path.exists(file_path):
-        return send_from_directory(app.config['RVC_UVR_FOLDER'], filename, as_attachment=True)
-    
-    # Kiểm tra trong các thư mục con của UVR tiềm năng khác
-    for subdir in ['vocals', 'instrumental']:
-        uvr_dir = os.path.join(app.config['RVC_UVR_FOLDER'], subdir)
-        if os.path.exists(uvr_dir):
-            # Kiểm tra các file trong thư mục
-            for file in os.listdir(uvr_dir):
-                # Kiểm tra tên file tương tự
-                if filename in file:
-                    logger.info(f"Đã tìm thấy file tương tự: {os.path.join(uvr_dir, file)}")
-                    return send_from_directory(uvr_dir, file, as_attachment=True)
-    
-    # Kiểm tra file trong thư mục results chung
-    file_path = os.path.join(app.config['RESULTS_FOLDER'], filename)
-    if os.path.exists(file_path):
-        return send_from_directory(app.config['RESULTS_FOLDER'], filename, as_attachment=True)
+    file_path = artifacts.resolve(filename)
+    if file_path:
+        return send_audio(file_path, as_attachment=True)
     
     # Nếu không tìm thấy file ở tất cả các vị trí
     logger.error(f"Không tìm thấy file: {filename} trong bất kỳ thư mục nào")
@@ -272,69 +404,16 @@ def play_audio():
     
     logger.info(f"Yêu cầu phát file âm thanh: {audio_path}")
     
-    # Kiểm tra xem file có phải là file mẫu từ OpenVoice không
-    openvoice_voices = openvoice.list_available_voices()
-    if audio_path in openvoice_voices:
-        # Phát file mẫu từ OpenVoice
-        return send_from_directory(os.path.dirname(audio_path), os.path.basename(audio_path))
-    
-    # Kiểm tra xem file có phải là file mẫu từ RVC không
-    rvc_voices = rvc.list_available_voices()
-    if audio_path in rvc_voices:
-        # Phát file mẫu từ RVC
-        return send_from_directory(os.path.dirname(audio_path), os.path.basename(audio_path))
+    # Kiểm tra xem file có phải là file mẫu từ OpenVoice / RVC không
+    if audio_path in openvoice_voices.get() or audio_path in rvc_voices.get():
+        # Phát file mẫu
+        return send_audio(audio_path)
     
-    # Kiểm tra trong các thư mục kết quả
+    # Tìm trong chỉ mục file kết quả
     filename = os.path.basename(audio_path)
-    logger.info(f"Tìm kiếm file: {filename}")
-    
-    # Kiểm tra trong thư mục OpenVoice voice_conversion
-    file_path = os.path.join(app.config['OPENVOICE_VC_FOLDER'], filename)
-    if os.path.exists(file_path):
-        return send_from_directory(app.config['OPENVOICE_VC_FOLDER'], filename)
-    
-    # Kiểm tra trong thư mục OpenVoice tts
-    file_path = os.path.join(app.config['OPENVOICE_TTS_FOLDER'], filename)
-    if os.path.exists(file_path):
-        return send_from_directory(app.config['OPENVOICE_TTS_FOLDER'], filename)
-    
-    # Kiểm tra trong thư mục RVC voice_conversion
-    file_path = os.path.join(app.config['RVC_VC_FOLDER'], filename)
-    if os.path.exists(file_path):
-        return send_from_directory(app.config['RVC_VC_FOLDER'], filename)
-    
-    # Kiểm tra trong thư mục RVC UVR vocals
-    vocals_dir = os.path.join(app.config['RVC_UVR_FOLDER'], 'vocals')
-    file_path = os.path.join(vocals_dir, filename)
-    if os.path.exists(file_path):
-        logger.info(f"Đã tìm thấy file vocals để phát: {file_path}")
-        return send_from_directory(vocals_dir, filename)
-    
-    # Kiểm tra trong thư mục RVC UVR instrumental
-    instrumental_dir = os.path.join(app.config['RVC_UVR_FOLDER'], 'instrumental')
-    file_path = os.path.join(instrumental_dir, filename)
-    if os.path.exists(file_path):
-        logger.info(f"Đã tìm thấy file instrumental để phát: {file_path}")
-        return send_from_directory(instrumental_dir, filename)
-    
-    # Kiểm tra trong thư mục RVC UVR (thư mục gốc)
-    file_path = os.path.join(app.config['RVC_UVR_FOLDER'], filename)
-    if os.path.exists(file_path):
-        return send_from_directory(app.config['RVC_UVR_FOLDER'], filename)
-    
-    # Tìm các file tương tự trong các thư mục con của UVR
-    for subdir in ['vocals', 'instrumental']:
-        uvr_dir = os.path.join(app.config['RVC_UVR_FOLDER'], subdir)
-        if os.path.exists(uvr_dir):
-            for file in os.listdir(uvr_dir):
-                # Kiểm tra tên file tương tự
-                if filename in file:
-                    logger.info(f"Đã tìm thấy file tương tự để phát: {os.path.join(uvr_dir, file)}")
-                    return send_from_directory(uvr_dir, file)
-    
-    # Kiểm tra trong thư mục chung
-    if os.path.exists(os.path.join(app.config['RESULTS_FOLDER'], filename)):
-        return send_from_directory(app.config['RESULTS_FOLDER'], filename)
+    file_path = artifacts.resolve(filename)
+    if file_path:
+        return send_audio(file_path)
     
     logger.error(f"Không tìm thấy file âm thanh: {filename}")
     return jsonify({'error': 'Không tìm thấy file âm thanh'}), 404
@@ -359,76 +438,83 @@ def list_tts_speakers():
 @app.route('/api/tts/generate', methods=['POST'])
 def text_to_speech():
     """API để chuyển văn bản thành giọng nói"""
-    try:
-        # Lấy dữ liệu từ request
-        data = request.json
-        
-        if not data or 'text' not in data:
-            logger.error("Không có dữ liệu văn bản được gửi lên")
-            return jsonify({'error': 'Không có dữ liệu văn bản'}), 400
-            
-        text = data.get('text')
-        speaker = data.get('speaker', 'default')
-        language = data.get('language', 'english')
-        speed = float(data.get('speed', 1.0))
-        
-        # Kiểm tra giá trị speed
-        if speed < 0.5:
-            speed = 0.5
-        elif speed > 2.0:
-            speed = 2.0
-        
-        logger.info(f"Xử lý text-to-speech: '{text}', speaker: {speaker}, language: {language}, speed: {speed}")
-        
-        # Chuyển văn bản thành giọng nói
-        result_path = openvoice.text_to_speech(text, speaker, language, speed)
+    # Lấy dữ liệu từ request
+    data = request.json
+    
+    if not data or 'text' not in data:
+        logger.error("Không có dữ liệu văn bản được gửi lên")
+        return jsonify({'error': 'Không có dữ liệu văn bản'}), 400
         
-        if result_path:
-            # Trả về URL để tải file kết quả
-            result_url = f"/api/download/{os.path.basename(result_path)}"
-            
-            # Lưu thông tin vào lịch sử
-            history_entry = {
-                'timestamp': time.time(),
-                'text': text,
-                'speaker': speaker,
-                'language': language,
-                'speed': speed,
-                'result_file': os.path.basename(result_path),
-                'result_url': result_url
-            }
-            
-            # Lưu lịch sử vào file
-            history_file = os.path.join(app.config['OPENVOICE_TTS_FOLDER'], 'tts_history.json')
-            history = []
-            if os.path.exists(history_file):
-                try:
-                    with open(history_file, 'r', encoding='utf-8') as f:
-                        history = json.load(f)
-                except:
-                    history = []
-            
-            history.append(history_entry)
-            with open(history_file, 'w', encoding='utf-8') as f:
-                json.dump(history, f, ensure_ascii=False, indent=2)
-            
-            return jsonify({
-                'success': True,
-                'result_url': result_url,
-                'speaker': speaker,
-                'language': language,
-                'speed': speed
-            })
-        else:
-            logger.error("Lỗi khi chuyển văn bản thành giọng nói")
-            return jsonify({
-                'success': False,
-                'error': 'Không thể chuyển văn bản thành giọng nói'
-            }), 500
-            
-    except Exception as e:
-        logger.exception(f"Lỗi xử lý text-to-speech: {str(e)}")
-        return jsonify({'error': f'Lỗi xử lý: {str(e)}'}), 500
+    speed = float(data.get('speed', 1.0))
+    try:
+        priority = int(data.get('priority', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Tham số priority phải là số nguyên'}), 400
+    
+    # Kiểm tra giá trị speed
+    if speed < 0.5:
+        speed = 0.5
+    elif speed > 2.0:
+        speed = 2.0
+    
+    return submit_job('tts', {
+        'text': data.get('text'),
+        'speaker': data.get('speaker', 'default'),
+        'language': data.get('language', 'english'),
+        'speed': speed
+    }, priority, is_async_request(data.get('async')))
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """Danh sách job gần đây, lọc theo ?status="""
+    limit = min(int(request.args.get('limit', 50)), 500)
+    jobs = job_queue.list(status=request.args.get('status'), limit=limit)
+    return jsonify({'jobs': [job_response(job) for job in jobs]})
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Không tìm thấy job'}), 404
+    return jsonify(job_response(job))
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    if job_queue.get(job_id) is None:
+        return jsonify({'error': 'Không tìm thấy job'}), 404
+    if not job_queue.cancel(job_id):
+        return jsonify({'error': 'Job đã kết thúc, không thể hủy'}), 409
+    return jsonify(job_response(job_queue.get(job_id)))
+
+@app.route('/api/jobs/<job_id>/wait', methods=['GET'])
+def wait_job(job_id):
+    """Long-poll: chờ tối đa ?timeout= giây (mặc định 30) đến khi job kết thúc"""
+    timeout = min(float(request.args.get('timeout', 30)), JOB_MAX_WAIT)
+    job, _ = job_queue.wait(job_id, timeout=timeout)
+    if job is None:
+        return jsonify({'error': 'Không tìm thấy job'}), 404
+    return jsonify(job_response(job))
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Server-Sent Events: gửi trạng thái job mỗi khi thay đổi, đóng stream khi job kết thúc"""
+    if job_queue.get(job_id) is None:
+        return jsonify({'error': 'Không tìm thấy job'}), 404
+
+    def generate():
+        # Gửi trạng thái hiện tại ngay, sau đó chờ từng thay đổi so với version đã gửi
+        job, version = job_queue.wait(job_id, timeout=0)
+        while job is not None:
+            yield f"data: {json.dumps(job_response(job), ensure_ascii=False)}\n\n"
+            if job['status'] in FINISHED_STATUSES:
+                return
+            job, version = job_queue.wait(job_id, timeout=15, version=version)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
 
 @app.route('/api/admin/logs', methods=['GET'])
 def get_logs():
@@ -502,115 +588,56 @@ def get_voice_details():
             'error': str(e)
         })
 
+def history_page(kind, model=None):
+    """
+    Trả về lịch sử theo thứ tự ghi (cũ trước, giống các file JSON trước đây), phân trang bằng
+    ?page= (từ 1, tính từ bản ghi cũ nhất) và ?per_page= (mặc định 100, tối đa 1000). Không có
+    ?page= thì trả về per_page bản ghi mới nhất. Tổng số bản ghi nằm trong header X-Total-Count.
+    """
+    try:
+        page = request.args.get('page')
+        page = max(1, int(page)) if page is not None else None
+        per_page = min(max(1, int(request.args.get('per_page', 100))), 1000)
+    except ValueError:
+        return jsonify({'error': 'Tham số phân trang không hợp lệ'}), 400
+
+    try:
+        if page is None:
+            items, total = query_history(kind, model=model, limit=per_page, newest_first=True)
+            items.reverse()
+        else:
+            items, total = query_history(kind, model=model, limit=per_page, offset=(page - 1) * per_page,
+                                         newest_first=False)
+    except Exception as e:
+        logger.error(f"Lỗi khi đọc lịch sử {kind}: {str(e)}")
+        return jsonify([])
+
+    response = jsonify(items)
+    response.headers['X-Total-Count'] = str(total)
+    if page is not None:
+        response.headers['X-Page'] = str(page)
+    response.headers['X-Per-Page'] = str(per_page)
+    return response
+
 @app.route('/api/conversion-history', methods=['GET'])
 def get_conversion_history():
     """Lấy lịch sử chuyển đổi giọng nói"""
     model_type = request.args.get('model_type', 'all')
     
-    if model_type == 'openvoice':
-        history_file = os.path.join(app.config['OPENVOICE_VC_FOLDER'], 'conversion_history.json')
-    elif model_type == 'rvc':
-        history_file = os.path.join(app.config['RVC_VC_FOLDER'], 'conversion_history.json')
-    else:
+    if model_type not in ('openvoice', 'rvc'):
         # Mặc định hoặc 'all' - trả về danh sách trống
         return jsonify([])
-    
-    if not os.path.exists(history_file):
-        return jsonify([])
-    
-    try:
-        with open(history_file, 'r', encoding='utf-8') as f:
-            history = json.load(f)
-        return jsonify(history)
-    except Exception as e:
-        logger.error(f"Lỗi khi đọc lịch sử chuyển đổi: {str(e)}")
-        return jsonify([])
+    return history_page('conversion', model=model_type)
 
 @app.route('/api/uvr-history', methods=['GET'])
 def get_uvr_history():
     """Lấy lịch sử tách giọng nói UVR"""
-    history_file = os.path.join(app.config['RVC_UVR_FOLDER'], 'uvr_history.json')
-    
-    logger.info(f"Đang tìm kiếm file lịch sử UVR tại: {history_file}")
-    
-    if not os.path.exists(history_file):
-        logger.warning(f"Không tìm thấy file lịch sử UVR: {history_file}")
-        return jsonify([])
-    
-    try:
-        with open(history_file, 'r', encoding='utf-8') as f:
-            history = json.load(f)
-        
-        # Thêm log để gỡ lỗi
-        logger.info(f"Đã đọc lịch sử UVR: {len(history)} mục")
-        
-        # Kiểm tra và cập nhật các đường dẫn URL nếu cần
-        for item in history:
-            # Tạo các đường dẫn đến thư mục vocals và instrumental
-            vocals_dir = os.path.join(app.config['RVC_UVR_FOLDER'], 'vocals')
-            instrumental_dir = os.path.join(app.config['RVC_UVR_FOLDER'], 'instrumental')
-            
-            # Kiểm tra file vocals
-            expected_vocals_file = item.get('vocals_file')
-            if expected_vocals_file:
-                vocals_path = os.path.join(vocals_dir, expected_vocals_file)
-                if not os.path.exists(vocals_path):
-                    # Tìm file thay thế trong thư mục vocals
-                    source_file_base = os.path.splitext(item.get('source_file', ''))[0]
-                    if source_file_base:
-                        for filename in os.listdir(vocals_dir):
-                            if source_file_base in filename:
-                                logger.info(f"Tìm thấy file vocals thay thế: {filename} thay vì {expected_vocals_file}")
-                                item['vocals_file'] = filename
-                                item['vocals_url'] = f"/api/download/{filename}"
-                                break
-            
-            # Kiểm tra file instrumental
-            expected_instrumental_file = item.get('instrumental_file')
-            if expected_instrumental_file:
-                instrumental_path = os.path.join(instrumental_dir, expected_instrumental_file)
-                if not os.path.exists(instrumental_path):
-                    # Tìm file thay thế trong thư mục instrumental
-                    source_file_base = os.path.splitext(item.get('source_file', ''))[0]
-                    if source_file_base:
-                        for filename in os.listdir(instrumental_dir):
-                            if source_file_base in filename:
-                                logger.info(f"Tìm thấy file instrumental thay thế: {filename} thay vì {expected_instrumental_file}")
-                                item['instrumental_file'] = filename
-                                item['instrumental_url'] = f"/api/download/{filename}"
-                                break
-            
-            # Đảm bảo rằng vocals_url và instrumental_url đều bắt đầu bằng /api/download/
-            if 'vocals_url' in item and not item['vocals_url'].startswith('/api/download/'):
-                item['vocals_url'] = f"/api/download/{item['vocals_file']}"
-                
-            if 'instrumental_url' in item and not item['instrumental_url'].startswith('/api/download/'):
-                item['instrumental_url'] = f"/api/download/{item['instrumental_file']}"
-                
-        # Cập nhật file lịch sử với các đường dẫn đã chỉnh sửa
-        with open(history_file, 'w', encoding='utf-8') as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
-            
-        return jsonify(history)
-    except Exception as e:
-        logger.exception(f"Lỗi khi đọc lịch sử UVR: {str(e)}")
-        return jsonify([])
+    return history_page('uvr')
 
 @app.route('/api/tts-history', methods=['GET'])
 def get_tts_history():
     """Lấy lịch sử text-to-speech"""
-    history_file = os.path.join(app.config['OPENVOICE_TTS_FOLDER'], 'tts_history.json')
-    
-    if not os.path.exists(history_file):
-        return jsonify([])
-    
-    try:
-        with open(history_file, 'r', encoding='utf-8') as f:
-            history = json.load(f)
-        return jsonify(history)
-    except Exception as e:
-        logger.error(f"Lỗi khi đọc lịch sử TTS: {str(e)}")
-        return jsonify([])
+    return history_page('tts')
 
 # Route cho frontend
 @app.route('/', defaults={'path': ''})
@@ -1,7 +1,16 @@
+import os
+import json
+import logging
+from contextlib import contextmanager
+from flask import has_app_context
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 
 db = SQLAlchemy()
+logger = logging.getLogger(__name__)
+
+# App được lưu lại khi init_db để ghi lịch sử từ thread nền (worker hàng đợi job, worker UVR)
+_app = None
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -28,13 +37,114 @@ class SystemLog(db.Model):
     def __repr__(self):
         return f'<SystemLog {self.timestamp} {self.level}>'
 
+class History(db.Model):
+    """Lịch sử chuyển đổi giọng nói / TTS / tách giọng UVR, chỉ thêm mới không sửa"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # conversion, tts, uvr
+    model = db.Column(db.String(50))  # openvoice, rvc, tên model UVR...
+    timestamp = db.Column(db.Float, nullable=False)
+    user_id = db.Column(db.Integer, nullable=True)
+    data = db.Column(db.Text, nullable=False)  # JSON của bản ghi như API trả về
+
+    __table_args__ = (
+        db.Index('ix_history_kind_model_timestamp', 'kind', 'model', 'timestamp'),
+        db.Index('ix_history_kind_timestamp', 'kind', 'timestamp'),
+        db.Index('ix_history_user_timestamp', 'user_id', 'timestamp'),
+    )
+
+    def to_dict(self):
+        return json.loads(self.data)
+
+    def __repr__(self):
+        return f'<History {self.kind} {self.model} {self.timestamp}>'
+
+@contextmanager
+def _history_context():
+    if has_app_context() or _app is None:
+        yield
+    else:
+        with _app.app_context():
+            yield
+
+def add_history(kind, entry, model=None, user_id=None):
+    """Thêm một bản ghi lịch sử (entry là dict sẽ được trả về nguyên dạng qua API)"""
+    with _history_context():
+        try:
+            db.session.add(History(
+                kind=kind,
+                model=model,
+                timestamp=entry.get('timestamp') or datetime.utcnow().timestamp(),
+                user_id=user_id,
+                data=json.dumps(entry, ensure_ascii=False)
+            ))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+def query_history(kind, model=None, user_id=None, limit=100, offset=0, newest_first=True):
+    """
+    Lấy một trang lịch sử
+
+    Returns:
+        tuple: (danh sách bản ghi, tổng số bản ghi khớp điều kiện)
+    """
+    with _history_context():
+        query = History.query.filter_by(kind=kind)
+        if model:
+            query = query.filter_by(model=model)
+        if user_id is not None:
+            query = query.filter_by(user_id=user_id)
+        total = query.count()
+        if newest_first:
+            order = (History.timestamp.desc(), History.id.desc())
+        else:
+            order = (History.timestamp.asc(), History.id.asc())
+        rows = query.order_by(*order).offset(offset).limit(limit).all()
+        return [row.to_dict() for row in rows], total
+
+def count_history(kind, model=None):
+    with _history_context():
+        query = History.query.filter_by(kind=kind)
+        if model:
+            query = query.filter_by(model=model)
+        return query.count()
+
+def import_legacy_history(sources):
+    """
+    Nhập một lần các file lịch sử JSON cũ vào bảng History. File đã nhập được đổi tên thành
+    *.imported nên các lần khởi động sau không nhập lại.
+
+    Args:
+        sources (list): Danh sách (kind, model, đường dẫn file JSON)
+    """
+    with _history_context():
+        for kind, model, path in sources:
+            if not os.path.exists(path):
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    entries = json.load(f)
+                rows = [History(
+                    kind=kind,
+                    model=model or entry.get('model_used') or entry.get('model_name'),
+                    timestamp=entry.get('timestamp') or 0,
+                    data=json.dumps(entry, ensure_ascii=False)
+                ) for entry in entries if isinstance(entry, dict)]
+                db.session.add_all(rows)
+                db.session.commit()
+                os.replace(path, f"{path}.imported")
+                logger.info(f"Đã nhập {len(rows)} bản ghi lịch sử từ {path}")
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Lỗi khi nhập lịch sử từ {path}: {str(e)}")
+
 def init_db(app):
     """Khởi tạo và cập nhật database"""
+    global _app
+    _app = app
     with app.app_context():
-        # Xóa tất cả các bảng
-        db.drop_all()
-        
-        # Tạo lại tất cả các bảng với cấu trúc mới
+        # Chỉ tạo các bảng còn thiếu, không xóa dữ liệu cũ (lịch sử, người dùng)
         db.create_all()
         
-        print("Đã khởi tạo lại database thành công!") 
\ No newline at end of file
+        print("Đã khởi tạo database thành công!")
@@ -0,0 +1,276 @@
+"""
+Hàng đợi job xử lý giọng nói chạy nền.
+
+Job được lưu trong SQLite (results/jobs.db) nên không mất khi server khởi động lại: các job đang
+chờ hoặc đang chạy dở được đưa lại vào hàng đợi. Một số worker thread cố định lấy job theo độ ưu
+tiên (cao trước, cùng độ ưu tiên thì job cũ trước) và gọi handler đã đăng ký cho loại job đó.
+"""
+import os
+import json
+import time
+import uuid
+import queue
+import logging
+import sqlite3
+import itertools
+import threading
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATUSES = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class QueueFullError(Exception):
+    """Hàng đợi đã đầy, client nên thử lại sau"""
+
+
+class JobCancelledError(Exception):
+    """Handler dừng giữa chừng vì job đã bị hủy"""
+
+
+class JobContext:
+    """Được truyền cho handler: tham số của job, báo tiến độ và kiểm tra job có bị hủy không"""
+
+    def __init__(self, job_queue, job_id, params):
+        self.job_queue = job_queue
+        self.job_id = job_id
+        self.params = params
+
+    @property
+    def cancelled(self):
+        return self.job_id in self.job_queue.cancel_requested
+
+    def progress(self, value, message=None):
+        """Cập nhật tiến độ (0.0 - 1.0), dừng job nếu đã bị hủy"""
+        if self.cancelled:
+            raise JobCancelledError()
+        self.job_queue._update(self.job_id, progress=float(value), message=message)
+
+
+class JobQueue:
+    def __init__(self, db_path, num_workers=1, max_queued=100):
+        """
+        Args:
+            db_path (str): File SQLite lưu job
+            num_workers (int): Số job chạy đồng thời (mỗi worker giữ một lượt dùng model)
+            max_queued (int): Số job chờ tối đa, vượt quá thì submit báo QueueFullError
+        """
+        self.db_path = db_path
+        self.num_workers = max(1, int(num_workers))
+        self.max_queued = max(1, int(max_queued))
+        self.handlers = {}
+        self.cleanups = {}
+
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.cancel_requested = set()
+        # Báo cho các request đang chờ (long-poll / SSE) khi job thay đổi trạng thái
+        self.condition = threading.Condition()
+        self.versions = {}
+
+        self.started = False
+        self.start_lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        with self.db_lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    type TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    params TEXT,
+                    result TEXT,
+                    error TEXT,
+                    progress REAL NOT NULL DEFAULT 0,
+                    message TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+            """)
+            self.db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, priority, created_at)")
+
+    def register(self, job_type, handler, cleanup=None):
+        """
+        Args:
+            handler (callable): handler(ctx: JobContext) -> dict kết quả (JSON), raise exception nếu thất bại
+            cleanup (callable): cleanup(params), dọn file đầu vào của job bị hủy trước khi chạy
+        """
+        self.handlers[job_type] = handler
+        if cleanup:
+            self.cleanups[job_type] = cleanup
+
+    def start(self):
+        """Khởi động worker và đưa lại các job chưa xong vào hàng đợi (gọi nhiều lần không sao)"""
+        with self.start_lock:
+            if self.started:
+                return
+            self.started = True
+
+            with self.db_lock:
+                # Job đang chạy khi server dừng thì chạy lại từ đầu
+                self.db.execute("UPDATE jobs SET status = ?, started_at = NULL WHERE status = ?", (QUEUED, RUNNING))
+                rows = self.db.execute(
+                    "SELECT id, priority FROM jobs WHERE status = ? ORDER BY created_at", (QUEUED,)
+                ).fetchall()
+            for row in rows:
+                self.queue.put((-row['priority'], next(self.sequence), row['id']))
+            if rows:
+                logger.info(f"Đã đưa lại {len(rows)} job chưa hoàn thành vào hàng đợi")
+
+            for i in range(self.num_workers):
+                threading.Thread(target=self._worker_loop, name=f"job-worker-{i}", daemon=True).start()
+            logger.info(f"Đã khởi động {self.num_workers} worker xử lý job")
+
+    def submit(self, job_type, params, priority=0):
+        """Thêm job vào hàng đợi, trả về job_id"""
+        if job_type not in self.handlers:
+            raise ValueError(f"Loại job không được hỗ trợ: {job_type}")
+        job_id = uuid.uuid4().hex
+        with self.db_lock:
+            # Chỉ đếm job còn đang chờ: job đã hủy vẫn nằm trong self.queue đến khi worker bỏ qua nó
+            queued = self.db.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+            if queued >= self.max_queued:
+                raise QueueFullError(f"Hàng đợi đã đầy ({self.max_queued} job đang chờ)")
+            self.db.execute(
+                "INSERT INTO jobs (id, type, status, priority, params, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, job_type, QUEUED, int(priority), json.dumps(params, ensure_ascii=False), time.time())
+            )
+        self.queue.put((-int(priority), next(self.sequence), job_id))
+        logger.info(f"Đã thêm job {job_id} ({job_type}, ưu tiên {priority}), {queued + 1} job đang chờ")
+        return job_id
+
+    def get(self, job_id):
+        with self.db_lock:
+            row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def list(self, status=None, limit=50):
+        query = "SELECT * FROM jobs"
+        args = []
+        if status:
+            query += " WHERE status = ?"
+            args.append(status)
+        query += " ORDER BY created_at DESC LIMIT ?"
+        args.append(int(limit))
+        with self.db_lock:
+            rows = self.db.execute(query, args).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def cancel(self, job_id):
+        """
+        Hủy job: job đang chờ bị bỏ ngay, job đang chạy dừng ở lần báo tiến độ tiếp theo
+        (kết quả của nó bị bỏ). Trả về False nếu job không tồn tại hoặc đã xong.
+        """
+        job = self.get(job_id)
+        if job is None or job['status'] in FINISHED_STATUSES:
+            return False
+        self.cancel_requested.add(job_id)
+        # Chuyển trạng thái có điều kiện để không tranh chấp với worker vừa lấy job này
+        if self._update(job_id, expected_status=QUEUED, status=CANCELLED, finished_at=time.time()):
+            self.cancel_requested.discard(job_id)
+            cleanup = self.cleanups.get(job['type'])
+            if cleanup:
+                try:
+                    cleanup(job['params'])
+                except Exception as e:
+                    logger.warning(f"Khong don duoc du lieu cua job {job_id}: {str(e)}")
+        logger.info(f"Đã yêu cầu hủy job {job_id}")
+        return True
+
+    def wait(self, job_id, timeout=None, version=None):
+        """
+        Chờ đến khi job thay đổi so với version (hoặc kết thúc nếu version=None), hết timeout thì
+        trả về trạng thái hiện tại.
+
+        Returns:
+            tuple: (job dict hoặc None, version hiện tại)
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                job = self.get(job_id)
+                current = self.versions.get(job_id, 0)
+                if job is None or job['status'] in FINISHED_STATUSES:
+                    return job, current
+                if version is not None and current != version:
+                    return job, current
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return job, current
+                self.condition.wait(remaining)
+
+    def _update(self, job_id, expected_status=None, **fields):
+        """Cập nhật job, nếu có expected_status thì chỉ cập nhật khi job đang ở trạng thái đó"""
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        query = f"UPDATE jobs SET {columns} WHERE id = ?"
+        args = list(fields.values()) + [job_id]
+        if expected_status:
+            query += " AND status = ?"
+            args.append(expected_status)
+        with self.db_lock:
+            updated = self.db.execute(query, args).rowcount > 0
+        if not updated:
+            return False
+        with self.condition:
+            self.versions[job_id] = self.versions.get(job_id, 0) + 1
+            if fields.get('status') in FINISHED_STATUSES:
+                self.versions.pop(job_id, None)
+            self.condition.notify_all()
+        return True
+
+    def _worker_loop(self):
+        while True:
+            _, _, job_id = self.queue.get()
+            try:
+                self._run(job_id)
+            except Exception as e:
+                logger.exception(f"Lỗi không mong muốn khi chạy job {job_id}: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+    def _run(self, job_id):
+        job = self.get(job_id)
+        start = time.time()
+        if job is None or not self._update(job_id, expected_status=QUEUED, status=RUNNING, started_at=start):
+            # job đã bị hủy khi còn trong hàng đợi
+            return
+
+        handler = self.handlers.get(job['type'])
+        if handler is None:
+            self._update(job_id, status=FAILED, error=f"Loại job không được hỗ trợ: {job['type']}", finished_at=time.time())
+            return
+
+        logger.info(f"Bắt đầu job {job_id} ({job['type']}), đã chờ {start - job['created_at']:.2f}s")
+        try:
+            result = handler(JobContext(self, job_id, job['params']))
+            if job_id in self.cancel_requested:
+                raise JobCancelledError()
+            self._update(job_id, status=SUCCEEDED, result=json.dumps(result, ensure_ascii=False),
+                         progress=1.0, finished_at=time.time())
+            logger.info(f"Job {job_id} hoàn thành sau {time.time() - start:.2f}s")
+        except JobCancelledError:
+            self._update(job_id, status=CANCELLED, finished_at=time.time())
+            logger.info(f"Job {job_id} đã bị hủy")
+        except Exception as e:
+            logger.exception(f"Job {job_id} thất bại: {str(e)}")
+            self._update(job_id, status=FAILED, error=str(e), finished_at=time.time())
+        finally:
+            self.cancel_requested.discard(job_id)
+
+    @staticmethod
+    def _to_dict(row):
+        job = dict(row)
+        for name in ('params', 'result'):
+            job[name] = json.loads(job[name]) if job[name] else None
+        return job
@@ -0,0 +1,136 @@
+"""
+Chỉ mục file kết quả (tên file -> đường dẫn tuyệt đối) cho /api/download và /api/play-audio.
+
+Controller đăng ký file ngay khi ghi ra kết quả, lúc khởi động các thư mục kết quả được quét một
+lần ở nền để nhận các file có từ trước. Tra cứu là một lần đọc dict, không phụ thuộc số file trong
+thư mục results.
+"""
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+from models.se_cache import file_hash
+
+logger = logging.getLogger(__name__)
+
+# Chỉ các file âm thanh được lập chỉ mục khi quét (không để lộ jobs.db, file lịch sử... qua /api/download)
+AUDIO_EXTENSIONS = ('.wav', '.mp3', '.flac', '.ogg', '.m4a', '.aac', '.opus', '.webm')
+
+
+class ArtifactIndex:
+    def __init__(self):
+        self.paths = {}  # tên file -> đường dẫn tuyệt đối
+        self.lock = threading.Lock()
+        self.roots = []
+        self.ready = threading.Event()
+        # (đường dẫn, kích thước, mtime) -> ETag, để chỉ hash mỗi phiên bản file một lần
+        self.etags = OrderedDict()
+        self.max_etags = 10000
+
+    def add(self, path):
+        """Đăng ký file kết quả vừa ghi (ghi đè file cùng tên đã đăng ký trước đó)"""
+        if not path:
+            return
+        path = os.path.abspath(path)
+        with self.lock:
+            self.paths[os.path.basename(path)] = path
+
+    def remove(self, filename):
+        with self.lock:
+            self.paths.pop(filename, None)
+
+    def resolve(self, filename):
+        """Đường dẫn của file kết quả, None nếu không có"""
+        with self.lock:
+            path = self.paths.get(filename)
+        if path is not None:
+            if os.path.isfile(path):
+                return path
+            # File đã bị xóa khỏi đĩa
+            self.remove(filename)
+            return None
+
+        if not self.ready.is_set():
+            # Chưa quét xong lúc khởi động: kiểm tra trực tiếp trong các thư mục kết quả
+            for root in self.roots:
+                candidate = os.path.join(root, filename)
+                if filename.lower().endswith(AUDIO_EXTENSIONS) and os.path.isfile(candidate):
+                    return candidate
+        return None
+
+    def scan(self):
+        """
+        Quét các thư mục kết quả (không đệ quy) theo thứ tự ưu tiên: file cùng tên ở thư mục đứng
+        trước được dùng, file đã được controller đăng ký trong lúc quét không bị ghi đè
+        """
+        count = 0
+        for root in self.roots:
+            if not os.path.isdir(root):
+                continue
+            with os.scandir(root) as it:
+                batch = [(entry.name, entry.path) for entry in it
+                         if entry.is_file() and entry.name.lower().endswith(AUDIO_EXTENSIONS)]
+            with self.lock:
+                for name, path in batch:
+                    if name not in self.paths:
+                        self.paths[name] = path
+                        count += 1
+        self.ready.set()
+        logger.info(f"Da lap chi muc {count} file ket qua")
+
+    def start_scan(self, roots):
+        """Quét ở nền, trong lúc quét resolve() kiểm tra trực tiếp các thư mục kết quả"""
+        self.roots = [os.path.abspath(root) for root in roots]
+        threading.Thread(target=self.scan, name="artifact-scan", daemon=True).start()
+
+    def etag(self, path):
+        """ETag mạnh (hash nội dung) của file, đổi khi file bị ghi lại"""
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if key in self.etags:
+                self.etags.move_to_end(key)
+                return self.etags[key]
+        etag = file_hash(path)[:32]
+        with self.lock:
+            self.etags[key] = etag
+            while len(self.etags) > self.max_etags:
+                self.etags.popitem(last=False)
+        return etag
+
+    def __len__(self):
+        with self.lock:
+            return len(self.paths)
+
+
+class ListingCache:
+    """Kết quả liệt kê thư mục (danh sách giọng mẫu...), chỉ liệt kê lại khi mtime thư mục thay đổi"""
+
+    def __init__(self, dirs, loader):
+        self.dirs = dirs
+        self.loader = loader
+        self.lock = threading.Lock()
+        self.key = None
+        self.items = frozenset()
+
+    def get(self):
+        key = tuple(os.stat(d).st_mtime_ns if os.path.isdir(d) else None for d in self.dirs)
+        with self.lock:
+            if key != self.key:
+                self.items = frozenset(self.loader())
+                self.key = key
+            return self.items
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_artifact_index():
+    """Chỉ mục dùng chung trong process"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = ArtifactIndex()
+        return _index
@@ -0,0 +1,188 @@
+"""
+Registry ToneColorConverter dùng chung trong process.
+
+Mỗi checkpoint converter chỉ được khởi tạo và load_ckpt một lần rồi giữ trong bộ nhớ, các request
+dùng chung cùng một instance (chỉ suy luận nên có thể dùng đồng thời từ nhiều thread). Registry
+giới hạn tổng bộ nhớ các converter, bỏ converter ít dùng nhất khi vượt ngân sách và giải phóng
+converter không được dùng quá idle_timeout giây.
+"""
+import os
+import gc
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class _ConverterEntry:
+    def __init__(self, config_path, checkpoint_path):
+        self.config_path = config_path
+        self.checkpoint_path = checkpoint_path
+        self.converter = None
+        self.checkpoint_mtime = None
+        self.size_bytes = 0
+        self.refcount = 0  # số request đang dùng, không được giải phóng khi > 0
+        self.last_used = time.monotonic()
+        self.load_lock = threading.Lock()
+
+
+def _model_size(converter):
+    """Ước lượng bộ nhớ của converter (tham số + buffer của các model torch)"""
+    size = 0
+    for model in [getattr(converter, 'model', None), getattr(converter, 'watermark_model', None)]:
+        if model is None:
+            continue
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            size += tensor.numel() * tensor.element_size()
+    return size
+
+
+class ToneColorConverterRegistry:
+    def __init__(self, device='cpu', memory_budget_mb=1024, idle_timeout=1800):
+        """
+        Args:
+            device (str): Thiết bị chạy converter
+            memory_budget_mb (float): Tổng bộ nhớ tối đa cho các converter thường trú
+            idle_timeout (float): Giải phóng converter không dùng quá số giây này, 0 để giữ mãi
+        """
+        self.device = device
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.idle_timeout = idle_timeout
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        if self.idle_timeout:
+            sweeper = threading.Thread(target=self._sweep_loop, daemon=True)
+            sweeper.start()
+
+    @contextmanager
+    def use(self, config_path, checkpoint_path):
+        """
+        Lấy converter đã load sẵn (load ở lần đầu), converter không bị giải phóng khi đang dùng
+
+            with registry.use(config_path, checkpoint_path) as converter:
+                src_se = converter.extract_se([path])
+        """
+        entry = self._acquire(os.path.abspath(config_path), os.path.abspath(checkpoint_path))
+        try:
+            yield entry.converter
+        finally:
+            with self.lock:
+                entry.refcount -= 1
+                entry.last_used = time.monotonic()
+
+    def warm(self, config_path, checkpoint_path):
+        """Load trước một converter (gọi lúc khởi tạo controller)"""
+        with self.use(config_path, checkpoint_path):
+            pass
+
+    def _acquire(self, config_path, checkpoint_path):
+        key = (config_path, checkpoint_path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = _ConverterEntry(config_path, checkpoint_path)
+                self.entries[key] = entry
+            entry.refcount += 1
+
+        try:
+            # Chỉ một thread load mỗi checkpoint, các thread khác chờ rồi dùng chung
+            with entry.load_lock:
+                mtime = os.path.getmtime(checkpoint_path)
+                if entry.converter is None or entry.checkpoint_mtime != mtime:
+                    self._load(entry, mtime)
+        except Exception:
+            with self.lock:
+                entry.refcount -= 1
+                if entry.converter is None and entry.refcount == 0:
+                    self.entries.pop(key, None)
+            raise
+
+        entry.last_used = time.monotonic()
+        return entry
+
+    def _load(self, entry, mtime):
+        from openvoice.api import ToneColorConverter
+
+        start = time.perf_counter()
+        logger.info(f"Khoi tao ToneColorConverter, load checkpoint: {entry.checkpoint_path}")
+        converter = ToneColorConverter(entry.config_path, device=self.device)
+        converter.load_ckpt(entry.checkpoint_path)
+        size = _model_size(converter)
+
+        with self.lock:
+            entry.converter = converter
+            entry.checkpoint_mtime = mtime
+            entry.size_bytes = size
+            self._enforce_budget()
+        logger.info(f"Da load ToneColorConverter trong {time.perf_counter() - start:.2f}s "
+                    f"({size / 1024 / 1024:.1f}MB)")
+
+    def _loaded_size(self):
+        return sum(e.size_bytes for e in self.entries.values() if e.converter is not None)
+
+    def _enforce_budget(self):
+        """Giải phóng converter ít dùng nhất (không đang dùng) đến khi nằm trong ngân sách bộ nhớ"""
+        idle = sorted(
+            (e for e in self.entries.values() if e.refcount == 0 and e.converter is not None),
+            key=lambda e: e.last_used
+        )
+        while self._loaded_size() > self.memory_budget and idle:
+            self._unload(idle.pop(0))
+        if self._loaded_size() > self.memory_budget:
+            logger.warning(f"Cac converter dang dung vuot ngan sach bo nho: "
+                           f"{self._loaded_size() / 1024 / 1024:.1f}MB > {self.memory_budget / 1024 / 1024:.1f}MB")
+
+    def _unload(self, entry):
+        logger.info(f"Giai phong ToneColorConverter: {entry.checkpoint_path}")
+        self.entries.pop((entry.config_path, entry.checkpoint_path), None)
+        entry.converter = None
+
+    def evict_idle(self):
+        """Giải phóng các converter không được dùng quá idle_timeout giây"""
+        now = time.monotonic()
+        with self.lock:
+            expired = [e for e in self.entries.values()
+                       if e.refcount == 0 and e.converter is not None and now - e.last_used > self.idle_timeout]
+            for entry in expired:
+                self._unload(entry)
+        if expired:
+            gc.collect()
+
+    def _sweep_loop(self):
+        interval = max(1.0, self.idle_timeout / 4)
+        while True:
+            time.sleep(interval)
+            try:
+                self.evict_idle()
+            except Exception as e:
+                logger.error(f"Loi khi giai phong converter: {str(e)}")
+
+    def get_stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                'memory_budget_mb': self.memory_budget / 1024 / 1024,
+                'loaded_mb': self._loaded_size() / 1024 / 1024,
+                'converters': [{
+                    'checkpoint': e.checkpoint_path,
+                    'size_mb': e.size_bytes / 1024 / 1024,
+                    'in_use': e.refcount,
+                    'idle_seconds': now - e.last_used
+                } for e in self.entries.values() if e.converter is not None]
+            }
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_converter_registry(**kwargs):
+    """Registry dùng chung trong process (tham số chỉ có tác dụng ở lần gọi đầu tiên)"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ToneColorConverterRegistry(**kwargs)
+        return _registry
@@ -0,0 +1,197 @@
+"""
+Pool model MeloTTS theo ngôn ngữ.
+
+melo.api.TTS(language=...) load front-end BERT và model âm học của ngôn ngữ đó, rất chậm nên chỉ
+tạo một lần cho mỗi ngôn ngữ rồi giữ lại. Số ngôn ngữ thường trú có giới hạn, ngôn ngữ ít dùng
+nhất (và không đang được dùng) bị giải phóng trước.
+"""
+import gc
+import re
+import time
+import logging
+import threading
+import importlib.metadata
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def melo_version():
+    """Phiên bản package MeloTTS đã cài (None nếu không xác định được)"""
+    for dist in ('melotts', 'melo'):
+        try:
+            return importlib.metadata.version(dist)
+        except importlib.metadata.PackageNotFoundError:
+            continue
+    return None
+
+
+def melo_checkpoint_path(locale):
+    """
+    File checkpoint MeloTTS của ngôn ngữ trong cache HuggingFace (đường dẫn có mã revision), None
+    nếu chưa được tải. Không tải gì từ mạng.
+    """
+    try:
+        from huggingface_hub import hf_hub_download
+        from melo.download_utils import LANG_TO_HF_REPO_ID
+        return hf_hub_download(repo_id=LANG_TO_HF_REPO_ID[locale], filename="checkpoint.pth", local_files_only=True)
+    except Exception:
+        return None
+
+
+class _MeloEntry:
+    def __init__(self, locale):
+        self.locale = locale
+        self.model = None
+        self.refcount = 0
+        self.load_lock = threading.Lock()
+
+
+class MeloTTSPool:
+    def __init__(self, max_languages=2):
+        """
+        Args:
+            max_languages (int): Số ngôn ngữ tối đa giữ trong bộ nhớ
+        """
+        self.max_languages = max(1, int(max_languages))
+        self.entries = OrderedDict()  # locale -> _MeloEntry, theo thứ tự dùng gần nhất
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def use(self, locale):
+        """
+        Lấy model MeloTTS của locale (tạo ở lần đầu)
+
+            with pool.use("EN") as tts:
+                tts.tts_to_file(...)
+        """
+        entry = self._acquire(locale)
+        try:
+            yield entry.model
+        finally:
+            with self.lock:
+                entry.refcount -= 1
+                self._evict()
+
+    def preload(self, locales):
+        for locale in locales:
+            try:
+                with self.use(locale):
+                    pass
+            except Exception as e:
+                logger.warning(f"Khong the load truoc MeloTTS {locale}: {str(e)}")
+
+    def _acquire(self, locale):
+        with self.lock:
+            entry = self.entries.get(locale)
+            if entry is None:
+                entry = _MeloEntry(locale)
+                self.entries[locale] = entry
+            self.entries.move_to_end(locale)
+            entry.refcount += 1
+
+        try:
+            with entry.load_lock:
+                if entry.model is None:
+                    from melo.api import TTS
+                    start = time.perf_counter()
+                    # NGÔN NGỮ PHẢI VIẾT HOA
+                    logger.info(f"Khởi tạo MeloTTS với ngôn ngữ: {locale}")
+                    entry.model = TTS(language=locale)
+                    logger.info(f"Da load MeloTTS {locale} trong {time.perf_counter() - start:.2f}s")
+        except Exception:
+            with self.lock:
+                entry.refcount -= 1
+                if entry.model is None and entry.refcount == 0:
+                    self.entries.pop(locale, None)
+            raise
+        return entry
+
+    def _evict(self):
+        """Giải phóng ngôn ngữ ít dùng nhất khi vượt quá max_languages (gọi khi đang giữ self.lock)"""
+        evicted = False
+        for locale in list(self.entries):
+            if len(self.entries) <= self.max_languages:
+                break
+            entry = self.entries[locale]
+            if entry.refcount == 0:
+                logger.info(f"Giai phong MeloTTS {locale}")
+                del self.entries[locale]
+                entry.model = None
+                evicted = True
+        if evicted:
+            gc.collect()
+
+    def loaded_languages(self):
+        with self.lock:
+            return [locale for locale, entry in self.entries.items() if entry.model is not None]
+
+
+# Kết thúc câu: dấu câu Latin cần khoảng trắng phía sau, dấu câu CJK thì không
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+|(?<=[。！？；])')
+CLAUSE_END = re.compile(r'(?<=[,;:])\s+|(?<=[，、：])')
+CJK_CHAR = re.compile(r'[\u3000-\u9fff\uff00-\uffef]')
+
+
+def split_text(text, max_chars=500):
+    """
+    Tách văn bản (mọi ngôn ngữ MeloTTS hỗ trợ) thành các đoạn không quá max_chars ký tự,
+    ưu tiên cắt ở cuối câu, rồi đến dấu phẩy, cuối cùng là cắt cứng
+    """
+    pieces = []
+    for sentence in SENTENCE_END.split(text.strip()):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if len(sentence) <= max_chars:
+            pieces.append(sentence)
+            continue
+        for clause in CLAUSE_END.split(sentence):
+            clause = clause.strip()
+            while len(clause) > max_chars:
+                cut = clause.rfind(' ', 0, max_chars)
+                cut = cut if cut > 0 else max_chars
+                pieces.append(clause[:cut].strip())
+                clause = clause[cut:].strip()
+            if clause:
+                pieces.append(clause)
+
+    # Gộp các câu liên tiếp thành đoạn gần max_chars để giảm số lần gọi model
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + len(piece) + 1 > max_chars:
+            chunks.append(current)
+            current = piece
+        elif current:
+            # văn bản CJK không có khoảng trắng giữa các câu
+            separator = "" if CJK_CHAR.match(current[-1]) else " "
+            current = f"{current}{separator}{piece}"
+        else:
+            current = piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def crossfade_concat(segments, sample_rate, crossfade_ms=20):
+    """Nối các đoạn âm thanh, trộn chéo (crossfade) tuyến tính ở các điểm nối để không bị click"""
+    segments = [np.asarray(segment, dtype=np.float32) for segment in segments if len(segment) > 0]
+    if not segments:
+        return np.zeros(0, dtype=np.float32)
+    fade = int(sample_rate * crossfade_ms / 1000)
+    output = [segments[0]]
+    for segment in segments[1:]:
+        previous = output[-1]
+        n = min(fade, len(previous), len(segment))
+        if n > 0:
+            ramp = np.linspace(0.0, 1.0, n, dtype=np.float32)
+            joined = previous[-n:] * (1.0 - ramp) + segment[:n] * ramp
+            output[-1] = previous[:-n]
+            output.append(joined)
+            segment = segment[n:]
+        output.append(segment)
+    return np.concatenate(output)
@@ -6,14 +6,32 @@ import soundfile as sf
 import librosa
 import time
 import json
-import re
 from models.voice_model_interface import VoiceModelInterface
+from models.converter_registry import get_converter_registry
+from models.se_cache import SpeakerEmbeddingCache
+from models.result_cache import get_result_cache, make_key
+from models.artifact_index import get_artifact_index
+from concurrent.futures import ThreadPoolExecutor, wait
+from models.melo_pool import MeloTTSPool, split_text, crossfade_concat, melo_version, melo_checkpoint_path
 
 # Tắt GPU để tránh lỗi với GPU cũ
 os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 
 logger = logging.getLogger(__name__)
 
+# Ánh xạ tên ngôn ngữ sang locale code của MeloTTS (viết hoa)
+MELO_LANGUAGES = {
+    "english": "EN",
+    "chinese": "ZH",
+    "french": "FR",
+    "spanish": "ES",
+    "japanese": "JP",
+    "korean": "KR"
+}
+
+# Số ký tự tối đa của một đoạn văn bản đưa vào MeloTTS
+MELO_MAX_CHUNK_CHARS = 500
+
 class OpenVoiceController(VoiceModelInterface):
     def __init__(self):
         """Khởi tạo controller cho mô hình OpenVoice"""
@@ -85,6 +103,46 @@ class OpenVoiceController(VoiceModelInterface):
         except Exception as e:
             logger.warning(f"Không thể cài đặt các gói NLTK: {str(e)}")
         
+        # Converter được giữ thường trú trong registry dùng chung, load sẵn checkpoint mặc định
+        config = config or {}
+        self.converter_config_path = os.path.join(self.model_dir, "checkpoints_v2", "converter", "config.json")
+        self.converter_checkpoint_path = os.path.join(self.model_dir, "checkpoints_v2", "converter", "checkpoint.pth")
+        self.converter_registry = get_converter_registry(
+            device='cpu',
+            memory_budget_mb=float(config.get('converter_memory_budget_mb', os.environ.get("OPENVOICE_CONVERTER_BUDGET_MB", 1024))),
+            idle_timeout=float(config.get('converter_idle_timeout', os.environ.get("OPENVOICE_CONVERTER_IDLE_TIMEOUT", 1800)))
+        )
+        # Cache SE theo nội dung audio, lưu trên đĩa cạnh thư mục base_speakers/ses
+        self.se_cache = SpeakerEmbeddingCache(
+            os.path.join(self.model_dir, "checkpoints_v2", "base_speakers", "se_cache"),
+            max_items=int(config.get('se_cache_size', os.environ.get("OPENVOICE_SE_CACHE_SIZE", 256)))
+        )
+        # Cache kết quả theo nội dung yêu cầu (None nếu bị tắt bằng RESULT_CACHE_MAX_MB=0)
+        self.result_cache = get_result_cache()
+        # Chỉ mục file kết quả cho /api/download và /api/play-audio
+        self.artifacts = get_artifact_index()
+        
+        # Model MeloTTS được giữ lại theo ngôn ngữ, có thể load trước lúc khởi động
+        # (ví dụ OPENVOICE_MELO_PRELOAD="english,chinese")
+        self.melo_pool = MeloTTSPool(
+            max_languages=int(config.get('melo_max_languages', os.environ.get("OPENVOICE_MELO_MAX_LANGUAGES", 2)))
+        )
+        # Pool thread giới hạn để tổng hợp song song các đoạn của văn bản dài
+        self.melo_executor = ThreadPoolExecutor(
+            max_workers=int(config.get('melo_workers', os.environ.get("OPENVOICE_MELO_WORKERS", min(4, os.cpu_count() or 1)))),
+            thread_name_prefix="melotts"
+        )
+        preload_languages = config.get('melo_preload_languages', os.environ.get("OPENVOICE_MELO_PRELOAD", ""))
+        if isinstance(preload_languages, str):
+            preload_languages = [language.strip() for language in preload_languages.split(",") if language.strip()]
+        self.melo_pool.preload([self._melo_locale(language) for language in preload_languages])
+        
+        if os.path.exists(self.converter_checkpoint_path):
+            try:
+                self.converter_registry.warm(self.converter_config_path, self.converter_checkpoint_path)
+            except Exception as e:
+                logger.warning(f"Khong the load truoc ToneColorConverter: {str(e)}")
+        
         logger.info("Da khoi tao OpenVoice controller (CPU mode)")
         return True
         
@@ -145,6 +203,15 @@ class OpenVoiceController(VoiceModelInterface):
             target_voice_basename = os.path.splitext(os.path.basename(target_voice))[0]  # Lấy tên không có đuôi
             output_file = os.path.join(self.voice_conversion_dir, f"{filename}_openvoice_{target_voice_basename}.wav")  # Luôn dùng đuôi .wav
             
+            # Yêu cầu giống hệt (cùng nội dung audio, giọng đích, checkpoint, tau) thì dùng lại kết quả cũ
+            cache_key = None
+            if self.result_cache is not None and os.path.exists(target_voice):
+                cache_key = make_key('openvoice_vc', inputs=[input_file_path, target_voice],
+                                     models=[self.converter_checkpoint_path], params={'tau': tau})
+                if self.result_cache.fetch(cache_key, output_file):
+                    self.artifacts.add(output_file)
+                    return output_file
+            
             # Kiểm tra file âm thanh đầu vào
             logger.info("Kiểm tra và đảm bảo format âm thanh đầu vào hợp lệ")
             fixed_input = self._ensure_valid_audio(input_file_path)
@@ -154,16 +221,9 @@ class OpenVoiceController(VoiceModelInterface):
             import torch
             torch.set_num_threads(4)  # Giới hạn số thread để tránh quá tải
             
-            # Import và khởi tạo OpenVoice API
-            from openvoice.api import ToneColorConverter
-            
-            # Đường dẫn đến file cấu hình và checkpoint
-            config_path = os.path.join(self.model_dir, "checkpoints_v2", "converter", "config.json")
-            checkpoint_path = os.path.join(self.model_dir, "checkpoints_v2", "converter", "checkpoint.pth")
-            
             # Kiểm tra checkpoint tồn tại
-            if not os.path.exists(checkpoint_path):
-                logger.error(f"Khong tim thay checkpoint: {checkpoint_path}")
+            if not os.path.exists(self.converter_checkpoint_path):
+                logger.error(f"Khong tim thay checkpoint: {self.converter_checkpoint_path}")
                 return None
             
             # Kiểm tra file target_voice tồn tại
@@ -175,43 +235,47 @@ class OpenVoiceController(VoiceModelInterface):
             device = 'cpu'
             logger.info(f"Su dung thiet bi: {device}")
             
-            # Khởi tạo converter
-            logger.info("Khoi tao ToneColorConverter")
-            converter = ToneColorConverter(config_path, device=device)
-            
-            # Load checkpoint
-            logger.info(f"Dang load checkpoint: {checkpoint_path}")
-            converter.load_ckpt(checkpoint_path)
-            
-            # Trích xuất đặc trưng từ file nguồn
-            logger.info("Trích xuất đặc trưng từ file nguồn")
-            src_se = converter.extract_se([fixed_input])
-            
-            # Xử lý file target voice
-            if target_voice.endswith('.pth'):
-                # Nếu là file .pth, load trực tiếp đặc trưng giọng nói
-                logger.info(f"Đang load đặc trưng giọng nói từ file .pth: {target_voice}")
-                try:
-                    tgt_se = torch.load(target_voice, map_location=device)
-                    logger.info("Đã load thành công đặc trưng giọng nói từ file .pth")
-                except Exception as e:
-                    logger.error(f"Lỗi khi load file .pth: {str(e)}")
-                    return None
-            else:
-                # Nếu là file âm thanh, trích xuất đặc trưng
-                logger.info(f"Trích xuất đặc trưng từ file âm thanh: {target_voice}")
-                fixed_target = self._ensure_valid_audio(target_voice)
-                tgt_se = converter.extract_se([fixed_target])
-            
-            # Chuyển đổi và lưu kết quả
-            logger.info(f"Chuyển đổi giọng nói với tau={tau}")
-            converter.convert(
-                audio_src_path=fixed_input,
-                src_se=src_se,
-                tgt_se=tgt_se,
-                output_path=output_file,
-                tau=tau
-            )
+            # Lấy converter thường trú (checkpoint đã được load sẵn)
+            with self.converter_registry.use(self.converter_config_path, self.converter_checkpoint_path) as converter:
+                start = time.perf_counter()
+                
+                # Trích xuất đặc trưng từ file nguồn (bỏ qua nếu file này đã có trong cache SE)
+                logger.info("Trích xuất đặc trưng từ file nguồn")
+                src_se = self.se_cache.get(
+                    converter, self.converter_checkpoint_path, input_file_path,
+                    prepare=lambda _: fixed_input
+                )
+                
+                # Xử lý file target voice
+                if target_voice.endswith('.pth'):
+                    # Nếu là file .pth, load trực tiếp đặc trưng giọng nói
+                    logger.info(f"Đang load đặc trưng giọng nói từ file .pth: {target_voice}")
+                    try:
+                        tgt_se = torch.load(target_voice, map_location=device)
+                        logger.info("Đã load thành công đặc trưng giọng nói từ file .pth")
+                    except Exception as e:
+                        logger.error(f"Lỗi khi load file .pth: {str(e)}")
+                        return None
+                else:
+                    # Nếu là file âm thanh, trích xuất đặc trưng (chỉ chuẩn hóa và trích xuất khi cache miss)
+                    logger.info(f"Trích xuất đặc trưng từ file âm thanh: {target_voice}")
+                    tgt_se = self.se_cache.get(
+                        converter, self.converter_checkpoint_path, target_voice,
+                        prepare=self._ensure_valid_audio
+                    )
+                extract_time = time.perf_counter() - start
+                
+                # Chuyển đổi và lưu kết quả
+                logger.info(f"Chuyển đổi giọng nói với tau={tau}")
+                start = time.perf_counter()
+                converter.convert(
+                    audio_src_path=fixed_input,
+                    src_se=src_se,
+                    tgt_se=tgt_se,
+                    output_path=output_file,
+                    tau=tau
+                )
+                logger.info(f"Thoi gian extract_se: {extract_time:.2f}s, convert: {time.perf_counter() - start:.2f}s")
             
             # Kiểm tra kết quả
             if os.path.exists(output_file):
@@ -228,8 +292,12 @@ class OpenVoiceController(VoiceModelInterface):
                         logger.warning("Biên độ âm thanh quá nhỏ!")
                     else:
                         logger.info(f"Biên độ âm thanh hợp lệ: {max_amplitude:.4f}")
+                
+                if cache_key:
+                    self.result_cache.put(cache_key, output_file)
             
             logger.info(f"Chuyển đổi thành công: {output_file}")
+            self.artifacts.add(output_file)
             return output_file
             
         except Exception as e:
@@ -280,6 +348,17 @@ class OpenVoiceController(VoiceModelInterface):
             
             logger.info(f"Su dung speaker embedding: {speaker_path}")
             
+            # Cùng văn bản, speaker, ngôn ngữ, tốc độ và checkpoint (converter và MeloTTS) thì dùng lại kết quả cũ
+            cache_key = None
+            if self.result_cache is not None:
+                locale = self._melo_locale(language)
+                cache_key = make_key('openvoice_tts', inputs=[speaker_path],
+                                     models=[self.converter_checkpoint_path, melo_checkpoint_path(locale)],
+                                     params={'text': text, 'locale': locale, 'speed': speed, 'melo': melo_version()})
+                if self.result_cache.fetch(cache_key, output_file):
+                    self.artifacts.add(output_file)
+                    return output_file
+            
             # ---------- PHƯƠNG PHÁP 1: Sử dụng MeloTTS + OpenVoice ----------
             logger.info("Phương pháp 1: Dùng MeloTTS kết hợp OpenVoice")
             
@@ -291,37 +370,33 @@ class OpenVoiceController(VoiceModelInterface):
                 
                 # Phương pháp tương tự convert_voice nhưng ít tham số điều chỉnh hơn
                 try:
-                    from openvoice.api import ToneColorConverter
-                    
-                    # Đường dẫn đến file cấu hình và checkpoint
-                    config_path = os.path.join(self.model_dir, "checkpoints_v2", "converter", "config.json")
-                    checkpoint_path = os.path.join(self.model_dir, "checkpoints_v2", "converter", "checkpoint.pth")
-                    
                     # Sử dụng CPU
                     device = 'cpu'
                     
-                    # Khởi tạo converter
-                    converter = ToneColorConverter(config_path, device=device)
-                    converter.load_ckpt(checkpoint_path)
-                    
-                    # Trích xuất đặc trưng từ file nguồn
-                    src_se = converter.extract_se([temp_result])
-                    
-                    # Load đặc trưng giọng nói đích
-                    tgt_se = torch.load(speaker_path, map_location=device)
-                    
-                    # Chuyển đổi và lưu kết quả (tau=0.7 để giữ nội dung rõ ràng)
-                    converter.convert(
-                        audio_src_path=temp_result,
-                        src_se=src_se,
-                        tgt_se=tgt_se,
-                        output_path=output_file,
-                        tau=0.7
-                    )
+                    # Lấy converter thường trú (checkpoint đã được load sẵn)
+                    with self.converter_registry.use(self.converter_config_path, self.converter_checkpoint_path) as converter:
+                        # Trích xuất đặc trưng từ file nguồn
+                        src_se = converter.extract_se([temp_result])
+                        
+                        # Load đặc trưng giọng nói đích
+                        tgt_se = torch.load(speaker_path, map_location=device)
+                        
+                        # Chuyển đổi và lưu kết quả (tau=0.7 để giữ nội dung rõ ràng)
+                        converter.convert(
+                            audio_src_path=temp_result,
+                            src_se=src_se,
+                            tgt_se=tgt_se,
+                            output_path=output_file,
+                            tau=0.7
+                        )
                     
                     # Kiểm tra kết quả
                     if os.path.exists(output_file):
                         logger.info(f"TTS thành công, đã lưu kết quả tại: {output_file}")
+                        # Chỉ cache kết quả đầy đủ, không cache kết quả tạm khi bước OpenVoice lỗi
+                        if cache_key:
+                            self.result_cache.put(cache_key, output_file)
+                        self.artifacts.add(output_file)
                         return output_file
                     
                 except Exception as e:
@@ -331,6 +406,7 @@ class OpenVoiceController(VoiceModelInterface):
                     # Sao chép file từ thư mục tạm sang thư mục tts
                     import shutil
                     shutil.copy(temp_result, output_file)
+                    self.artifacts.add(output_file)
                     return output_file
             
             return None
@@ -341,10 +417,19 @@ class OpenVoiceController(VoiceModelInterface):
             logger.error(traceback.format_exc())
             return None
             
+    def _melo_locale(self, language):
+        """Tên ngôn ngữ (english...) hoặc locale (EN...) -> locale MeloTTS, mặc định EN"""
+        if language.upper() in MELO_LANGUAGES.values():
+            return language.upper()
+        return MELO_LANGUAGES.get(language.lower(), "EN")
+
     def generate_speech_with_melotts(self, text, language, speed):
         """
         Tạo âm thanh từ văn bản sử dụng thư viện MeloTTS
         
+        Văn bản dài được tách thành các đoạn theo câu (mọi ngôn ngữ), các đoạn được tổng hợp song song
+        trên pool thread giới hạn, giữ trong bộ nhớ rồi nối lại (crossfade) thành một file duy nhất.
+        
         Args:
             text (str): Văn bản cần chuyển đổi
             language (str): Ngôn ngữ của văn bản
@@ -354,124 +439,59 @@ class OpenVoiceController(VoiceModelInterface):
             str: Đường dẫn đến file âm thanh tạm
         """
         try:
-            # Thử import MeloTTS
-            from melo.api import TTS
-            
-            # Ánh xạ tên ngôn ngữ sang locale code (viết hoa)
-            language_map = {
-                "english": "EN",
-                "chinese": "ZH",
-                "french": "FR",
-                "spanish": "ES",
-                "japanese": "JP",
-                "korean": "KR"
-            }
-            locale = language_map.get(language.lower(), "EN")
+            locale = self._melo_locale(language)
             
             # Tạo tạm file âm thanh tạm
             temp_file = os.path.join(self.temp_dir, f"temp_tts_{int(time.time())}.wav")
             
-            # Khởi tạo TTS với ngôn ngữ - NGÔN NGỮ PHẢI VIẾT HOA
-            logger.info(f"Khởi tạo MeloTTS với ngôn ngữ: {locale}")
-            tts = TTS(language=locale)
-            
-            # Phân đoạn văn bản nếu quá dài để tránh lỗi
-            if len(text) > 500:
-                logger.info(f"Văn bản quá dài ({len(text)} ký tự), phân đoạn để xử lý...")
-                audio_segments = []
+            # Phân đoạn văn bản theo câu để tránh lỗi với văn bản dài
+            chunks = split_text(text, max_chars=MELO_MAX_CHUNK_CHARS)
+            if len(chunks) > 1:
+                logger.info(f"Văn bản dài ({len(text)} ký tự), đã phân đoạn thành {len(chunks)} đoạn văn bản")
+            
+            # Lấy model MeloTTS của ngôn ngữ từ pool (chỉ khởi tạo ở lần đầu) - NGÔN NGỮ PHẢI VIẾT HOA
+            with self.melo_pool.use(locale) as tts:
+                def synthesize(i, chunk):
+                    logger.info(f"Xử lý đoạn {i+1}/{len(chunks)}: {chunk[:50]}...")
+                    # output_path=None: MeloTTS trả về mảng âm thanh thay vì ghi file
+                    return tts.tts_to_file(
+                        text=chunk,
+                        speaker_id=0,  # speaker_id=0 là giá trị mặc định
+                        output_path=None,
+                        speed=speed,
+                        sdp_ratio=0.2,
+                        noise_scale=0.6
+                    )
                 
-                # Phân đoạn theo dấu câu
-                if language.lower() == "english":
-                    # Sử dụng biểu thức chính quy để tách câu tiếng Anh
-                    sentences = re.split(r'(?<=[.!?])\s+', text)
-                    
-                    # Nhóm các câu thành đoạn nhỏ hơn 500 ký tự
-                    chunks = []
-                    current_chunk = ""
-                    
-                    for sentence in sentences:
-                        if len(current_chunk) + len(sentence) < 500:
-                            current_chunk += (" " if current_chunk else "") + sentence
-                        else:
-                            if current_chunk:
-                                chunks.append(current_chunk)
-                            current_chunk = sentence
-                    
-                    if current_chunk:
-                        chunks.append(current_chunk)
-                        
-                    logger.info(f"Đã phân đoạn thành {len(chunks)} đoạn văn bản")
-                    
-                    # Xử lý từng đoạn và nối lại
-                    temp_files = []
-                    for i, chunk in enumerate(chunks):
-                        chunk_file = os.path.join(self.temp_dir, f"temp_tts_chunk_{i}_{int(time.time())}.wav")
-                        logger.info(f"Xử lý đoạn {i+1}/{len(chunks)}: {chunk[:50]}...")
-                        
+                start = time.perf_counter()
+                if len(chunks) == 1:
+                    futures = []
+                    segments = [synthesize(0, chunks[0])]
+                else:
+                    futures = [self.melo_executor.submit(synthesize, i, chunk) for i, chunk in enumerate(chunks)]
+                    segments = []
+                    for i, future in enumerate(futures):
                         try:
-                            tts.tts_to_file(
-                                text=chunk, 
-                                speaker_id=0,
-                                output_path=chunk_file,
-                                speed=speed,
-                                sdp_ratio=0.2,
-                                noise_scale=0.6
-                            )
-                            temp_files.append(chunk_file)
+                            segments.append(future.result())
                         except Exception as chunk_err:
                             logger.error(f"Lỗi khi xử lý đoạn {i+1}: {str(chunk_err)}")
-                    
-                    # Nối các file âm thanh lại
-                    if temp_files:
-                        import numpy as np
-                        from scipy.io import wavfile
-                        
-                        audio_data = []
-                        sample_rate = None
-                        
-                        for tf in temp_files:
-                            try:
-                                sr, data = wavfile.read(tf)
-                                if sample_rate is None:
-                                    sample_rate = sr
-                                audio_data.append(data)
-                            except Exception as e:
-                                logger.error(f"Lỗi khi đọc file {tf}: {str(e)}")
-                        
-                        if audio_data and sample_rate:
-                            combined = np.concatenate(audio_data)
-                            wavfile.write(temp_file, sample_rate, combined)
-                            logger.info(f"Đã nối {len(temp_files)} đoạn âm thanh thành công")
-                            
-                            # Xóa các file tạm
-                            for tf in temp_files:
-                                try:
-                                    os.remove(tf)
-                                except:
-                                    pass
-                            
-                            return temp_file
-                    
-                    # Nếu xử lý đoạn không thành công, thử xử lý cả văn bản
-                    logger.warning("Xử lý phân đoạn không thành công, thử xử lý nguyên văn bản...")
-                
-                # Đối với các ngôn ngữ khác hoặc nếu phân đoạn tiếng Anh thất bại
-                else:
-                    logger.warning(f"Không hỗ trợ phân đoạn cho ngôn ngữ {language}, cắt ngắn văn bản...")
-                    text = text[:500]  # Cắt ngắn văn bản
-            
-            # Xử lý văn bản (nguyên bản hoặc đã cắt ngắn)
-            logger.info(f"Tạo file âm thanh với text: {text[:100]}...")
-            tts.tts_to_file(
-                text=text, 
-                speaker_id=0,  # speaker_id=0 là giá trị mặc định
-                output_path=temp_file,
-                speed=speed,
-                sdp_ratio=0.2,
-                noise_scale=0.6
-            )
-            
-            logger.info(f"Đã tạo file âm thanh tạm: {temp_file}")
+                            # Bỏ các đoạn chưa chạy và chờ các đoạn đang chạy xong trước khi trả model về pool
+                            for other in futures[i + 1:]:
+                                other.cancel()
+                            wait(futures)
+                            segments = None
+                            break
+                sample_rate = tts.hps.data.sampling_rate
+            
+            # Không trả về âm thanh thiếu đoạn (kết quả sẽ bị lưu vào result cache)
+            if not segments:
+                logger.error("Không tổng hợp được đầy đủ các đoạn văn bản")
+                return None
+            
+            audio = crossfade_concat(segments, sample_rate)
+            sf.write(temp_file, audio, sample_rate)
+            logger.info(f"Đã tạo file âm thanh tạm: {temp_file} ({len(segments)} đoạn, "
+                        f"{len(audio) / sample_rate:.1f}s âm thanh trong {time.perf_counter() - start:.2f}s)")
             return temp_file
             
         except Exception as e:
@@ -0,0 +1,165 @@
+"""
+Cache kết quả chuyển đổi giọng nói / TTS theo nội dung.
+
+Khóa là hash của nội dung âm thanh đầu vào (hoặc văn bản), phiên bản model (đường dẫn, kích thước,
+mtime của file model) và các tham số, nên cùng một yêu cầu được gửi lại (kể cả khác tên file) sẽ
+dùng lại kết quả cũ mà không cần chạy model. File kết quả được lưu trong results/cache, tổng dung
+lượng có giới hạn, file ít dùng nhất bị xóa trước.
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from models.se_cache import file_hash
+
+logger = logging.getLogger(__name__)
+
+
+def model_version(path):
+    """Định danh phiên bản file model mà không phải hash cả file (file model thường rất lớn)"""
+    if not path or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def make_key(kind, inputs=(), models=(), params=None):
+    """
+    Args:
+        kind (str): Loại yêu cầu (openvoice_vc, openvoice_tts, rvc_vc...)
+        inputs (list): File âm thanh đầu vào, được hash theo nội dung
+        models (list): File model/checkpoint, dùng model_version
+        params (dict): Các tham số còn lại (văn bản, tau, f0up_key...)
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps({
+        'kind': kind,
+        'inputs': [file_hash(path) for path in inputs],
+        'models': [model_version(path) for path in models],
+        'params': params or {}
+    }, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3):
+        """
+        Args:
+            cache_dir (str): Thư mục lưu file kết quả đã cache
+            max_bytes (int): Tổng dung lượng tối đa của cache trên đĩa
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # tên file -> kích thước, theo thứ tự dùng gần nhất
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Dựng lại thứ tự LRU từ mtime (được cập nhật mỗi lần cache hit)
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+            elif os.path.isfile(path):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total_bytes += size
+
+    def fetch(self, key, output_file):
+        """
+        Nếu key có trong cache, sao chép kết quả đã cache ra output_file và trả về True. Không dùng
+        hard link vì các model ghi đè output_file tại chỗ, sẽ làm hỏng luôn file trong cache.
+        """
+        name = f"{key}{os.path.splitext(output_file)[1]}"
+        path = os.path.join(self.cache_dir, name)
+        with self.lock:
+            if name not in self.entries or not os.path.exists(path):
+                self.misses += 1
+                return False
+            self.entries.move_to_end(name)
+            self.hits += 1
+
+        tmp_path = f"{output_file}.{threading.get_ident()}.tmp"
+        try:
+            os.utime(path)
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, output_file)
+        except OSError as e:
+            logger.warning(f"Khong lay duoc ket qua tu cache {name}: {str(e)}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        logger.info(f"Result cache hit: {os.path.basename(output_file)}")
+        return True
+
+    def put(self, key, result_file):
+        """Lưu file kết quả vào cache (bỏ qua nếu file lớn hơn cả dung lượng cache)"""
+        size = os.path.getsize(result_file)
+        if size > self.max_bytes:
+            return
+        name = f"{key}{os.path.splitext(result_file)[1]}"
+        path = os.path.join(self.cache_dir, name)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            shutil.copyfile(result_file, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Khong ghi duoc result cache {name}: {str(e)}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        with self.lock:
+            self.total_bytes -= self.entries.pop(name, 0)
+            self.entries[name] = size
+            self.total_bytes += size
+            self._evict()
+
+    def _evict(self):
+        """Xóa file ít dùng nhất đến khi nằm trong giới hạn dung lượng (gọi khi đang giữ self.lock)"""
+        while self.total_bytes > self.max_bytes and self.entries:
+            name, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size_mb': self.total_bytes / 1024 / 1024,
+                'max_mb': self.max_bytes / 1024 / 1024,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """
+    Cache dùng chung trong process, cấu hình bằng RESULT_CACHE_MAX_MB (mặc định 2048, 0 để tắt).
+    Trả về None nếu cache bị tắt.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            max_mb = float(os.environ.get('RESULT_CACHE_MAX_MB', 2048))
+            if max_mb <= 0:
+                return None
+            cache_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'results', 'cache'))
+            _cache = ResultCache(cache_dir, max_bytes=int(max_mb * 1024 * 1024))
+        return _cache
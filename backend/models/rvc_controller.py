@@ -6,9 +6,17 @@ import subprocess
 import shutil
 import datetime
 import torch
-import json
 import time
-import glob
+import json
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from models.rvc_worker import get_worker_pool
+from models.result_cache import get_result_cache, make_key
+from models.artifact_index import get_artifact_index, AUDIO_EXTENSIONS
+from models.uvr_pool import get_uvr_pool
+from models.se_cache import file_hash
+from database import add_history
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +44,33 @@ class RVCController:
         os.makedirs(self.weights_dir, exist_ok=True)
         os.makedirs(self.logs_dir, exist_ok=True)
         
+        # Pool worker RVC thường trú (giữ HuBERT, model giọng và index trong bộ nhớ)
+        # RVC_NUM_WORKERS=0 để quay lại chạy tools/infer_cli.py cho mỗi lần chuyển đổi
+        self.num_workers = int(os.environ.get("RVC_NUM_WORKERS", 1))
+        self.max_resident_voices = int(os.environ.get("RVC_MAX_RESIDENT_VOICES", 4))
+        # Số worker riêng cho chuyển đổi hàng loạt (0: dùng chung pool RVC_NUM_WORKERS)
+        self.batch_workers = int(os.environ.get("RVC_BATCH_WORKERS", 0))
+        
+        # Model UVR5 thường trú: giới hạn bộ nhớ và danh sách model load sẵn lúc khởi động
+        # (ví dụ UVR_PRELOAD="HP2_all_vocals,HP5_only_main_vocal")
+        self.uvr_memory_budget_mb = float(os.environ.get("UVR_MEMORY_BUDGET_MB", 2048))
+        self.uvr_preload = [name.strip() for name in os.environ.get("UVR_PRELOAD", "").split(",") if name.strip()]
+        # Số lần tách giọng chạy song song (mặc định bằng số nhân CPU)
+        self.uvr_workers = int(os.environ.get("UVR_WORKERS", 0)) or None
+        # File dài hơn UVR_WINDOWED_MIN_SECONDS được tách theo từng cửa sổ UVR_WINDOW_SECONDS giây
+        # (chồng lấn UVR_WINDOW_OVERLAP_SECONDS giây) để bộ nhớ không tăng theo độ dài file
+        self.uvr_windowed_min_seconds = float(os.environ.get("UVR_WINDOWED_MIN_SECONDS", 600))
+        self.uvr_window_seconds = float(os.environ.get("UVR_WINDOW_SECONDS", 30))
+        self.uvr_window_overlap_seconds = float(os.environ.get("UVR_WINDOW_OVERLAP_SECONDS", 1))
+        if not 0 <= self.uvr_window_overlap_seconds < self.uvr_window_seconds:
+            raise ValueError("UVR_WINDOW_OVERLAP_SECONDS phải nhỏ hơn UVR_WINDOW_SECONDS "
+                             f"({self.uvr_window_overlap_seconds} >= {self.uvr_window_seconds})")
+        
+        # Cache kết quả theo nội dung yêu cầu (None nếu bị tắt bằng RESULT_CACHE_MAX_MB=0)
+        self.result_cache = get_result_cache()
+        # Chỉ mục file kết quả cho /api/download và /api/play-audio
+        self.artifacts = get_artifact_index()
+        
         # Kiểm tra xem mô hình đã được cài đặt chưa
         self.is_model_available = self._check_model_available()
         
@@ -66,7 +101,8 @@ class RVCController:
     
     def convert_voice(self, input_file_path, target_voice, f0up_key=0, index_rate=0.5, protect=0.33, rms_mix_rate=0.25):
         """
-        Chuyển đổi giọng nói từ file âm thanh đầu vào sang giọng nói đích sử dụng RVC CLI
+        Chuyển đổi giọng nói từ file âm thanh đầu vào sang giọng nói đích, trên pool worker RVC thường trú
+        (hoặc RVC CLI nếu pool bị tắt / không khởi động được)
         """
         if not self.is_model_available:
             logger.error("Không thể chuyển đổi: Mô hình RVC chưa được cài đặt")
@@ -90,52 +126,27 @@ class RVCController:
             # Đường dẫn tuyệt đối cho input
             input_path = os.path.abspath(input_file_path)
 
-            # Đường dẫn model và index: chỉ lấy tên file
-            model_name = os.path.basename(model_path)
-            index_name = os.path.basename(index_path) if index_path else ""
-
-            # Đường dẫn tới CLI script
-            cli_script = os.path.join(self.model_dir, 'tools', 'infer_cli.py')
-            cli_script = os.path.abspath(cli_script)
-
-            # Thiết lập các tham số cho CLI
-            cmd = [
-                sys.executable,
-                cli_script,
-                "--input_path", input_path,
-                "--opt_path", output_file,
-                "--model_name", model_name,
-                "--f0up_key", str(f0up_key),
-                "--index_rate", str(index_rate),
-                "--protect", str(protect),
-                "--rms_mix_rate", str(rms_mix_rate),
-            ]
-            if index_name:
-                cmd.extend(["--index_path", index_name])
-
-            logger.info(f"Đang chạy lệnh CLI: {' '.join(cmd)}")
-
-            # Thực thi và lấy kết quả
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                cwd=self.model_dir
-            )
-            stdout, stderr = process.communicate()
-
-            logger.info(f"Kết quả CLI stdout: {stdout}")
-            if stderr:
-                logger.error(f"Kết quả CLI stderr: {stderr}")
+            # Yêu cầu giống hệt (cùng nội dung audio, model, index và tham số) thì dùng lại kết quả cũ
+            cache_key = None
+            if self.result_cache is not None:
+                cache_key = make_key('rvc_vc', inputs=[input_path], models=[model_path, index_path], params={
+                    'f0up_key': f0up_key,
+                    'index_rate': index_rate,
+                    'protect': protect,
+                    'rms_mix_rate': rms_mix_rate
+                })
 
-            if process.returncode != 0:
-                logger.error(f"Lỗi khi chạy CLI, mã trả về: {process.returncode}")
-                return None
+            if not (cache_key and self.result_cache.fetch(cache_key, output_file)):
+                if not self._run_conversion(input_path, output_file, model_path, index_path,
+                                            f0up_key, index_rate, protect, rms_mix_rate):
+                    return None
+                if cache_key and os.path.exists(output_file):
+                    self.result_cache.put(cache_key, output_file)
 
             # Kiểm tra xem file kết quả có tồn tại không
             if os.path.exists(output_file):
                 logger.info(f"Đã tạo file kết quả: {output_file}")
+                self.artifacts.add(output_file)
                 
                 # Lưu thông tin vào lịch sử chuyển đổi
                 self._save_conversion_history(input_file_path, target_voice, output_file, {
@@ -151,51 +162,158 @@ class RVCController:
                 return None
 
         except Exception as e:
-            logger.exception(f"Lỗi khi xử lý RVC CLI: {str(e)}")
+            logger.exception(f"Lỗi khi chuyển đổi giọng nói RVC: {str(e)}")
             return None
     
+    def get_worker_pool(self):
+        """Pool worker RVC dùng chung trong process, khởi động ở lần gọi đầu tiên (None nếu tắt hoặc lỗi)"""
+        if self.num_workers <= 0 or not self.is_model_available:
+            return None
+        return get_worker_pool(
+            self.model_dir,
+            num_workers=self.num_workers,
+            max_voices=self.max_resident_voices,
+            log_dir=self.logs_dir
+        )
+
+    def get_batch_pool(self):
+        """Pool worker cho chuyển đổi hàng loạt: pool riêng RVC_BATCH_WORKERS worker nếu có cấu hình"""
+        if self.batch_workers <= 0 or not self.is_model_available:
+            return self.get_worker_pool()
+        return get_worker_pool(
+            self.model_dir,
+            name='batch',
+            num_workers=self.batch_workers,
+            max_voices=self.max_resident_voices,
+            log_dir=self.logs_dir
+        )
+    
+    def get_worker_stats(self):
+        """Thời gian trung bình từng bước và trạng thái các worker RVC"""
+        pool = self.get_worker_pool()
+        return pool.get_stats() if pool is not None else None
+
+    def get_uvr_pool(self):
+        """Pool bộ tách UVR5 thường trú dùng chung trong process"""
+        is_half = torch.cuda.is_available()
+        device = "cuda" if is_half else "cpu"
+        return get_uvr_pool(
+            model_dir=self.model_dir,
+            device=device,
+            is_half=is_half,
+            memory_budget_mb=self.uvr_memory_budget_mb,
+            max_workers=self.uvr_workers
+        )
+
+    def warm_uvr_models(self):
+        """Load trước các model UVR5 trong UVR_PRELOAD"""
+        if not self.uvr_preload or not self.is_model_available:
+            return
+        uvr5_weights_dir = os.path.join(self.model_dir, 'assets', 'uvr5_weights')
+        self.get_uvr_pool().warm([(name, os.path.join(uvr5_weights_dir, f"{name}.pth")) for name in self.uvr_preload])
+
+    def _run_conversion(self, input_path, output_file, model_path, index_path,
+                        f0up_key, index_rate, protect, rms_mix_rate):
+        """Chạy chuyển đổi trên pool worker RVC, hoặc RVC CLI nếu pool bị tắt"""
+        pool = self.get_worker_pool()
+        if pool is not None:
+            result = pool.convert(
+                input_path,
+                output_file,
+                model_path,
+                index_path,
+                f0up_key=f0up_key,
+                index_rate=index_rate,
+                protect=protect,
+                rms_mix_rate=rms_mix_rate
+            )
+            logger.info(f"Thời gian xử lý RVC (giây): {result['timings']}")
+            if not result['ok']:
+                logger.error(f"Lỗi khi chuyển đổi trên worker RVC: {result['error']}")
+                return False
+            return True
+        return self._convert_voice_cli(input_path, output_file, model_path, index_path,
+                                       f0up_key, index_rate, protect, rms_mix_rate)
+
+    def _convert_voice_cli(self, input_path, output_file, model_path, index_path,
+                           f0up_key, index_rate, protect, rms_mix_rate):
+        """Chuyển đổi bằng tools/infer_cli.py trong một process mới (khi không dùng pool worker)"""
+        # Đường dẫn model và index: chỉ lấy tên file
+        model_name = os.path.basename(model_path)
+        index_name = os.path.basename(index_path) if index_path else ""
+
+        # Đường dẫn tới CLI script
+        cli_script = os.path.join(self.model_dir, 'tools', 'infer_cli.py')
+        cli_script = os.path.abspath(cli_script)
+
+        # Thiết lập các tham số cho CLI
+        cmd = [
+            sys.executable,
+            cli_script,
+            "--input_path", input_path,
+            "--opt_path", output_file,
+            "--model_name", model_name,
+            "--f0up_key", str(f0up_key),
+            "--index_rate", str(index_rate),
+            "--protect", str(protect),
+            "--rms_mix_rate", str(rms_mix_rate),
+        ]
+        if index_name:
+            cmd.extend(["--index_path", index_name])
+
+        logger.info(f"Đang chạy lệnh CLI: {' '.join(cmd)}")
+
+        # Thực thi và lấy kết quả
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            cwd=self.model_dir
+        )
+        stdout, stderr = process.communicate()
+
+        logger.info(f"Kết quả CLI stdout: {stdout}")
+        if stderr:
+            logger.error(f"Kết quả CLI stderr: {stderr}")
+
+        if process.returncode != 0:
+            logger.error(f"Lỗi khi chạy CLI, mã trả về: {process.returncode}")
+            return False
+        return True
+
     def _save_conversion_history(self, input_file_path, target_voice, output_file, params=None):
         """Lưu thông tin chuyển đổi vào lịch sử"""
         try:
-            history_file = os.path.join(self.voice_conversion_dir, 'conversion_history.json')
-            
-            # Tạo bản ghi mới
-            history_entry = {
+            add_history('conversion', {
                 'timestamp': time.time(),
                 'source_file': os.path.basename(input_file_path),
                 'target_voice': target_voice,
+                'model_used': 'rvc',
                 'result_file': os.path.basename(output_file),
                 'result_url': f"/api/download/{os.path.basename(output_file)}",
                 'params': params or {}
-            }
-            
-            # Đọc lịch sử hiện tại
-            history = []
-            if os.path.exists(history_file):
-                try:
-                    with open(history_file, 'r', encoding='utf-8') as f:
-                        history = json.load(f)
-                except Exception as e:
-                    logger.error(f"Lỗi khi đọc file lịch sử: {str(e)}")
-                    history = []
-            
-            # Thêm bản ghi mới và lưu lại
-            history.append(history_entry)
-            with open(history_file, 'w', encoding='utf-8') as f:
-                json.dump(history, f, ensure_ascii=False, indent=2)
+            }, model='rvc')
                 
             logger.info(f"Đã lưu thông tin chuyển đổi vào lịch sử: {os.path.basename(output_file)}")
             
         except Exception as e:
             logger.error(f"Lỗi khi lưu lịch sử chuyển đổi: {str(e)}")
     
-    def separate_vocals(self, input_file_path, model_name=None, vocal_type='vocals'):
-        """Tách giọng nói khỏi âm nhạc sử dụng UVR5"""
+    def separate_vocals(self, input_file_path, model_name=None, vocal_type='vocals', windowed=None, progress=None,
+                        job_id=None):
+        """
+        Tách giọng nói khỏi âm nhạc sử dụng UVR5
+
+        Args:
+            job_id (str): Mã job, dùng trong tên file kết quả (mặc định tạo mới)
+            windowed (bool): Tách theo từng cửa sổ (None: tự chọn theo độ dài file)
+            progress (callable): progress(số cửa sổ đã xong, tổng số cửa sổ)
+        """
         if not self.is_model_available:
             logger.error("Không thể tách giọng: Mô hình RVC chưa được cài đặt")
             return None
         
-        # Tạo tên file kết quả cố định
         base_name = os.path.basename(input_file_path)
         filename, ext = os.path.splitext(base_name)
         
@@ -206,9 +324,6 @@ class RVCController:
         os.makedirs(instrumental_dir, exist_ok=True)
         
         try:
-            # Lưu thư mục hiện tại
-            original_dir = os.getcwd()
-            
             # Chuyển đổi đường dẫn input thành đường dẫn tuyệt đối
             input_file_abs_path = os.path.abspath(input_file_path)
             
@@ -216,123 +331,95 @@ class RVCController:
                 logger.error(f"File đầu vào không tồn tại: {input_file_abs_path}")
                 return None
             
+            # Chọn model UVR5
+            if model_name is None:
+                model_name = "HP2_all_vocals"
+            
+            # Đường dẫn đến mô hình UVR5
+            uvr5_weights_dir = os.path.join(self.model_dir, 'assets', 'uvr5_weights')
+            model_path = os.path.join(uvr5_weights_dir, f"{model_name}.pth")
+            
+            if not os.path.exists(model_path) and not model_name.startswith("onnx_"):
+                logger.error(f"Không tìm thấy mô hình UVR5: {model_path}")
+                available_models = self.list_uvr_models()
+                logger.info(f"Các mô hình khả dụng: {available_models}")
+                if len(available_models) > 0:
+                    model_name = available_models[0]
+                    model_path = os.path.join(uvr5_weights_dir, f"{model_name}.pth")
+                    logger.info(f"Sử dụng mô hình thay thế: {model_name}")
+                else:
+                    logger.error("Không có mô hình UVR5 nào khả dụng")
+                    return None
+            
+            # Log thông tin xử lý
+            logger.info(f"Tách giọng nói từ file: {input_file_abs_path}")
+            logger.info(f"Sử dụng mô hình: {model_name}")
+            logger.info(f"Thư mục vocals: {vocals_dir}")
+            logger.info(f"Thư mục instrumental: {instrumental_dir}")
+            
+            # Kiểm tra xem model có phải là HP3 không
+            is_hp3 = "HP3" in model_name
+            
+            # Tên file kết quả cố định, riêng cho mỗi job: tên gốc + mã job + hash nội dung đầu vào
+            stem_id = f"{filename}_{(job_id or uuid.uuid4().hex)[:12]}_{file_hash(input_file_abs_path)[:12]}"
+            outputs = {
+                'vocals': os.path.join(vocals_dir, f"vocal_{stem_id}.wav"),
+                'instrumental': os.path.join(instrumental_dir, f"instrument_{stem_id}.wav")
+            }
+            
+            if windowed is None:
+                windowed = self._uvr_duration(input_file_abs_path) > self.uvr_windowed_min_seconds
+            
+            # Xử lý âm thanh và trích xuất giọng nói trên bộ tách thường trú (chỉ load .pth ở lần đầu),
+            # chạy trên executor của pool nên nhiều request có thể tách giọng song song
             try:
-                # Chuyển đến thư mục RVC
-                os.chdir(self.model_dir)
-                
-                # Thêm thư mục RVC vào sys.path
-                if self.model_dir not in sys.path:
-                    sys.path.insert(0, self.model_dir)
-                
-                # Chọn model UVR5
-                if model_name is None:
-                    model_name = "HP2_all_vocals"
-                
-                # Đường dẫn đến mô hình UVR5
-                uvr5_weights_dir = os.path.join(self.model_dir, 'assets', 'uvr5_weights')
-                model_path = os.path.join(uvr5_weights_dir, f"{model_name}.pth")
-                
-                if not os.path.exists(model_path) and not model_name.startswith("onnx_"):
-                    logger.error(f"Không tìm thấy mô hình UVR5: {model_path}")
-                    available_models = self.list_uvr_models()
-                    logger.info(f"Các mô hình khả dụng: {available_models}")
-                    if len(available_models) > 0:
-                        model_name = available_models[0]
-                        model_path = os.path.join(uvr5_weights_dir, f"{model_name}.pth")
-                        logger.info(f"Sử dụng mô hình thay thế: {model_name}")
-                    else:
-                        logger.error("Không có mô hình UVR5 nào khả dụng")
-                        return None
-                
-                # Thiết lập weight_uvr5_root cho infer/modules/uvr5/modules.py
-                os.environ["weight_uvr5_root"] = uvr5_weights_dir
-                
-                # Log thông tin xử lý
-                logger.info(f"Tách giọng nói từ file: {input_file_abs_path}")
-                logger.info(f"Sử dụng mô hình: {model_name}")
-                logger.info(f"Thư mục vocals: {vocals_dir}")
-                logger.info(f"Thư mục instrumental: {instrumental_dir}")
-                
-                # Kiểm tra xem có phải là DeEcho model không
-                use_deecho = "DeEcho" in model_name
-                
-                # Tạo đối tượng xử lý âm thanh
-                from infer.modules.uvr5.vr import AudioPre, AudioPreDeEcho
-                
-                # Kiểm tra GPU
-                is_half = torch.cuda.is_available()
-                device = "cuda" if torch.cuda.is_available() else "cpu"
-                logger.info(f"Sử dụng thiết bị: {device}, half precision: {is_half}")
-                
-                # Tạo đối tượng xử lý tương ứng
-                processor_class = AudioPreDeEcho if use_deecho else AudioPre
-                audio_processor = processor_class(
-                    agg=0,  # Mức độ xử lý (0-100)
-                    model_path=model_path,
-                    device=device,
-                    is_half=is_half
-                )
-                
-                # Kiểm tra xem model có phải là HP3 không
-                is_hp3 = "HP3" in model_name
-                
-                # Xử lý âm thanh và trích xuất giọng nói
-                try:
-                    result = audio_processor._path_audio_(
-                        input_file_abs_path,  # Đường dẫn tuyệt đối đầu vào
-                        instrumental_dir,     # Thư mục cho nhạc nền
-                        vocals_dir,           # Thư mục cho giọng hát
-                        "wav",                # Định dạng xuất
-                        is_hp3=is_hp3         # Có phải là HP3 không
+                if windowed:
+                    logger.info(f"Tach giong theo cua so {self.uvr_window_seconds}s "
+                                f"(chong lan {self.uvr_window_overlap_seconds}s)")
+                    _, load_time, separate_time = self.get_uvr_pool().separate_windowed(
+                        model_name, model_path, input_file_abs_path, outputs, is_hp3=is_hp3,
+                        window_seconds=self.uvr_window_seconds,
+                        overlap_seconds=self.uvr_window_overlap_seconds,
+                        progress=progress
                     )
-                    logger.info(f"Kết quả xử lý âm thanh: {result}")
-                except Exception as e:
-                    logger.exception(f"Lỗi khi xử lý âm thanh: {str(e)}")
-                    return None
-                
-                # Tìm các file kết quả từ UVR5
-                result_files = self._find_uvr_output_files(vocals_dir, instrumental_dir, filename)
-                
-                if result_files:
-                    # Sử dụng trực tiếp các file kết quả từ UVR5 thay vì tạo bản sao
-                    vocals_output = result_files.get('vocals')
-                    instrumental_output = result_files.get('instrumental')
-                    
-                    if vocals_output and instrumental_output:
-                        # Cập nhật lịch sử UVR
-                        self._save_uvr_history(input_file_path, model_name, vocals_output, instrumental_output)
-                        
-                        # Ghi log đường dẫn đầy đủ để debug
-                        logger.info(f"UVR Result - vocals: {vocals_output}")
-                        logger.info(f"UVR Result - instrumental: {instrumental_output}")
-                        
-                        # Trả về đường dẫn các file kết quả
-                        return {
-                            'vocals': vocals_output,
-                            'instrumental': instrumental_output
-                        }
-                    else:
-                        logger.error("Không tìm thấy đủ file vocals và instrumental từ UVR5")
-                        return None
                 else:
-                    logger.error("Không tìm thấy file kết quả từ UVR5")
-                    return None
-                
-            finally:
-                # Quay lại thư mục ban đầu
-                os.chdir(original_dir)
+                    _, load_time, separate_time = self.get_uvr_pool().separate(
+                        model_name, model_path, input_file_abs_path, outputs, is_hp3=is_hp3
+                    )
+                    if progress:
+                        progress(1, 1)
+                logger.info(f"Thoi gian UVR5 - lay model: {load_time:.2f}s, tach giong: {separate_time:.2f}s")
+            except Exception as e:
+                logger.exception(f"Lỗi khi xử lý âm thanh: {str(e)}")
+                return None
+            
+            self.artifacts.add(outputs['vocals'])
+            self.artifacts.add(outputs['instrumental'])
+            
+            # Cập nhật lịch sử UVR
+            self._save_uvr_history(input_file_path, model_name, outputs['vocals'], outputs['instrumental'])
+            
+            logger.info(f"UVR Result - vocals: {outputs['vocals']}")
+            logger.info(f"UVR Result - instrumental: {outputs['instrumental']}")
+            return outputs
                 
         except Exception as e:
             logger.exception(f"Lỗi khi tách giọng nói: {str(e)}")
             return None
         
+    def _uvr_duration(self, input_path):
+        """Độ dài file (giây) đọc từ header, 0 nếu soundfile không đọc được định dạng này"""
+        try:
+            import soundfile as sf
+            return sf.info(input_path).duration
+        except Exception as e:
+            logger.warning(f"Khong doc duoc do dai file {input_path}, tach ca file: {str(e)}")
+            return 0
+    
     def _save_uvr_history(self, input_file_path, model_name, vocals_output, instrumental_output):
         """Lưu thông tin tách giọng nói vào lịch sử"""
         try:
-            history_file = os.path.join(self.uvr_results_dir, 'uvr_history.json')
-            
-            # Tạo bản ghi mới với đường dẫn file thực tế
-            history_entry = {
+            add_history('uvr', {
                 'timestamp': time.time(),
                 'source_file': os.path.basename(input_file_path),
                 'model_name': model_name,
@@ -340,92 +427,13 @@ class RVCController:
                 'vocals_url': f"/api/download/{os.path.basename(vocals_output)}",
                 'instrumental_file': os.path.basename(instrumental_output),
                 'instrumental_url': f"/api/download/{os.path.basename(instrumental_output)}"
-            }
-            
-            # Đọc lịch sử hiện tại
-            history = []
-            if os.path.exists(history_file):
-                try:
-                    with open(history_file, 'r', encoding='utf-8') as f:
-                        history = json.load(f)
-                except Exception as e:
-                    logger.error(f"Lỗi khi đọc file lịch sử UVR: {str(e)}")
-                    history = []
-            
-            # Thêm bản ghi mới và lưu lại
-            history.append(history_entry)
-            with open(history_file, 'w', encoding='utf-8') as f:
-                json.dump(history, f, ensure_ascii=False, indent=2)
+            }, model=model_name)
                 
             logger.info(f"Đã lưu thông tin tách giọng nói vào lịch sử UVR")
         
         except Exception as e:
             logger.error(f"Lỗi khi lưu lịch sử UVR: {str(e)}")
     
-    def _find_uvr_output_files(self, vocals_dir, instrumental_dir, filename):
-        """Tìm các file được tạo ra sau khi tách giọng với UVR5"""
-        # Các định dạng tên file cần kiểm tra
-        vocals_patterns = [
-            os.path.join(vocals_dir, f"vocals_{filename}_*.wav"),
-            os.path.join(vocals_dir, f"{filename}_vocals*.wav"),
-            os.path.join(vocals_dir, f"{filename}_v*.wav"),
-            os.path.join(vocals_dir, f"vocal_{filename}*.wav"),
-            os.path.join(vocals_dir, 'uvr_output', f"{filename}*.wav"),
-            os.path.join(vocals_dir, 'uvr_output', f"vocals_{filename}*.wav")
-        ]
-        
-        instrumental_patterns = [
-            os.path.join(instrumental_dir, f"instrument_{filename}_*.wav"),
-            os.path.join(instrumental_dir, f"{filename}_instruments*.wav"),
-            os.path.join(instrumental_dir, f"{filename}_i*.wav"),
-            os.path.join(instrumental_dir, 'uvr_output', f"instrument_{filename}*.wav"),
-            os.path.join(instrumental_dir, 'uvr_output', f"instruments_{filename}*.wav")
-        ]
-        
-        # Kết quả
-        results = {}
-        
-        # Kiểm tra các mẫu file vocal
-        for pattern in vocals_patterns:
-            matches = glob.glob(pattern)
-            if matches:
-                # Lấy file mới nhất nếu có nhiều kết quả
-                latest_file = max(matches, key=os.path.getctime)
-                logger.info(f"Tìm thấy file vocal: {latest_file}")
-                results['vocals'] = latest_file
-                break
-                
-        # Kiểm tra các mẫu file instrumental
-        for pattern in instrumental_patterns:
-            matches = glob.glob(pattern)
-            if matches:
-                # Lấy file mới nhất nếu có nhiều kết quả
-                latest_file = max(matches, key=os.path.getctime)
-                logger.info(f"Tìm thấy file instrumental: {latest_file}")
-                results['instrumental'] = latest_file
-                break
-        
-        # Nếu không tìm thấy, kiểm tra tất cả các file trong thư mục
-        if 'vocals' not in results:
-            logger.info(f"Kiểm tra tất cả file trong thư mục: {vocals_dir}")
-            for root, _, files in os.walk(vocals_dir):
-                for file in files:
-                    if filename in file and file.endswith(".wav"):
-                        results['vocals'] = os.path.join(root, file)
-                        logger.info(f"Đã tìm thấy file vocals: {results['vocals']}")
-                        break
-        
-        if 'instrumental' not in results:
-            logger.info(f"Kiểm tra tất cả file trong thư mục: {instrumental_dir}")
-            for root, _, files in os.walk(instrumental_dir):
-                for file in files:
-                    if filename in file and file.endswith(".wav"):
-                        results['instrumental'] = os.path.join(root, file)
-                        logger.info(f"Đã tìm thấy file instrumental: {results['instrumental']}")
-                        break
-            
-        return results
-    
     def _find_model_path(self, target_voice):
         """Tìm đường dẫn đến model dựa trên tên target voice"""
         # Tìm kiếm trong thư mục models
@@ -565,28 +573,23 @@ class RVCController:
             logger.info(f"Đang chạy lệnh dung hợp mô hình: {' '.join(cmd)}")
             
             # Thực thi và lấy kết quả
-            original_dir = os.getcwd()
-            try:
-                os.chdir(self.model_dir)
-                
-                process = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
-                stdout, stderr = process.communicate()
-                
-                # Log kết quả
-                logger.info(f"Kết quả từ quá trình dung hợp mô hình: {stdout}")
-                if stderr:
-                    logger.error(f"Lỗi từ quá trình dung hợp mô hình: {stderr}")
-                
-                if process.returncode != 0:
-                    logger.error(f"Lỗi khi dung hợp mô hình, mã trả về: {process.returncode}")
-                    return None
-            finally:
-                os.chdir(original_dir)
+            process = subprocess.Popen(
+                cmd,
+                cwd=self.model_dir,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True
+            )
+            stdout, stderr = process.communicate()
+            
+            # Log kết quả
+            logger.info(f"Kết quả từ quá trình dung hợp mô hình: {stdout}")
+            if stderr:
+                logger.error(f"Lỗi từ quá trình dung hợp mô hình: {stderr}")
+            
+            if process.returncode != 0:
+                logger.error(f"Lỗi khi dung hợp mô hình, mã trả về: {process.returncode}")
+                return None
                 
             # Kiểm tra mô hình mới có tồn tại không
             # RVC thường lưu mô hình vào thư mục weights
@@ -654,28 +657,23 @@ class RVCController:
             logger.info(f"Đang chạy lệnh xuất mô hình ONNX: {' '.join(cmd)}")
             
             # Thực thi và lấy kết quả
-            original_dir = os.getcwd()
-            try:
-                os.chdir(self.model_dir)
-                
-                process = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
-                stdout, stderr = process.communicate()
-                
-                # Log kết quả
-                logger.info(f"Kết quả từ quá trình xuất ONNX: {stdout}")
-                if stderr:
-                    logger.error(f"Lỗi từ quá trình xuất ONNX: {stderr}")
-                
-                if process.returncode != 0:
-                    logger.error(f"Lỗi khi xuất ONNX, mã trả về: {process.returncode}")
-                    return None
-            finally:
-                os.chdir(original_dir)
+            process = subprocess.Popen(
+                cmd,
+                cwd=self.model_dir,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True
+            )
+            stdout, stderr = process.communicate()
+            
+            # Log kết quả
+            logger.info(f"Kết quả từ quá trình xuất ONNX: {stdout}")
+            if stderr:
+                logger.error(f"Lỗi từ quá trình xuất ONNX: {stderr}")
+            
+            if process.returncode != 0:
+                logger.error(f"Lỗi khi xuất ONNX, mã trả về: {process.returncode}")
+                return None
                 
             # Kiểm tra xem có file ONNX được tạo ra không
             if os.path.exists(onnx_output_dir) and len(os.listdir(onnx_output_dir)) > 0:
@@ -690,7 +688,8 @@ class RVCController:
             logger.error(traceback.format_exc())
             return None
             
-    def batch_convert(self, input_dir, target_voice, f0up_key=0, index_rate=0.5, protect=0.33, rms_mix_rate=0.25):
+    def batch_convert(self, input_dir, target_voice, f0up_key=0, index_rate=0.5, protect=0.33, rms_mix_rate=0.25,
+                      output_dir=None):
         """
         Chuyển đổi hàng loạt các file âm thanh trong một thư mục
         
@@ -701,112 +700,146 @@ class RVCController:
             index_rate (float): Tỷ lệ áp dụng index feature, từ 0.0 đến 1.0
             protect (float): Bảo vệ tiếng nổi (consonants), từ 0.0 đến 0.5
             rms_mix_rate (float): Tỷ lệ trộn RMS, từ 0.0 đến 1.0
+            output_dir (str): Thư mục của lần chuyển đổi trước để chạy tiếp (mặc định tạo mới)
             
         Returns:
             dict: Dictionary chứa đường dẫn đến các file kết quả nếu thành công, None nếu thất bại
         """
-        if not self.is_model_available:
-            logger.error("Không thể chuyển đổi hàng loạt: Mô hình RVC chưa được cài đặt")
-            return None
-            
-        # Kiểm tra thư mục đầu vào
-        if not os.path.exists(input_dir) or not os.path.isdir(input_dir):
-            logger.error(f"Thư mục đầu vào không tồn tại: {input_dir}")
-            return None
-            
+        result_files = {}
+        errors = 0
         try:
-            # Tìm đường dẫn đến mô hình và index
-            model_path = self._find_model_path(target_voice)
-            index_path = self._find_index_path(target_voice)
-            
-            if not model_path:
-                logger.error(f"Không tìm thấy mô hình cho {target_voice}")
-                return None
-                
-            # Tạo thư mục đầu ra
-            output_dir = os.path.join(self.results_dir, f"batch_{target_voice}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}")
-            os.makedirs(output_dir, exist_ok=True)
-            
-            # Gọi trực tiếp đến infer-web.py với tab batch inference
-            infer_web_path = os.path.join(self.model_dir, "infer-web.py")
-            
-            # Kiểm tra và giới hạn các tham số
-            f0up_key = int(f0up_key)  # Đảm bảo là số nguyên
-            
-            # Giới hạn index_rate trong khoảng [0, 1]
-            index_rate = max(0.0, min(1.0, float(index_rate)))
-            
-            # Giới hạn protect trong khoảng [0, 0.5]
-            protect = max(0.0, min(0.5, float(protect)))
-            
-            # Giới hạn rms_mix_rate trong khoảng [0, 1]
-            rms_mix_rate = max(0.0, min(1.0, float(rms_mix_rate)))
-            
-            # Thiết lập tham số cho batch inference
-            cmd = [
-                sys.executable,
-                infer_web_path,
-                "--tab", "1",                  # Tab 1 là 批量推理 (batch inference)
-                "--dir_path", input_dir,       # Thư mục chứa file đầu vào
-                "--opt", output_dir,           # Thư mục đầu ra
-                "--model_name", model_path,    # Đường dẫn đến mô hình
-                "--index_rate", str(index_rate),
-                "--f0up_key", str(f0up_key),
-                "--filter_radius", "3",
-                "--resample_sr", "0",
-                "--rms_mix_rate", str(rms_mix_rate),
-                "--protect", str(protect)
-            ]
-            
-            # Thêm index path nếu có
-            if index_path:
-                cmd.extend(["--index_path", index_path])
-                
-            logger.info(f"Đang chạy lệnh chuyển đổi hàng loạt: {' '.join(cmd)}")
-            
-            # Thực thi và lấy kết quả
-            original_dir = os.getcwd()
-            try:
-                os.chdir(self.model_dir)
-                
-                process = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
-                stdout, stderr = process.communicate()
-                
-                # Log kết quả
-                logger.info(f"Kết quả từ quá trình chuyển đổi hàng loạt: {stdout}")
-                if stderr:
-                    logger.error(f"Lỗi từ quá trình chuyển đổi hàng loạt: {stderr}")
-                
-                if process.returncode != 0:
-                    logger.error(f"Lỗi khi chuyển đổi hàng loạt, mã trả về: {process.returncode}")
-                    return None
-            finally:
-                os.chdir(original_dir)
-                
-            # Kiểm tra kết quả trong thư mục đầu ra
-            if os.path.exists(output_dir) and len(os.listdir(output_dir)) > 0:
-                # Thu thập các file kết quả
-                result_files = {}
-                for file in os.listdir(output_dir):
-                    file_path = os.path.join(output_dir, file)
-                    if os.path.isfile(file_path):
-                        result_files[file] = file_path
-                        
-                logger.info(f"Đã chuyển đổi hàng loạt thành công: {len(result_files)} file")
-                return result_files
-            else:
-                logger.error(f"Không tìm thấy file kết quả sau khi chuyển đổi hàng loạt")
-                return None
-                
+            for item in self.iter_batch_convert(input_dir, target_voice, f0up_key, index_rate, protect,
+                                                rms_mix_rate, output_dir=output_dir):
+                if item['ok']:
+                    result_files[os.path.basename(item['output'])] = item['output']
+                else:
+                    errors += 1
         except Exception as e:
             logger.exception(f"Lỗi khi chuyển đổi hàng loạt: {str(e)}")
-            logger.error(traceback.format_exc())
             return None
+        
+        if not result_files:
+            logger.error(f"Không tìm thấy file kết quả sau khi chuyển đổi hàng loạt")
+            return None
+        logger.info(f"Đã chuyển đổi hàng loạt thành công: {len(result_files)} file, {errors} file lỗi")
+        return result_files
+    
+    def iter_batch_convert(self, input_dir, target_voice, f0up_key=0, index_rate=0.5, protect=0.33,
+                           rms_mix_rate=0.25, output_dir=None):
+        """
+        Chuyển đổi hàng loạt trên pool worker RVC (mỗi worker load model và index một lần), trả về
+        kết quả của từng file ngay khi file đó xong.
+        
+        Các file đã xong được ghi vào batch_manifest.jsonl trong thư mục đầu ra, truyền lại
+        output_dir đó để chạy tiếp một lần chuyển đổi bị dừng giữa chừng (bỏ qua các file đã xong).
+        
+        Yields:
+            dict: {'file', 'ok', 'output', 'error', 'timings', 'resumed'}
+        """
+        if not self.is_model_available:
+            raise RuntimeError("Mô hình RVC chưa được cài đặt")
+        if not os.path.isdir(input_dir):
+            raise FileNotFoundError(f"Thư mục đầu vào không tồn tại: {input_dir}")
+        
+        model_path = self._find_model_path(target_voice)
+        index_path = self._find_index_path(target_voice)
+        if not model_path:
+            raise FileNotFoundError(f"Không tìm thấy mô hình cho {target_voice}")
+        
+        # Kiểm tra và giới hạn các tham số
+        params = {
+            'f0up_key': int(f0up_key),
+            'index_rate': max(0.0, min(1.0, float(index_rate))),
+            'protect': max(0.0, min(0.5, float(protect))),
+            'rms_mix_rate': max(0.0, min(1.0, float(rms_mix_rate)))
+        }
+        header = {'input_dir': os.path.abspath(input_dir), 'target_voice': target_voice, 'params': params}
+        
+        if output_dir is None:
+            output_dir = os.path.join(self.results_dir, f"batch_{target_voice}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}")
+        os.makedirs(output_dir, exist_ok=True)
+        manifest_path = os.path.join(output_dir, "batch_manifest.jsonl")
+        
+        # Đọc manifest của lần chạy trước (nếu có)
+        done = {}
+        if os.path.exists(manifest_path):
+            lines = []
+            dropped = 0
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        lines.append(json.loads(line))
+                    except ValueError:
+                        # Dòng ghi dở khi process bị dừng giữa chừng
+                        dropped += 1
+            if dropped:
+                logger.warning(f"Bo qua {dropped} dong hong trong {manifest_path}")
+                # Ghi lại manifest chỉ với các dòng hợp lệ để dòng ghi thêm sau không bị dính vào dòng hỏng
+                tmp_path = f"{manifest_path}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    for entry in lines:
+                        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                os.replace(tmp_path, manifest_path)
+            if lines and lines[0] != header:
+                raise ValueError(f"Thư mục {output_dir} thuộc một lần chuyển đổi với tham số khác")
+            done = {entry['file']: entry for entry in lines[1:]
+                    if isinstance(entry, dict) and entry.get('ok') and entry.get('output')
+                    and os.path.exists(entry['output'])}
+        
+        files = sorted(name for name in os.listdir(input_dir)
+                       if name.lower().endswith(AUDIO_EXTENSIONS) and os.path.isfile(os.path.join(input_dir, name)))
+        pending = [name for name in files if name not in done]
+        logger.info(f"Chuyển đổi hàng loạt {len(files)} file sang {target_voice}, "
+                    f"{len(done)} file đã xong trước đó, đầu ra: {output_dir}")
+        
+        for name in files:
+            if name in done:
+                yield dict(done[name], resumed=True)
+        if not pending:
+            return
+        
+        pool = self.get_batch_pool()
+        manifest_lock = threading.Lock()
+        manifest = open(manifest_path, 'a', encoding='utf-8')
+        if manifest.tell() == 0:
+            manifest.write(json.dumps(header, ensure_ascii=False) + "\n")
+            manifest.flush()
+        
+        def convert_one(name):
+            input_path = os.path.join(input_dir, name)
+            output_path = os.path.join(output_dir, name if name.lower().endswith('.wav') else f"{name}.wav")
+            if pool is not None:
+                result = pool.convert(input_path, output_path, model_path, index_path, **params)
+                entry = {'file': name, 'ok': result['ok'], 'output': output_path,
+                         'error': result.get('error'), 'timings': result['timings']}
+            else:
+                ok = self._convert_voice_cli(input_path, output_path, model_path, index_path, **params)
+                entry = {'file': name, 'ok': bool(ok), 'output': output_path,
+                         'error': None if ok else "RVC CLI thất bại", 'timings': {}}
+            with manifest_lock:
+                manifest.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                manifest.flush()
+            return entry
+        
+        # Mỗi thread giữ một worker RVC, nên số thread bằng số worker để dùng hết các worker
+        executor = ThreadPoolExecutor(max_workers=pool.num_workers if pool is not None else 1,
+                                      thread_name_prefix="rvc-batch")
+        try:
+            futures = {executor.submit(convert_one, name): name for name in pending}
+            for future in as_completed(futures):
+                try:
+                    entry = future.result()
+                except Exception as e:
+                    entry = {'file': futures[future], 'ok': False, 'output': None, 'error': str(e), 'timings': {}}
+                if not entry['ok']:
+                    logger.error(f"Lỗi khi chuyển đổi {entry['file']}: {entry['error']}")
+                yield dict(entry, resumed=False)
+        finally:
+            # Dừng sớm (generator bị đóng) thì bỏ các file chưa bắt đầu, chạy tiếp được nhờ manifest
+            executor.shutdown(wait=True, cancel_futures=True)
+            manifest.close()
             
     def show_model_info(self, model_name):
         """
@@ -848,28 +881,23 @@ class RVCController:
             logger.info(f"Đang chạy lệnh xem thông tin mô hình: {' '.join(cmd)}")
             
             # Thực thi và lấy kết quả
-            original_dir = os.getcwd()
-            try:
-                os.chdir(self.model_dir)
-                
-                process = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
-                stdout, stderr = process.communicate()
-                
-                # Log kết quả
-                logger.info(f"Kết quả từ quá trình xem thông tin mô hình: {stdout}")
-                if stderr:
-                    logger.error(f"Lỗi từ quá trình xem thông tin mô hình: {stderr}")
-                
-                if process.returncode != 0:
-                    logger.error(f"Lỗi khi xem thông tin mô hình, mã trả về: {process.returncode}")
-                    return None
-            finally:
-                os.chdir(original_dir)
+            process = subprocess.Popen(
+                cmd,
+                cwd=self.model_dir,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True
+            )
+            stdout, stderr = process.communicate()
+            
+            # Log kết quả
+            logger.info(f"Kết quả từ quá trình xem thông tin mô hình: {stdout}")
+            if stderr:
+                logger.error(f"Lỗi từ quá trình xem thông tin mô hình: {stderr}")
+            
+            if process.returncode != 0:
+                logger.error(f"Lỗi khi xem thông tin mô hình, mã trả về: {process.returncode}")
+                return None
                 
             # Phân tích thông tin mô hình từ kết quả
             model_info = {}
@@ -947,28 +975,23 @@ class RVCController:
             logger.info(f"Đang chạy lệnh sửa thông tin mô hình: {' '.join(cmd)}")
             
             # Thực thi và lấy kết quả
-            original_dir = os.getcwd()
-            try:
-                os.chdir(self.model_dir)
-                
-                process = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
-                stdout, stderr = process.communicate()
-                
-                # Log kết quả
-                logger.info(f"Kết quả từ quá trình sửa thông tin mô hình: {stdout}")
-                if stderr:
-                    logger.error(f"Lỗi từ quá trình sửa thông tin mô hình: {stderr}")
-                
-                if process.returncode != 0:
-                    logger.error(f"Lỗi khi sửa thông tin mô hình, mã trả về: {process.returncode}")
-                    return None
-            finally:
-                os.chdir(original_dir)
+            process = subprocess.Popen(
+                cmd,
+                cwd=self.model_dir,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True
+            )
+            stdout, stderr = process.communicate()
+            
+            # Log kết quả
+            logger.info(f"Kết quả từ quá trình sửa thông tin mô hình: {stdout}")
+            if stderr:
+                logger.error(f"Lỗi từ quá trình sửa thông tin mô hình: {stderr}")
+            
+            if process.returncode != 0:
+                logger.error(f"Lỗi khi sửa thông tin mô hình, mã trả về: {process.returncode}")
+                return None
                 
             # Kiểm tra mô hình mới có tồn tại không
             # RVC thường lưu mô hình với thông tin mới vào thư mục weights
@@ -1049,28 +1072,23 @@ class RVCController:
             logger.info(f"Đang chạy lệnh trích xuất mô hình nhỏ: {' '.join(cmd)}")
             
             # Thực thi và lấy kết quả
-            original_dir = os.getcwd()
-            try:
-                os.chdir(self.model_dir)
-                
-                process = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
-                stdout, stderr = process.communicate()
-                
-                # Log kết quả
-                logger.info(f"Kết quả từ quá trình trích xuất mô hình nhỏ: {stdout}")
-                if stderr:
-                    logger.error(f"Lỗi từ quá trình trích xuất mô hình nhỏ: {stderr}")
-                
-                if process.returncode != 0:
-                    logger.error(f"Lỗi khi trích xuất mô hình nhỏ, mã trả về: {process.returncode}")
-                    return None
-            finally:
-                os.chdir(original_dir)
+            process = subprocess.Popen(
+                cmd,
+                cwd=self.model_dir,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True
+            )
+            stdout, stderr = process.communicate()
+            
+            # Log kết quả
+            logger.info(f"Kết quả từ quá trình trích xuất mô hình nhỏ: {stdout}")
+            if stderr:
+                logger.error(f"Lỗi từ quá trình trích xuất mô hình nhỏ: {stderr}")
+            
+            if process.returncode != 0:
+                logger.error(f"Lỗi khi trích xuất mô hình nhỏ, mã trả về: {process.returncode}")
+                return None
                 
             # Kiểm tra mô hình mới có tồn tại không
             # RVC thường lưu mô hình trích xuất vào thư mục weights
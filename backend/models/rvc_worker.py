@@ -0,0 +1,494 @@
+"""
+Pool worker RVC chạy thường trú.
+
+Mỗi worker là một process Python riêng, khởi động một lần: import torch, load HuBERT,
+sau đó giữ các model giọng (.pth) và file index FAISS đã load trong bộ nhớ (theo tên giọng,
+LRU). Controller gửi job qua kênh IPC cục bộ (Unix socket / named pipe của
+multiprocessing.connection) và nhận lại kết quả cùng thời gian của từng bước.
+
+File này vừa được controller import (RVCWorkerPool), vừa được chạy như script worker:
+    python rvc_worker.py --model-dir <ai/rvc> --address <socket> --worker-id 0
+"""
+import os
+import re
+import sys
+import time
+import uuid
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import traceback
+import subprocess
+from collections import OrderedDict
+from multiprocessing.connection import Client, Listener
+
+logger = logging.getLogger(__name__)
+
+# authkey được truyền qua biến môi trường để không lộ trên dòng lệnh
+AUTHKEY_ENV = "RVC_WORKER_AUTHKEY"
+
+# Tham số mặc định giống tools/infer_cli.py
+DEFAULT_F0_METHOD = "harvest"
+DEFAULT_FILTER_RADIUS = 3
+DEFAULT_RESAMPLE_SR = 0
+
+
+class RVCWorkerError(Exception):
+    """Worker không khởi động được hoặc bị chết giữa chừng"""
+
+
+class _RVCWorker:
+    """Phía controller của một worker: process, kết nối IPC và các giọng đang thường trú"""
+
+    def __init__(self, worker_id, process, conn):
+        self.worker_id = worker_id
+        self.process = process
+        self.conn = conn
+        self.voices = []  # model_path các giọng đang được giữ trong worker
+        self.busy = False
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        if self.is_alive():
+            self.process.kill()
+            self.process.wait()
+
+
+class RVCWorkerPool:
+    """
+    Pool các worker RVC thường trú.
+
+    Job được giao cho worker rảnh đã load sẵn giọng cần dùng nếu có, nếu không thì cho worker
+    rảnh bất kỳ. Worker chết hoặc quá thời gian bị bỏ khỏi pool và được khởi động lại ở thread
+    nền (không chặn request).
+    """
+
+    def __init__(self, model_dir, num_workers=1, max_voices=4, log_dir=None,
+                 startup_timeout=300, job_timeout=600):
+        self.model_dir = model_dir
+        self.num_workers = max(1, int(num_workers))
+        self.max_voices = max(1, int(max_voices))
+        self.log_dir = log_dir or os.path.join(model_dir, 'logs')
+        self.startup_timeout = startup_timeout
+        self.job_timeout = job_timeout
+
+        self.workers = []
+        self.condition = threading.Condition()
+        self.closed = False
+        # id các worker đang được khởi động lại và lỗi của lần khởi động lại gần nhất (None nếu thành công)
+        self.respawning = set()
+        self.spawn_error = None
+
+        # Thống kê thời gian từng bước: bước -> (tổng giây, số job), cộng dồn từ lúc khởi động
+        self.stats_lock = threading.Lock()
+        self.stats = {'jobs': 0, 'errors': 0, 'timings': {}}
+
+    def start(self):
+        """Khởi động tất cả worker và chờ đến khi chúng sẵn sàng (đã load HuBERT)"""
+        os.makedirs(self.log_dir, exist_ok=True)
+        for worker_id in range(self.num_workers):
+            self.workers.append(self._spawn(worker_id))
+        logger.info(f"Đã khởi động {self.num_workers} worker RVC")
+
+    def _spawn(self, worker_id):
+        """Chạy một process worker và kết nối tới nó qua IPC"""
+        if sys.platform == 'win32':
+            address = rf"\\.\pipe\rvc-worker-{os.getpid()}-{uuid.uuid4().hex}"
+        else:
+            address = os.path.join(tempfile.mkdtemp(prefix='rvc-worker-'), 'worker.sock')
+        authkey = os.urandom(16)
+
+        env = dict(os.environ)
+        env[AUTHKEY_ENV] = authkey.hex()
+        cmd = [
+            sys.executable, os.path.abspath(__file__),
+            "--model-dir", self.model_dir,
+            "--address", address,
+            "--worker-id", str(worker_id),
+            "--max-voices", str(self.max_voices),
+        ]
+        log_path = os.path.join(self.log_dir, f"rvc_worker_{worker_id}.log")
+        with open(log_path, 'a', encoding='utf-8') as log_file:
+            process = subprocess.Popen(
+                cmd,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+                cwd=self.model_dir,
+                env=env
+            )
+        logger.info(f"Đang khởi động worker RVC {worker_id} (pid {process.pid}), log: {log_path}")
+
+        start = time.perf_counter()
+        deadline = time.monotonic() + self.startup_timeout
+        conn = None
+        while conn is None:
+            if process.poll() is not None:
+                raise RVCWorkerError(f"Worker RVC {worker_id} đã thoát với mã {process.returncode}, xem {log_path}")
+            if time.monotonic() > deadline:
+                process.kill()
+                raise RVCWorkerError(f"Worker RVC {worker_id} không phản hồi sau {self.startup_timeout}s")
+            try:
+                conn = Client(address, authkey=authkey)
+            except (FileNotFoundError, ConnectionRefusedError, OSError):
+                time.sleep(0.1)
+
+        worker = _RVCWorker(worker_id, process, conn)
+        remaining = max(0.0, deadline - time.monotonic())
+        try:
+            if not conn.poll(remaining):
+                raise RVCWorkerError(f"Worker RVC {worker_id} không sẵn sàng sau {self.startup_timeout}s")
+            message = conn.recv()
+        except (EOFError, OSError) as e:
+            worker.kill()
+            raise RVCWorkerError(f"Worker RVC {worker_id} bị ngắt khi khởi động: {str(e)}, xem {log_path}")
+        except RVCWorkerError:
+            worker.kill()
+            raise
+
+        if sys.platform != 'win32':
+            # worker đã đóng listener, chỉ còn thư mục tạm chứa socket
+            shutil.rmtree(os.path.dirname(address), ignore_errors=True)
+
+        if not message.get('ok'):
+            worker.kill()
+            raise RVCWorkerError(f"Worker RVC {worker_id} khởi động lỗi: {message.get('error')}")
+
+        logger.info(f"Worker RVC {worker_id} sẵn sàng sau {time.perf_counter() - start:.2f}s, "
+                    f"thời gian khởi động: {message.get('timings')}")
+        return worker
+
+    def _acquire(self, model_path):
+        """Lấy một worker rảnh, ưu tiên worker đã load sẵn model_path"""
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise RVCWorkerError("Pool worker RVC đã đóng")
+                idle = [w for w in self.workers if not w.busy]
+                if idle:
+                    warm = [w for w in idle if model_path in w.voices]
+                    worker = warm[0] if warm else min(idle, key=lambda w: len(w.voices))
+                    worker.busy = True
+                    return worker
+                if not self.workers and self.spawn_error:
+                    # Không còn worker nào và lần khởi động lại gần nhất đã lỗi: báo lỗi ngay thay vì chờ
+                    raise RVCWorkerError(f"Không có worker RVC nào đang chạy: {self.spawn_error}")
+                self.condition.wait()
+
+    def _release(self, worker):
+        with self.condition:
+            worker.busy = False
+            self.condition.notify()
+
+    def _discard(self, worker):
+        """Bỏ worker bị lỗi khỏi pool (_acquire không chọn nữa) và khởi động lại nó ở thread nền"""
+        with self.condition:
+            if worker in self.workers:
+                self.workers.remove(worker)
+            start = not self.closed and worker.worker_id not in self.respawning
+            if start:
+                self.respawning.add(worker.worker_id)
+        worker.kill()
+        if start:
+            threading.Thread(target=self._respawn, args=(worker.worker_id,),
+                             name=f"rvc-respawn-{worker.worker_id}", daemon=True).start()
+
+    def _respawn(self, worker_id):
+        """Khởi động lại worker cho đến khi thành công (chờ lâu dần giữa các lần lỗi)"""
+        delay = 1
+        while True:
+            with self.condition:
+                if self.closed:
+                    self.respawning.discard(worker_id)
+                    return
+            try:
+                worker = self._spawn(worker_id)
+            except Exception as e:
+                logger.error(f"Không khởi động lại được worker RVC {worker_id}: {str(e)}, thử lại sau {delay}s")
+                with self.condition:
+                    self.spawn_error = str(e)
+                    self.condition.notify_all()
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+                continue
+
+            with self.condition:
+                self.respawning.discard(worker_id)
+                if not self.closed:
+                    self.workers.append(worker)
+                    self.spawn_error = None
+                    self.condition.notify_all()
+                    return
+            worker.kill()
+            return
+
+    def convert(self, input_path, output_path, model_path, index_path=None, f0up_key=0,
+                index_rate=0.5, protect=0.33, rms_mix_rate=0.25, f0_method=DEFAULT_F0_METHOD,
+                filter_radius=DEFAULT_FILTER_RADIUS, resample_sr=DEFAULT_RESAMPLE_SR):
+        """
+        Chuyển đổi một file trên worker thường trú
+
+        Returns:
+            dict: {'ok': bool, 'error': str|None, 'timings': {bước: giây}}
+        """
+        job = {
+            'input_path': os.path.abspath(input_path),
+            'output_path': os.path.abspath(output_path),
+            'model_path': os.path.abspath(model_path),
+            'index_path': os.path.abspath(index_path) if index_path else "",
+            'f0up_key': int(f0up_key),
+            'index_rate': float(index_rate),
+            'protect': float(protect),
+            'rms_mix_rate': float(rms_mix_rate),
+            'f0_method': f0_method,
+            'filter_radius': int(filter_radius),
+            'resample_sr': int(resample_sr),
+        }
+
+        submitted = time.perf_counter()
+        try:
+            worker = self._acquire(job['model_path'])
+        except RVCWorkerError as e:
+            result = {'ok': False, 'error': str(e), 'timings': {'queue': time.perf_counter() - submitted}}
+            self._record(result)
+            return result
+        queue_time = time.perf_counter() - submitted
+        try:
+            try:
+                worker.conn.send(job)
+                if not worker.conn.poll(self.job_timeout):
+                    raise RVCWorkerError(f"Job quá thời gian {self.job_timeout}s")
+                result = worker.conn.recv()
+                worker.voices = result.get('voices', worker.voices)
+            except (EOFError, OSError, RVCWorkerError) as e:
+                logger.error(f"Worker RVC {worker.worker_id} lỗi khi xử lý job: {str(e)}, khởi động lại worker")
+                self._discard(worker)
+                result = {'ok': False, 'error': str(e), 'timings': {}}
+        finally:
+            self._release(worker)
+
+        result['timings']['queue'] = queue_time
+        result['timings']['roundtrip'] = time.perf_counter() - submitted
+        self._record(result)
+        return result
+
+    def _record(self, result):
+        with self.stats_lock:
+            self.stats['jobs'] += 1
+            if not result.get('ok'):
+                self.stats['errors'] += 1
+            for stage, value in result.get('timings', {}).items():
+                total, count = self.stats['timings'].get(stage, (0.0, 0))
+                self.stats['timings'][stage] = (total + value, count + 1)
+
+    def get_stats(self):
+        """Thời gian trung bình từng bước và trạng thái các worker"""
+        with self.stats_lock:
+            average = {stage: total / count for stage, (total, count) in self.stats['timings'].items()}
+            stats = {'jobs': self.stats['jobs'], 'errors': self.stats['errors'], 'average_timings': average}
+        with self.condition:
+            stats['workers'] = [{
+                'worker_id': w.worker_id,
+                'pid': w.process.pid,
+                'alive': w.is_alive(),
+                'busy': w.busy,
+                'voices': [os.path.splitext(os.path.basename(v))[0] for v in w.voices]
+            } for w in self.workers]
+            stats['respawning'] = sorted(self.respawning)
+        return stats
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            workers, self.workers = self.workers, []
+            self.condition.notify_all()
+        for worker in workers:
+            try:
+                worker.conn.send(None)
+            except Exception:
+                pass
+            try:
+                worker.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                pass
+            worker.kill()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_worker_pool(model_dir, name='default', **kwargs):
+    """
+    Pool dùng chung trong process cho mỗi thư mục RVC (app.py và rvc_routes.py đều tạo controller
+    riêng nhưng phải dùng chung worker). name tách các pool riêng (ví dụ pool cho chuyển đổi hàng
+    loạt). Trả về None nếu không khởi động được.
+    """
+    key = (model_dir, name)
+    with _pools_lock:
+        if key not in _pools:
+            pool = RVCWorkerPool(model_dir, **kwargs)
+            try:
+                pool.start()
+            except Exception as e:
+                logger.error(f"Không thể khởi động pool worker RVC ({name}): {str(e)}")
+                pool.close()
+                pool = None
+            _pools[key] = pool
+        return _pools[key]
+
+
+# ---------------------------------------------------------------------------
+# Phía worker
+# ---------------------------------------------------------------------------
+
+class _IndexCache:
+    """Cache faiss.read_index theo (đường dẫn, mtime) để không đọc lại index mỗi job"""
+
+    def __init__(self, read_index, max_size):
+        self.read_index = read_index
+        self.max_size = max_size
+        self.indexes = OrderedDict()
+        self.load_time = 0.0
+
+    def __call__(self, path, *args, **kwargs):
+        key = (os.path.abspath(path), os.path.getmtime(path))
+        if key in self.indexes:
+            self.indexes.move_to_end(key)
+            return self.indexes[key]
+        start = time.perf_counter()
+        index = self.read_index(path, *args, **kwargs)
+        self.load_time += time.perf_counter() - start
+        self.indexes[key] = index
+        while len(self.indexes) > self.max_size:
+            self.indexes.popitem(last=False)
+        return index
+
+
+def _parse_rvc_times(info):
+    """vc_single trả về chuỗi '... npy: 0.12s, f0: 1.30s, infer: 0.85s.'"""
+    return {name: float(value) for name, value in re.findall(r"(npy|f0|infer): ([\d.]+)s", info or "")}
+
+
+def _worker_main(args):
+    authkey = bytes.fromhex(os.environ.pop(AUTHKEY_ENV))
+    listener = Listener(args.address, authkey=authkey)
+    conn = listener.accept()
+    listener.close()
+
+    # Process riêng nên có thể chdir / sys.path: RVC dùng đường dẫn tương đối (configs, assets)
+    os.chdir(args.model_dir)
+    if args.model_dir not in sys.path:
+        sys.path.insert(0, args.model_dir)
+    # Config() của RVC tự parse sys.argv
+    sys.argv = sys.argv[:1]
+
+    timings = {}
+    try:
+        start = time.perf_counter()
+        try:
+            from dotenv import load_dotenv
+            load_dotenv()
+        except ImportError:
+            pass
+        import faiss
+        from scipy.io import wavfile
+        from configs.config import Config
+        from infer.modules.vc.modules import VC
+        from infer.modules.vc.utils import load_hubert
+        timings['import'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        config = Config()
+        hubert_model = load_hubert(config)
+        timings['load_hubert'] = time.perf_counter() - start
+
+        index_cache = _IndexCache(faiss.read_index, args.max_voices)
+        faiss.read_index = index_cache
+    except Exception:
+        conn.send({'ok': False, 'error': traceback.format_exc(), 'timings': timings})
+        return
+    conn.send({'ok': True, 'timings': timings})
+    print(f"[worker {args.worker_id}] sẵn sàng: {timings}", flush=True)
+
+    voices = OrderedDict()  # model_path -> (mtime, VC)
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+
+        timings = {}
+        job_start = time.perf_counter()
+        try:
+            model_path = job['model_path']
+            mtime = os.path.getmtime(model_path)
+            start = time.perf_counter()
+            if model_path in voices and voices[model_path][0] == mtime:
+                voices.move_to_end(model_path)
+                vc = voices[model_path][1]
+            else:
+                vc = VC(config)
+                vc.hubert_model = hubert_model
+                # get_vc đọc model từ weight_root + tên file
+                os.environ["weight_root"] = os.path.dirname(model_path)
+                vc.get_vc(os.path.basename(model_path))
+                voices[model_path] = (mtime, vc)
+                while len(voices) > args.max_voices:
+                    voices.popitem(last=False)
+            timings['load_model'] = time.perf_counter() - start
+
+            index_cache.load_time = 0.0
+            start = time.perf_counter()
+            info, (sample_rate, audio) = vc.vc_single(
+                0,
+                job['input_path'],
+                job['f0up_key'],
+                None,
+                job['f0_method'],
+                job['index_path'],
+                None,
+                job['index_rate'],
+                job['filter_radius'],
+                job['resample_sr'],
+                job['rms_mix_rate'],
+                job['protect'],
+            )
+            timings['convert'] = time.perf_counter() - start
+            timings['load_index'] = index_cache.load_time
+            timings.update(_parse_rvc_times(info))
+            if audio is None:
+                raise RuntimeError(info)
+
+            start = time.perf_counter()
+            wavfile.write(job['output_path'], sample_rate, audio)
+            timings['write'] = time.perf_counter() - start
+            timings['total'] = time.perf_counter() - job_start
+            result = {'ok': True, 'error': None, 'timings': timings}
+        except Exception:
+            error = traceback.format_exc()
+            print(f"[worker {args.worker_id}] lỗi: {error}", flush=True)
+            result = {'ok': False, 'error': error, 'timings': timings}
+
+        result['voices'] = list(voices)
+        conn.send(result)
+
+    conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Worker RVC thường trú")
+    parser.add_argument("--model-dir", required=True)
+    parser.add_argument("--address", required=True)
+    parser.add_argument("--worker-id", type=int, default=0)
+    parser.add_argument("--max-voices", type=int, default=4)
+    _worker_main(parser.parse_args())
@@ -0,0 +1,102 @@
+"""
+Cache đặc trưng giọng nói (speaker embedding - SE) của OpenVoice.
+
+Khóa cache là hash nội dung file âm thanh gốc + hash checkpoint converter, nên cùng một file được
+upload lại (khác tên) vẫn trúng cache, còn đổi checkpoint thì các SE cũ tự động không dùng nữa.
+Tầng 1 là LRU trong bộ nhớ, tầng 2 là file .pth trên đĩa (giữ qua các lần khởi động lại).
+"""
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """sha256 nội dung file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SpeakerEmbeddingCache:
+    def __init__(self, cache_dir, max_items=256):
+        """
+        Args:
+            cache_dir (str): Thư mục lưu SE trên đĩa
+            max_items (int): Số SE tối đa giữ trong bộ nhớ
+        """
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        # (đường dẫn, kích thước, mtime) -> hash checkpoint, tránh hash lại file checkpoint lớn
+        self.checkpoint_ids = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def checkpoint_id(self, checkpoint_path):
+        stat = os.stat(checkpoint_path)
+        key = (os.path.abspath(checkpoint_path), stat.st_size, stat.st_mtime)
+        with self.lock:
+            if key in self.checkpoint_ids:
+                return self.checkpoint_ids[key]
+        checkpoint_id = file_hash(checkpoint_path)[:16]
+        with self.lock:
+            self.checkpoint_ids[key] = checkpoint_id
+        return checkpoint_id
+
+    def get(self, converter, checkpoint_path, audio_path, prepare=None):
+        """
+        Lấy SE của audio_path, chỉ chạy converter.extract_se khi không có trong cache
+
+        Args:
+            converter: ToneColorConverter đã load checkpoint_path
+            checkpoint_path (str): Checkpoint của converter (một phần của khóa cache)
+            audio_path (str): File âm thanh gốc, dùng để tính khóa
+            prepare (callable): prepare(audio_path) -> file đưa vào extract_se (ví dụ chuẩn hóa
+                sample rate), chỉ được gọi khi cache miss
+
+        Returns:
+            torch.Tensor: Đặc trưng giọng nói
+        """
+        import torch
+
+        key = f"{file_hash(audio_path)}_{self.checkpoint_id(checkpoint_path)}"
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                logger.info(f"SE cache hit (bo nho): {os.path.basename(audio_path)}")
+                return self.memory[key]
+
+        disk_path = os.path.join(self.cache_dir, f"{key}.pth")
+        se = None
+        if os.path.exists(disk_path):
+            try:
+                se = torch.load(disk_path, map_location=converter.device)
+                logger.info(f"SE cache hit (dia): {os.path.basename(audio_path)}")
+            except Exception as e:
+                logger.warning(f"Khong doc duoc SE cache {disk_path}: {str(e)}")
+
+        if se is None:
+            extract_path = prepare(audio_path) if prepare else audio_path
+            se = converter.extract_se([extract_path])
+            # Ghi ra file tạm rồi đổi tên để không để lại file hỏng khi ghi đồng thời
+            tmp_path = f"{disk_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                torch.save(se, tmp_path)
+                os.replace(tmp_path, disk_path)
+            except Exception as e:
+                logger.warning(f"Khong ghi duoc SE cache {disk_path}: {str(e)}")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        with self.lock:
+            self.memory[key] = se
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_items:
+                self.memory.popitem(last=False)
+        return se
@@ -0,0 +1,347 @@
+"""
+Pool bộ tách giọng UVR5 (AudioPre / AudioPreDeEcho) thường trú theo tên model.
+
+Mỗi model (HP2, HP3, HP5, DeEcho...) chỉ load file .pth một lần rồi giữ lại, các lần tách giọng
+sau chỉ còn chạy suy luận trên spectrogram. Tổng bộ nhớ các model có giới hạn, model ít dùng nhất
+(và không đang được dùng) bị giải phóng trước.
+
+Pool không đổi thư mục làm việc hay biến môi trường: đường dẫn file tham số tương đối mà AudioPre
+dùng được chuyển thành đường dẫn tuyệt đối trong thư mục RVC, nên nhiều request có thể tách giọng
+song song (trên executor có giới hạn số thread).
+
+File dài được tách theo từng cửa sổ chồng lấn nhau (separate_windowed): bộ nhớ chỉ phụ thuộc độ
+dài cửa sổ, không phụ thuộc độ dài file.
+"""
+import os
+import gc
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def _stem_dirs(tmp_dir, is_hp3):
+    """
+    Thư mục tạm (ins_root, vocal_root) cho _path_audio_ và thư mục chứa từng stem. Model HP3 ghi
+    giọng hát (tiền tố vocal_) vào ins_root và nhạc nền vào vocal_root.
+    """
+    ins_root = os.path.join(tmp_dir, "ins")
+    vocal_root = os.path.join(tmp_dir, "vocal")
+    if is_hp3:
+        return ins_root, vocal_root, {'vocals': ins_root, 'instrumental': vocal_root}
+    return ins_root, vocal_root, {'vocals': vocal_root, 'instrumental': ins_root}
+
+
+class _SeparatorEntry:
+    def __init__(self, model_name, model_path):
+        self.model_name = model_name
+        self.model_path = model_path
+        self.separator = None
+        self.size_bytes = 0
+        self.refcount = 0  # số request đang dùng, không được giải phóng khi > 0
+        self.last_used = time.monotonic()
+        self.load_lock = threading.Lock()
+
+
+_vr_module = None
+_vr_lock = threading.Lock()
+
+
+def _import_vr(model_dir):
+    """
+    Import infer.modules.uvr5.vr của RVC một lần. AudioPre đọc file tham số theo đường dẫn tương đối
+    với thư mục RVC (infer/lib/uvr5_pack/...), thay ModelParameters trong module để đường dẫn đó
+    được hiểu theo model_dir thay vì thư mục làm việc hiện tại.
+    """
+    global _vr_module
+    with _vr_lock:
+        if _vr_module is None:
+            if model_dir not in sys.path:
+                sys.path.insert(0, model_dir)
+            from infer.modules.uvr5 import vr
+
+            model_parameters = vr.ModelParameters
+
+            def absolute_model_parameters(config_path="", *args, **kwargs):
+                if config_path and not os.path.isabs(config_path):
+                    config_path = os.path.join(model_dir, config_path)
+                return model_parameters(config_path, *args, **kwargs)
+
+            vr.ModelParameters = absolute_model_parameters
+            _vr_module = vr
+        return _vr_module
+
+
+def _separator_size(separator):
+    model = getattr(separator, 'model', None)
+    if model is None:
+        return 0
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+
+class UVRSeparatorPool:
+    def __init__(self, model_dir, device='cpu', is_half=False, memory_budget_mb=2048, agg=0, max_workers=None):
+        """
+        Args:
+            model_dir (str): Thư mục RVC (chứa infer/modules/uvr5)
+            device (str): Thiết bị chạy model
+            is_half (bool): Dùng half precision (chỉ khi chạy GPU)
+            memory_budget_mb (float): Tổng bộ nhớ tối đa cho các model thường trú
+            agg (int): Mức độ tách (0-100) dùng khi khởi tạo bộ tách
+            max_workers (int): Số lần tách giọng chạy song song, mặc định bằng số nhân CPU
+        """
+        self.model_dir = os.path.abspath(model_dir)
+        self.device = device
+        self.is_half = is_half
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.agg = agg
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.max_workers = max(1, int(max_workers or os.cpu_count() or 1))
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="uvr")
+
+    def separate(self, model_name, model_path, input_path, outputs, is_hp3=False):
+        """
+        Tách giọng file input_path (đường dẫn tuyệt đối) trên executor, chờ đến khi xong
+
+        Args:
+            outputs (dict): Đường dẫn file kết quả {'vocals': ..., 'instrumental': ...}
+
+        Returns:
+            tuple: (outputs, thời gian lấy model, thời gian tách giọng)
+        """
+        return self.executor.submit(
+            self._separate, model_name, model_path, input_path, outputs, is_hp3
+        ).result()
+
+    def _separate(self, model_name, model_path, input_path, outputs, is_hp3):
+        start = time.perf_counter()
+        with self.use(model_name, model_path) as separator:
+            load_time = time.perf_counter() - start
+            # _path_audio_ tự đặt tên file theo tên đầu vào, nên ghi vào thư mục tạm riêng của lần tách
+            # này rồi đổi tên thành đường dẫn đã định trước
+            tmp_dir = tempfile.mkdtemp(prefix=".uvr_", dir=os.path.dirname(outputs['vocals']))
+            try:
+                ins_root, vocal_root, stem_dirs = _stem_dirs(tmp_dir, is_hp3)
+                separator._path_audio_(
+                    input_path,  # Đường dẫn tuyệt đối đầu vào
+                    ins_root,    # Thư mục cho nhạc nền
+                    vocal_root,  # Thư mục cho giọng hát
+                    "wav",       # Định dạng xuất
+                    is_hp3=is_hp3
+                )
+                for key, stem_dir in stem_dirs.items():
+                    os.replace(os.path.join(stem_dir, os.listdir(stem_dir)[0]), outputs[key])
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        return outputs, load_time, time.perf_counter() - start - load_time
+
+    def separate_windowed(self, model_name, model_path, input_path, outputs, is_hp3=False,
+                          window_seconds=30, overlap_seconds=1, progress=None):
+        """
+        Tách giọng theo từng cửa sổ window_seconds giây (chồng lấn overlap_seconds giây), trộn chéo
+        các đoạn chồng lấn và ghi dần ra các file trong outputs.
+
+        Args:
+            outputs (dict): Đường dẫn file kết quả {'vocals': ..., 'instrumental': ...}
+            progress (callable): progress(số cửa sổ đã xong, tổng số cửa sổ)
+
+        Returns:
+            tuple: (outputs, thời gian lấy model, thời gian tách giọng)
+        """
+        if not 0 <= overlap_seconds < window_seconds:
+            raise ValueError(f"overlap_seconds ({overlap_seconds}) phải nhỏ hơn window_seconds ({window_seconds})")
+        return self.executor.submit(
+            self._separate_windowed, model_name, model_path, input_path, outputs, is_hp3,
+            window_seconds, overlap_seconds, progress
+        ).result()
+
+    def _separate_windowed(self, model_name, model_path, input_path, outputs, is_hp3,
+                           window_seconds, overlap_seconds, progress):
+        import numpy as np
+        import soundfile as sf
+
+        start = time.perf_counter()
+        with self.use(model_name, model_path) as separator:
+            load_time = time.perf_counter() - start
+            tmp_dir = tempfile.mkdtemp(prefix=".uvr_", dir=os.path.dirname(outputs['vocals']))
+            writers = {}
+            try:
+                with sf.SoundFile(input_path) as source:
+                    sr = source.samplerate
+                    window = max(1, int(window_seconds * sr))
+                    hop = max(1, window - int(overlap_seconds * sr))
+                    # Cửa sổ cuối được lùi lại cho đủ độ dài thay vì để một đoạn rất ngắn ở cuối file
+                    starts = list(range(0, max(1, source.frames - window + hop), hop))
+                    starts[-1] = max(0, min(starts[-1], source.frames - window))
+                    total = len(starts)
+
+                    tails = {}
+                    window_path = os.path.join(tmp_dir, "window.wav")
+                    ins_root, vocal_root, stem_dirs = _stem_dirs(tmp_dir, is_hp3)
+                    for index, window_start in enumerate(starts):
+                        source.seek(window_start)
+                        sf.write(window_path, source.read(window, dtype='float32', always_2d=True), sr)
+                        separator._path_audio_(window_path, ins_root, vocal_root, "wav", is_hp3=is_hp3)
+
+                        # Số mẫu (theo sample rate đầu vào) chồng lấn với cửa sổ sau
+                        window_end = min(window_start + window, source.frames)
+                        next_overlap = max(0, window_end - starts[index + 1]) if index + 1 < total else 0
+
+                        for key, stem_dir in stem_dirs.items():
+                            stem_path = os.path.join(stem_dir, os.listdir(stem_dir)[0])
+                            stem, out_sr = sf.read(stem_path, dtype='float32', always_2d=True)
+                            os.remove(stem_path)
+                            if key not in writers:
+                                writers[key] = sf.SoundFile(f"{outputs[key]}.part", 'w', samplerate=out_sr,
+                                                            channels=stem.shape[1], subtype='PCM_16', format='WAV')
+
+                            # Trộn chéo tuyến tính phần đầu cửa sổ với phần cuối đã giữ lại của cửa sổ trước
+                            tail = tails.pop(key, None)
+                            if tail is not None:
+                                n = min(len(tail), len(stem))
+                                ramp = np.linspace(0.0, 1.0, n, dtype=np.float32)[:, None]
+                                stem[:n] = tail[:n] * (1.0 - ramp) + stem[:n] * ramp
+
+                            keep = min(len(stem), int(round(next_overlap * out_sr / sr)))
+                            writers[key].write(stem[:len(stem) - keep])
+                            if keep:
+                                tails[key] = stem[len(stem) - keep:]
+
+                        if progress:
+                            progress(index + 1, total)
+
+                for key, writer in writers.items():
+                    writer.close()
+                    os.replace(f"{outputs[key]}.part", outputs[key])
+                writers = {}
+            finally:
+                for key, writer in writers.items():
+                    writer.close()
+                    if os.path.exists(f"{outputs[key]}.part"):
+                        os.remove(f"{outputs[key]}.part")
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        return outputs, load_time, time.perf_counter() - start - load_time
+
+    @contextmanager
+    def use(self, model_name, model_path):
+        """
+        Lấy bộ tách của model (load ở lần đầu). _path_audio_ chỉ đọc tham số của instance nên nhiều
+        thread có thể dùng chung một bộ tách.
+
+            with pool.use("HP2_all_vocals", path) as separator:
+                separator._path_audio_(...)
+        """
+        entry = self._acquire(model_name, model_path)
+        try:
+            yield entry.separator
+        finally:
+            with self.lock:
+                entry.refcount -= 1
+                entry.last_used = time.monotonic()
+                self._enforce_budget()
+
+    def warm(self, models):
+        """Load trước các model, models là danh sách (tên model, đường dẫn .pth)"""
+        for model_name, model_path in models:
+            try:
+                entry = self._acquire(model_name, model_path)
+                with self.lock:
+                    entry.refcount -= 1
+                    self._enforce_budget()
+            except Exception as e:
+                logger.warning(f"Khong the load truoc model UVR5 {model_name}: {str(e)}")
+
+    def _acquire(self, model_name, model_path):
+        with self.lock:
+            entry = self.entries.get(model_name)
+            if entry is None:
+                entry = _SeparatorEntry(model_name, model_path)
+                self.entries[model_name] = entry
+            entry.refcount += 1
+
+        try:
+            with entry.load_lock:
+                if entry.separator is None:
+                    self._load(entry)
+        except Exception:
+            with self.lock:
+                entry.refcount -= 1
+                if entry.separator is None and entry.refcount == 0:
+                    self.entries.pop(model_name, None)
+            raise
+
+        entry.last_used = time.monotonic()
+        return entry
+
+    def _load(self, entry):
+        vr = _import_vr(self.model_dir)
+
+        start = time.perf_counter()
+        processor_class = vr.AudioPreDeEcho if "DeEcho" in entry.model_name else vr.AudioPre
+        separator = processor_class(
+            agg=self.agg,  # Mức độ xử lý (0-100)
+            model_path=entry.model_path,
+            device=self.device,
+            is_half=self.is_half
+        )
+        size = _separator_size(separator)
+        with self.lock:
+            entry.separator = separator
+            entry.size_bytes = size
+        logger.info(f"Da load model UVR5 {entry.model_name} trong {time.perf_counter() - start:.2f}s "
+                    f"({size / 1024 / 1024:.1f}MB)")
+
+    def _loaded_size(self):
+        return sum(e.size_bytes for e in self.entries.values() if e.separator is not None)
+
+    def _enforce_budget(self):
+        """Giải phóng model ít dùng nhất (không đang dùng) đến khi nằm trong ngân sách (gọi khi giữ self.lock)"""
+        idle = sorted(
+            (e for e in self.entries.values() if e.refcount == 0 and e.separator is not None),
+            key=lambda e: e.last_used
+        )
+        evicted = False
+        while self._loaded_size() > self.memory_budget and idle:
+            entry = idle.pop(0)
+            logger.info(f"Giai phong model UVR5 {entry.model_name}")
+            self.entries.pop(entry.model_name, None)
+            entry.separator = None
+            evicted = True
+        if evicted:
+            gc.collect()
+
+    def get_stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                'memory_budget_mb': self.memory_budget / 1024 / 1024,
+                'loaded_mb': self._loaded_size() / 1024 / 1024,
+                'max_workers': self.max_workers,
+                'models': [{
+                    'name': e.model_name,
+                    'size_mb': e.size_bytes / 1024 / 1024,
+                    'in_use': e.refcount,
+                    'idle_seconds': now - e.last_used
+                } for e in self.entries.values() if e.separator is not None]
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_uvr_pool(**kwargs):
+    """Pool dùng chung trong process (tham số chỉ có tác dụng ở lần gọi đầu tiên)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = UVRSeparatorPool(**kwargs)
+        return _pool
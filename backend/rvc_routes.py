@@ -24,6 +24,20 @@ def list_rvc_models():
             'error': str(e)
         }), 500
 
+@rvc_bp.route('/api/rvc/workers', methods=['GET'])
+def rvc_worker_stats():
+    """Trạng thái pool worker RVC và thời gian trung bình từng bước xử lý"""
+    stats = rvc.get_worker_stats()
+    if stats is None:
+        return jsonify({
+            'success': False,
+            'error': 'Pool worker RVC không hoạt động'
+        }), 404
+    return jsonify({
+        'success': True,
+        'stats': stats
+    })
+
 @rvc_bp.route('/api/rvc/convert', methods=['POST'])
 def convert_voice():
     """Chuyển đổi giọng nói sử dụng RVC"""
@@ -135,6 +149,14 @@ def list_uvr_models():
             'error': 'Không thể lấy danh sách model UVR5'
         }), 500
 
+@rvc_bp.route('/api/uvr/pool', methods=['GET'])
+def uvr_pool_stats():
+    """Các model UVR5 đang thường trú trong bộ nhớ"""
+    return jsonify({
+        'success': True,
+        'stats': rvc.get_uvr_pool().get_stats()
+    })
+
 @rvc_bp.route('/api/rvc/separate-vocals', methods=['POST'])
 def separate_vocals():
     """Tách giọng nói khỏi nhạc nền bằng UVR5"""